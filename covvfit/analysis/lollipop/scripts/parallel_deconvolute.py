@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Run `lollipop deconvolute` per location (and optionally per var_dates period) in parallel
+
+One `lollipop deconvolute` over the whole tally runs the bootstrap of every
+location in one process. This driver instead:
+- splits tallymut.tsv.zst in one streaming pass (tallymut_reader) into one TSV
+  per location of locations_list, or per location and var_dates period with
+  --by-period, keeping only the columns and dates the deconvolution needs
+- writes a variant config (locations_list: [location]) and, per period, a
+  var_dates file with that period only, for every partition
+- runs one lollipop process per partition, as many at a time as the allocation
+  has cores (SLURM_CPUS_PER_TASK, else the CPU affinity) divided by --cores-per-task
+- seeds every partition with a value derived from --seed, the location and the
+  period, so a rerun gives the same results regardless of scheduling
+- concatenates the per-partition results, in location and period order, into
+  the output CSV (header written once)
+
+lollipop deconvolutes every location and every var_dates period on its own,
+so the partitions are independent.
+
+USAGE:
+    python parallel_deconvolute.py tallymut.tsv.zst -o deconvolved.csv \\
+        --variants-config variant_config.yaml --variants-dates var_dates.yaml \\
+        --deconv-config deconv_config.yaml --filters filters_badmut.yaml --seed 42 [--by-period] [--cache tallymut_parquet]
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+import yaml
+
+import tallymut_reader
+
+
+class Partition(NamedTuple):
+    location: str
+    # var_dates period start (inclusive) and end (inclusive), None for the whole range
+    period_start: Optional[str]
+    period_end: Optional[str]
+
+    @property
+    def name(self) -> str:
+        slug = "".join(c if c.isalnum() else "_" for c in self.location).strip("_")
+        return slug + (f"_{self.period_start}" if self.period_start else "")
+
+
+def allocated_cpus() -> int:
+    """Cores of the SLURM allocation, else the cores this process may run on."""
+    for var in ("SLURM_CPUS_PER_TASK", "SLURM_CPUS_ON_NODE"):
+        if os.environ.get(var, "").isdigit():
+            return int(os.environ[var])
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def partition_seed(seed: int, partition: Partition) -> int:
+    """Seed of a partition, from the global seed and the partition itself (not its position in the run)."""
+    key = f"{seed}\t{partition.location}\t{partition.period_start or ''}".encode("utf-8")
+    return int.from_bytes(hashlib.sha256(key).digest()[:4], "big") % (2**31 - 1)
+
+
+def var_dates_periods(var_dates: Dict) -> List[tuple]:
+    """[(start, end)] of the var_dates periods; a period ends the day before the next one starts."""
+    starts = sorted(str(d) for d in var_dates)
+    periods = []
+    for i, start in enumerate(starts):
+        end = None
+        if i + 1 < len(starts):
+            end = (datetime.date.fromisoformat(starts[i + 1]) - datetime.timedelta(days=1)).isoformat()
+        periods.append((start, end))
+    return periods
+
+
+def split_tally(
+    tally: str,
+    partitions: List[Partition],
+    columns: List[str],
+    date_from: Optional[str],
+    date_to: Optional[str],
+    workdir: str,
+    cache: Optional[str] = None,
+) -> Dict[Partition, int]:
+    """Write <workdir>/<partition>/tallymut.tsv for every partition; returns the number of rows of each."""
+    writers = {}
+    rows = dict.fromkeys(partitions, 0)
+    locations = sorted({p.location for p in partitions})
+    read_columns = columns + [c for c in ("date", "location") if c not in columns]
+
+    if cache is not None:
+        if not tallymut_reader.cache_is_current(tally, cache):
+            print(f"Rebuilding the partitioned copy {cache} from {tally}")
+            tallymut_reader.write_partitioned(tally, cache)
+        # one location at a time, in the row order of the tally
+        batches = (
+            batch
+            for location in locations
+            for batch in tallymut_reader.read_table(cache, read_columns, date_from, date_to, [location]).to_batches()
+        )
+    else:
+        batches = tallymut_reader.iter_batches(tally, read_columns, date_from, date_to, locations)
+
+    try:
+        for partition in partitions:
+            os.makedirs(os.path.join(workdir, partition.name), exist_ok=True)
+            writers[partition] = tallymut_reader.tsv_writer(
+                os.path.join(workdir, partition.name, "tallymut.tsv"), columns
+            )
+        for batch in batches:
+            for partition in partitions:
+                mask = tallymut_reader.row_mask(batch, partition.period_start, partition.period_end, [partition.location])
+                selected = batch.filter(mask)
+                if selected.num_rows:
+                    writers[partition][1].write_batch(selected.select(columns))
+                    rows[partition] += selected.num_rows
+    finally:
+        for sink, writer in writers.values():
+            writer.close()
+            sink.close()
+    return rows
+
+
+def write_partition_configs(partition: Partition, variants_config: Dict, var_dates: Dict, workdir: str):
+    directory = os.path.join(workdir, partition.name)
+    config = dict(variants_config, locations_list=[partition.location])
+    with open(os.path.join(directory, "variant_config.yaml"), "w") as f:
+        yaml.safe_dump(config, f, sort_keys=False, allow_unicode=True)
+    dates = var_dates["var_dates"]
+    if partition.period_start is not None:
+        key = next(k for k in dates if str(k) == partition.period_start)
+        dates = {key: dates[key]}
+    with open(os.path.join(directory, "var_dates.yaml"), "w") as f:
+        yaml.safe_dump(dict(var_dates, var_dates=dates), f, sort_keys=False, allow_unicode=True)
+
+
+def run_partition(partition: Partition, args, workdir: str) -> Optional[str]:
+    """Deconvolute one partition; returns None on success, else the reason it failed."""
+    directory = os.path.join(workdir, partition.name)
+    command = [
+        args.lollipop, "deconvolute", os.path.join(directory, "tallymut.tsv"),
+        "-o", os.path.join(directory, "deconvolved.csv"),
+        "--variants-config", os.path.join(directory, "variant_config.yaml"),
+        "--variants-dates", os.path.join(directory, "var_dates.yaml"),
+        "--deconv-config", args.deconv_config,
+        f"--seed={partition_seed(args.seed, partition)}",
+        f"--n-cores={args.cores_per_task}",
+    ]
+    if args.filters:
+        command += ["--filters", args.filters]
+
+    start_time = time.time()
+    with open(os.path.join(directory, "lollipop.log"), "w") as log:
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        return f"exit code {result.returncode}, see {os.path.join(directory, 'lollipop.log')}"
+    print(f"Deconvoluted {partition.name} in {time.time() - start_time:.0f}s")
+    return None
+
+
+def concatenate(results: List[str], output: str):
+    """Concatenate CSV files with the same header, writing the header once."""
+    tmp_output = output + ".tmp"
+    with open(tmp_output, "w") as out:
+        header = None
+        for path in results:
+            with open(path, "r") as f:
+                first = f.readline()
+                if header is None:
+                    header = first
+                    out.write(first)
+                elif first != header:
+                    raise ValueError(f"{path} has a different header than {results[0]}")
+                shutil.copyfileobj(f, out)
+    os.replace(tmp_output, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-location parallel lollipop deconvolution.")
+    parser.add_argument("tally", help="tallymut.tsv.zst (or .tsv)")
+    parser.add_argument("-o", "--output", required=True, help="Output CSV (deconvolved.csv)")
+    parser.add_argument("--variants-config", required=True)
+    parser.add_argument("--variants-dates", required=True)
+    parser.add_argument("--deconv-config", required=True)
+    parser.add_argument("--filters", default=None)
+    parser.add_argument("--seed", type=int, default=42, help="Global seed; every partition gets one derived from it")
+    parser.add_argument("--by-period", action="store_true", help="Also split every location by var_dates period")
+    parser.add_argument("--cores-per-task", type=int, default=1, help="--n-cores of every lollipop process (default: 1)")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent lollipop processes (default: allocated cores / cores per task)")
+    parser.add_argument("--cache", default=None, help="Partitioned Parquet copy of the tally (see tallymut_reader.py)")
+    parser.add_argument("--workdir", default=None, help="Directory for the partitions (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--lollipop", default="lollipop", help="lollipop executable")
+    args = parser.parse_args()
+
+    with open(args.variants_config, "r") as f:
+        variants_config = yaml.safe_load(f)
+    with open(args.variants_dates, "r") as f:
+        var_dates = yaml.safe_load(f)
+
+    header = tallymut_reader.read_header(args.tally)
+    locations = variants_config.get("locations_list") or []
+    if not locations:
+        parser.error("the variant config has no locations_list to partition by")
+    periods = var_dates_periods(var_dates["var_dates"]) if args.by_period else [(None, None)]
+    partitions = [Partition(str(location), start, end) for location in locations for start, end in periods]
+
+    workers = args.workers or max(1, allocated_cpus() // args.cores_per_task)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="deconvolute.", dir=os.environ.get("TMPDIR"))
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        start_time = time.time()
+        predicates = tallymut_reader.config_predicates(args.variants_config)
+        rows = split_tally(
+            args.tally,
+            partitions,
+            tallymut_reader.deconvolution_columns(header, args.variants_config),
+            predicates["date_from"],
+            predicates["date_to"],
+            workdir,
+            args.cache,
+        )
+        print(f"Split {args.tally} into {len(partitions)} partitions in {time.time() - start_time:.0f}s")
+
+        todo = []
+        for partition in partitions:
+            if rows[partition] == 0:
+                print(f"[WARN] No rows for {partition.name}, skipped")
+                continue
+            write_partition_configs(partition, variants_config, var_dates, workdir)
+            todo.append(partition)
+        if not todo:
+            # keep the previous output rather than replacing it with an empty file
+            print(f"[ERROR] No rows for any partition (locations_list or date window?), {args.output} left unchanged", file=sys.stderr)
+            sys.exit(1)
+
+        print(f"Deconvoluting {len(todo)} partitions with {workers} worker(s), {args.cores_per_task} core(s) each")
+        # the work happens in the lollipop child processes; the threads only wait for them
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            errors = dict(zip(todo, pool.map(lambda p: run_partition(p, args, workdir), todo)))
+        failed = {p: e for p, e in errors.items() if e is not None}
+        for partition, error in failed.items():
+            print(f"[ERROR] {partition.name}: {error}", file=sys.stderr)
+        if failed:
+            sys.exit(1)
+
+        concatenate([os.path.join(workdir, p.name, "deconvolved.csv") for p in todo], args.output)
+        print(f"Wrote {args.output} in {time.time() - start_time:.0f}s")
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
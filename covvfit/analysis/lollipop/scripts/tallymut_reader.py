@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Streaming reader for tallymut.tsv.zst
+
+Reads the V-pipe mutation tally straight from the zstd-compressed file (no
+`zstd -d` copy on disk) in record batches, keeping only:
+- the columns the deconvolution needs (column projection): the tally base
+  columns and the variant columns of variants_pangolin in the variant config
+- the rows in a date range and a list of locations (predicate pushdown); by
+  default start_date, end_date and locations_list of the variant config.
+  Bounds are inclusive, so the subset always contains what lollipop keeps.
+
+All values are read as text, so the subset written by `extract` has the same
+fields as the original file.
+
+A partitioned Parquet copy (<cache>/location=<location>/month=<YYYY-MM>/) can
+be kept for repeated reads: only the partitions of the requested locations and
+months are read, and the copy is rebuilt in the same pass whenever the source
+tally changed (size or modification time).
+
+Requires pyarrow; without it, `iter_chunks` falls back to pandas chunks
+(zstandard needed for .zst), and the Parquet copy is not available.
+
+USAGE:
+    python tallymut_reader.py extract tallymut.tsv.zst -o tallymut.subset.tsv --variants-config variant_config.yaml
+    python tallymut_reader.py extract tallymut.tsv.zst -o tallymut.subset.tsv --variants-config variant_config.yaml --cache tallymut_parquet
+    python tallymut_reader.py extract tallymut.tsv.zst -o zh.tsv --locations "Zürich (ZH)" --from 2024-01-01 --to 2024-06-30
+    python tallymut_reader.py partition tallymut.tsv.zst tallymut_parquet
+
+    from tallymut_reader import iter_batches, iter_chunks
+    for batch in iter_batches("tallymut.tsv.zst", columns=["date", "location", "pos", "frac", "cov"], locations=["Zürich (ZH)"]):
+        ...
+"""
+
+import argparse
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import pandas as pd
+import yaml
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+# tally columns besides the one column per variant (see DeconvolutionPrediagnostics.ipynb)
+BASE_COLUMNS = ("sample", "batch", "proto", "date", "location_code", "location", "pos", "gene", "base", "frac", "cov", "var")
+PARTITION_COLUMNS = ("location", "month")
+ROW_COLUMN = "_row"
+CACHE_VERSION = 1
+STAMP_FILE = "_source.json"
+BLOCK_SIZE = 16 << 20
+
+
+def _require_pyarrow(what: str):
+    if pa is None:
+        raise ImportError(f"{what} requires pyarrow")
+
+
+def _open(path: str):
+    compression = "zstd" if path.endswith(".zst") else None
+    return pa.input_stream(path, compression=compression)
+
+
+def read_header(path: str) -> List[str]:
+    """Column names of a tally file (.tsv or .tsv.zst) or of a partitioned copy."""
+    if os.path.isdir(path):
+        return _read_stamp(path)["header"]
+    if pa is None:
+        return list(pd.read_csv(path, sep="\t", nrows=0).columns)
+    head = b""
+    with _open(path) as f:
+        while b"\n" not in head:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            head += chunk
+    return head.split(b"\n", 1)[0].decode("utf-8").rstrip("\r").split("\t")
+
+
+def deconvolution_columns(header: Sequence[str], variants_config: Optional[str]) -> List[str]:
+    """Columns lollipop needs: the base columns and the variant columns of variants_pangolin."""
+    wanted = set(BASE_COLUMNS)
+    if variants_config is not None:
+        with open(variants_config, "r") as f:
+            wanted |= set((yaml.safe_load(f) or {}).get("variants_pangolin", {}))
+    return [c for c in header if c in wanted]
+
+
+def config_predicates(variants_config: str) -> Dict[str, object]:
+    """date_from, date_to and locations as lollipop applies them from the variant config."""
+    with open(variants_config, "r") as f:
+        config = yaml.safe_load(f) or {}
+    return {
+        "date_from": config.get("start_date"),
+        "date_to": config.get("end_date"),
+        "locations": config.get("locations_list"),
+    }
+
+
+def row_mask(batch, date_from: Optional[str], date_to: Optional[str], locations: Optional[Sequence[str]]):
+    """Boolean mask of the rows of a record batch passing the date and location predicates."""
+    mask = None
+    if date_from is not None or date_to is not None:
+        day = pc.utf8_slice_codeunits(batch.column("date"), 0, 10)
+        if date_from is not None:
+            mask = pc.greater_equal(day, str(date_from))
+        if date_to is not None:
+            upper = pc.less_equal(day, str(date_to))
+            mask = upper if mask is None else pc.and_(mask, upper)
+    if locations is not None:
+        keep = pc.is_in(batch.column("location"), value_set=pa.array([str(l) for l in locations]))
+        mask = keep if mask is None else pc.and_(mask, keep)
+    return mask
+
+
+def _stream_batches(path: str, header: List[str], read_columns: List[str], block_size: int) -> Iterator:
+    reader = pacsv.open_csv(
+        _open(path),
+        read_options=pacsv.ReadOptions(block_size=block_size, use_threads=True),
+        parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=read_columns,
+            column_types={c: pa.string() for c in header},
+            strings_can_be_null=False,
+        ),
+    )
+    yield from reader
+
+
+def _select(batch, columns: List[str], date_from, date_to, locations):
+    mask = row_mask(batch, date_from, date_to, locations)
+    if mask is not None:
+        batch = batch.filter(mask)
+    return batch.select(columns)
+
+
+def iter_batches(
+    path: str,
+    columns: Optional[Sequence[str]] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    locations: Optional[Sequence[str]] = None,
+    block_size: int = BLOCK_SIZE,
+) -> Iterator:
+    """
+    Arrow record batches of a tally file (or of a partitioned copy), projected and filtered.
+
+    Dates are compared on their first 10 characters (YYYY-MM-DD); both bounds are inclusive.
+    Batches of a partitioned copy are in the original row order only if read with `read_table`.
+    """
+    _require_pyarrow("iter_batches")
+    header = read_header(path)
+    columns = list(columns) if columns is not None else header
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise KeyError(f"{path} has no column(s) {', '.join(missing)}")
+
+    if os.path.isdir(path):
+        scanner = _dataset(path).scanner(
+            columns=columns, filter=_expression(date_from, date_to, locations), batch_size=1 << 17
+        )
+        yield from scanner.to_batches()
+        return
+
+    read_columns = [c for c in header if c in columns or (c == "date" and (date_from or date_to))
+                    or (c == "location" and locations is not None)]
+    for batch in _stream_batches(path, header, read_columns, block_size):
+        yield _select(batch, columns, date_from, date_to, locations)
+
+
+def read_table(
+    path: str,
+    columns: Optional[Sequence[str]] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    locations: Optional[Sequence[str]] = None,
+):
+    """The selected subset as one Arrow table, in the row order of the source tally."""
+    _require_pyarrow("read_table")
+    if not os.path.isdir(path):
+        batches = list(iter_batches(path, columns, date_from, date_to, locations))
+        header = read_header(path)
+        schema = pa.schema([(c, pa.string()) for c in (list(columns) if columns is not None else header)])
+        return pa.Table.from_batches(batches, schema=schema)
+    columns = list(columns) if columns is not None else read_header(path)
+    table = _dataset(path).to_table(
+        columns=columns + [ROW_COLUMN], filter=_expression(date_from, date_to, locations)
+    )
+    return table.sort_by(ROW_COLUMN).drop_columns([ROW_COLUMN])
+
+
+def iter_chunks(
+    path: str,
+    columns: Optional[Sequence[str]] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    locations: Optional[Sequence[str]] = None,
+    chunksize: int = 500_000,
+) -> Iterator[pd.DataFrame]:
+    """Same selection as `iter_batches`, as pandas DataFrames of text columns."""
+    if pa is not None:
+        for batch in iter_batches(path, columns, date_from, date_to, locations):
+            yield batch.to_pandas()
+        return
+
+    header = read_header(path)
+    columns = list(columns) if columns is not None else header
+    needed = set(columns) | ({"date"} if date_from or date_to else set()) | ({"location"} if locations is not None else set())
+    for chunk in pd.read_csv(
+        path, sep="\t", dtype=str, keep_default_na=False, usecols=lambda c: c in needed, chunksize=chunksize
+    ):
+        keep = pd.Series(True, index=chunk.index)
+        if date_from is not None:
+            keep &= chunk["date"].str[:10] >= str(date_from)
+        if date_to is not None:
+            keep &= chunk["date"].str[:10] <= str(date_to)
+        if locations is not None:
+            keep &= chunk["location"].isin([str(l) for l in locations])
+        yield chunk.loc[keep, columns]
+
+
+# partitioned Parquet copy
+
+
+def _dataset(cache_dir: str):
+    partitioning = ds.partitioning(pa.schema([(c, pa.string()) for c in PARTITION_COLUMNS]), flavor="hive")
+    return ds.dataset(cache_dir, format="parquet", partitioning=partitioning)
+
+
+def _expression(date_from, date_to, locations):
+    """Dataset filter; the month and location terms only touch the partition keys, so they prune directories."""
+    terms = []
+    if date_from is not None:
+        terms += [ds.field("month") >= str(date_from)[:7], pc.utf8_slice_codeunits(ds.field("date"), 0, 10) >= str(date_from)]
+    if date_to is not None:
+        terms += [ds.field("month") <= str(date_to)[:7], pc.utf8_slice_codeunits(ds.field("date"), 0, 10) <= str(date_to)]
+    if locations is not None:
+        terms.append(ds.field("location").isin([str(l) for l in locations]))
+    expression = None
+    for term in terms:
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def _source_stamp(path: str) -> Dict[str, object]:
+    stat = os.stat(path)
+    return {"version": CACHE_VERSION, "source": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _read_stamp(cache_dir: str) -> Dict:
+    with open(os.path.join(cache_dir, STAMP_FILE), "r") as f:
+        return json.load(f)
+
+
+def cache_is_current(path: str, cache_dir: str) -> bool:
+    """Whether the partitioned copy in cache_dir was written from the current version of the tally."""
+    if not os.path.exists(os.path.join(cache_dir, STAMP_FILE)):
+        return False
+    stamp = _read_stamp(cache_dir)
+    return {k: stamp.get(k) for k in ("version", "source", "size", "mtime_ns")} == _source_stamp(path)
+
+
+def _with_partition_keys(batches: Iterator, first_row: int = 0) -> Iterator:
+    for batch in batches:
+        month = pc.utf8_slice_codeunits(batch.column("date"), 0, 7)
+        rows = pa.array(range(first_row, first_row + batch.num_rows), type=pa.int64())
+        first_row += batch.num_rows
+        yield pa.RecordBatch.from_arrays(
+            list(batch.columns) + [month, rows], names=batch.schema.names + ["month", ROW_COLUMN]
+        )
+
+
+def write_partitioned(path: str, cache_dir: str, on_batch=None, block_size: int = BLOCK_SIZE):
+    """
+    Write a copy of the full tally partitioned by location and month, in one pass over the source.
+
+    on_batch, if given, is called with every source batch as it is read (see `extract`).
+    The copy is written next to cache_dir and swapped in once complete.
+    """
+    _require_pyarrow("write_partitioned")
+    header = read_header(path)
+    stamp = dict(_source_stamp(path), header=header)
+    schema = pa.schema([(c, pa.string()) for c in header] + [("month", pa.string()), (ROW_COLUMN, pa.int64())])
+
+    def batches():
+        for batch in _stream_batches(path, header, header, block_size):
+            if on_batch is not None:
+                on_batch(batch)
+            yield batch
+
+    tmp_dir = cache_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    ds.write_dataset(
+        _with_partition_keys(batches()),
+        tmp_dir,
+        schema=schema,
+        format="parquet",
+        partitioning=list(PARTITION_COLUMNS),
+        partitioning_flavor="hive",
+        max_partitions=1 << 16,
+        # buffer rows per partition, otherwise every source batch adds a tiny row group to every file
+        min_rows_per_group=1 << 16,
+        max_rows_per_group=1 << 20,
+        preserve_order=True,
+    )
+    with open(os.path.join(tmp_dir, STAMP_FILE), "w") as f:
+        json.dump(stamp, f, indent=1)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def tsv_writer(output: str, columns: List[str]):
+    """(file, CSVWriter) writing text batches of `columns` as an unquoted TSV with header."""
+    sink = open(output, "wb")
+    sink.write(("\t".join(columns) + "\n").encode("utf-8"))
+    schema = pa.schema([(c, pa.string()) for c in columns])
+    options = pacsv.WriteOptions(include_header=False, delimiter="\t", quoting_style="none")
+    return sink, pacsv.CSVWriter(sink, schema, write_options=options)
+
+
+def extract(
+    path: str,
+    output: str,
+    columns: Optional[Sequence[str]] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    locations: Optional[Sequence[str]] = None,
+    cache_dir: Optional[str] = None,
+) -> int:
+    """
+    Write the selected subset of the tally as TSV (rows in their original order); returns the number of rows.
+
+    With cache_dir, the subset is read from the partitioned copy if it is current,
+    otherwise the copy is rebuilt while the subset is written (a single pass over the source).
+    """
+    _require_pyarrow("extract")
+    header = read_header(path)
+    columns = list(columns) if columns is not None else header
+    tmp_output = output + ".tmp"
+    sink, writer = tsv_writer(tmp_output, columns)
+    rows = 0
+    try:
+        if cache_dir is not None and cache_is_current(path, cache_dir):
+            print(f"Reading the partitioned copy {cache_dir}")
+            table = read_table(cache_dir, columns, date_from, date_to, locations)
+            writer.write_table(table)
+            rows = table.num_rows
+        elif cache_dir is not None:
+            print(f"Rebuilding the partitioned copy {cache_dir} from {path}")
+
+            def write_subset(batch):
+                nonlocal rows
+                selected = _select(batch, columns, date_from, date_to, locations)
+                writer.write_batch(selected)
+                rows += selected.num_rows
+
+            write_partitioned(path, cache_dir, on_batch=write_subset)
+        else:
+            for batch in iter_batches(path, columns, date_from, date_to, locations):
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    finally:
+        writer.close()
+        sink.close()
+    os.replace(tmp_output, output)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream, project and filter tallymut.tsv.zst without decompressing it to disk.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_extract = sub.add_parser("extract", help="Write the subset needed by the deconvolution as TSV")
+    p_extract.add_argument("tally", help="tallymut.tsv.zst (or .tsv)")
+    p_extract.add_argument("-o", "--output", required=True, help="Output TSV")
+    p_extract.add_argument("--variants-config", default=None, help="Lollipop variant config: columns, start/end date, locations")
+    p_extract.add_argument("--columns", nargs="+", default=None, help="Columns to keep (default: from the variant config, else all)")
+    p_extract.add_argument("--from", dest="date_from", default=None, help="First date (YYYY-MM-DD, default: start_date)")
+    p_extract.add_argument("--to", dest="date_to", default=None, help="Last date (YYYY-MM-DD, default: end_date)")
+    p_extract.add_argument("--locations", nargs="+", default=None, help="Locations to keep (default: locations_list)")
+    p_extract.add_argument("--cache", default=None, help="Partitioned Parquet copy to read from (rebuilt if outdated)")
+
+    p_partition = sub.add_parser("partition", help="Write a Parquet copy partitioned by location and month")
+    p_partition.add_argument("tally", help="tallymut.tsv.zst (or .tsv)")
+    p_partition.add_argument("cache", help="Output directory")
+
+    args = parser.parse_args()
+
+    if args.command == "partition":
+        write_partitioned(args.tally, args.cache)
+        print(f"Wrote the partitioned copy of {args.tally} to {args.cache}")
+        return
+
+    predicates = config_predicates(args.variants_config) if args.variants_config else {}
+    columns = args.columns
+    if columns is None and args.variants_config:
+        columns = deconvolution_columns(read_header(args.tally), args.variants_config)
+    date_from = args.date_from or predicates.get("date_from")
+    date_to = args.date_to or predicates.get("date_to")
+    locations = args.locations or predicates.get("locations")
+
+    rows = extract(args.tally, args.output, columns, date_from, date_to, locations, args.cache)
+    print(
+        f"Wrote {rows} rows, {len(columns) if columns else len(read_header(args.tally))} columns to {args.output} "
+        f"(dates {date_from or '-'} to {date_to or '-'}, {len(locations) if locations else 'all'} locations)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Bulk upsert of variant curves into CovSpectrum's public.wastewater_result
+
+All (location, variant, payload) rows are staged with a single COPY into a
+temporary table that has the column types of wastewater_result. They are then
+applied with one set-based UPDATE (only where the stored payload differs) and
+one INSERT (for series not yet in the table), inside the caller's transaction.
+The table is matched on (variant_name, location) like the former per-series
+`DO $$ IF EXISTS ... $$` blocks, so no unique constraint is required.
+"""
+
+import csv
+import io
+from typing import Dict, Iterable, Tuple
+
+STAGE_TABLE = "wastewater_result_stage"
+
+_CREATE_STAGE = f"""
+CREATE TEMP TABLE {STAGE_TABLE} ON COMMIT DROP AS
+SELECT ww.location, ww.variant_name, ww.data FROM public.wastewater_result AS ww WITH NO DATA
+"""
+
+_UPDATE_CHANGED = f"""
+WITH updated AS (
+    UPDATE public.wastewater_result AS ww
+    SET data = s.data
+    FROM {STAGE_TABLE} AS s
+    WHERE ww.variant_name = s.variant_name AND ww.location = s.location
+      AND ww.data::text IS DISTINCT FROM s.data::text
+    RETURNING ww.location, ww.variant_name
+)
+SELECT count(DISTINCT (location, variant_name)) FROM updated
+"""
+
+_INSERT_MISSING = f"""
+INSERT INTO public.wastewater_result (variant_name, location, data)
+SELECT s.variant_name, s.location, s.data
+FROM {STAGE_TABLE} AS s
+WHERE NOT EXISTS (
+    SELECT 1 FROM public.wastewater_result AS ww
+    WHERE ww.variant_name = s.variant_name AND ww.location = s.location
+)
+"""
+
+
+def upsert_wastewater_results(dbconn, records: Iterable[Tuple[str, str, str]]) -> Dict[str, int]:
+    """
+    Stage and apply (location, variant, json payload) records.
+
+    Returns the number of series inserted, updated and unchanged (the stored
+    payload was identical, nothing written); a (location, variant) pair listed
+    more than once counts once, with its last payload. The caller commits.
+    """
+    if dbconn.autocommit:
+        # the staging table is dropped at commit, i.e. right after its CREATE in autocommit mode
+        raise ValueError("upsert_wastewater_results must run inside a transaction (autocommit is on)")
+
+    # a series listed twice is staged once, with its last payload, like the former per-row
+    # blocks where the later row overwrote the earlier one
+    latest = {}
+    for location, variant, payload in records:
+        latest[(location, variant)] = payload
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for (location, variant), payload in latest.items():
+        writer.writerow((location, variant, payload))
+    staged = len(latest)
+    buf.seek(0)
+
+    with dbconn.cursor() as cur:
+        cur.execute(_CREATE_STAGE)
+        cur.copy_expert(f"COPY {STAGE_TABLE} (location, variant_name, data) FROM STDIN WITH (FORMAT csv)", buf)
+        cur.execute(_UPDATE_CHANGED)
+        updated = cur.fetchone()[0]
+        cur.execute(_INSERT_MISSING)
+        inserted = cur.rowcount
+
+    return {"inserted": inserted, "updated": updated, "unchanged": staged - inserted - updated}
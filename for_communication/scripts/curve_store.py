@@ -0,0 +1,305 @@
+"""
+Columnar store for lollipop-format variant curves
+
+The lollipop output (deconvoluted_upload.json) and every file derived from it
+(stitched curves, CovSpectrum/WiseDB/Polybox uploads) share the nested layout:
+
+{
+  "Location": {
+    "Variant": {
+      "timeseriesSummary": [
+        {"date": "YYYY-MM-DD", "proportion": float, "proportionLower": float, "proportionUpper": float},
+        ...
+      ]
+    },
+    ...
+  },
+  ...
+}
+
+CurveStore keeps the same information as flat arrays instead of one dict per
+data point:
+- location and variant names are interned once (code -> name tables)
+- every (location, variant) pair is a "series"; its rows are a contiguous
+  slice of the row arrays (CSR layout, `offsets[i]:offsets[i + 1]`)
+- dates are int32 day offsets since 1970-01-01
+- proportion, proportionLower and proportionUpper are float32 by default
+
+Locations without variants and variants with an empty timeseriesSummary are
+kept, and the row order inside each series is preserved, so `to_dict` returns
+the same nested structure that was loaded. Missing values (null / NaN) are
+written back as null. The default float32 storage keeps ~7 significant
+digits; pass `value_dtype=np.float64` when the values must round-trip
+bit-exactly (e.g. when stitching).
+
+USAGE:
+    from curve_store import CurveStore
+    store = CurveStore.load("deconvoluted_upload.json")
+    df = store.to_frame()
+    store.save_json("copy.json")
+"""
+
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lollipop_json import LollipopJSONWriter, iter_series
+
+VALUE_FIELDS = ("proportion", "proportionLower", "proportionUpper")
+
+
+def dates_to_days(dates: Iterable[str]) -> np.ndarray:
+    """Convert ISO 'YYYY-MM-DD' strings to int32 day offsets since 1970-01-01."""
+    return np.asarray(list(dates), dtype="datetime64[D]").astype(np.int32)
+
+
+def days_to_dates(days: np.ndarray) -> List[str]:
+    """Convert int32 day offsets back to ISO 'YYYY-MM-DD' strings."""
+    return np.asarray(days, dtype=np.int64).astype("datetime64[D]").astype(str).tolist()
+
+
+def _none_if_nan(value: float) -> Optional[float]:
+    return None if value != value else value
+
+
+class CurveStore:
+    """Array-backed representation of a lollipop-format curves file."""
+
+    def __init__(
+        self,
+        locations: List[str],
+        variants: List[str],
+        series_location: np.ndarray,
+        series_variant: np.ndarray,
+        offsets: np.ndarray,
+        day: np.ndarray,
+        proportion: np.ndarray,
+        lower: np.ndarray,
+        upper: np.ndarray,
+    ):
+        self.locations = locations
+        self.variants = variants
+        self.series_location = series_location
+        self.series_variant = series_variant
+        self.offsets = offsets
+        self.day = day
+        self.proportion = proportion
+        self.lower = lower
+        self.upper = upper
+        self.location_code = {name: i for i, name in enumerate(locations)}
+        self.variant_code = {name: i for i, name in enumerate(variants)}
+        self._series_index = {
+            (int(l), int(v)): i for i, (l, v) in enumerate(zip(series_location, series_variant))
+        }
+
+    # --------- construction ---------
+
+    @classmethod
+    def from_series(
+        cls,
+        series: Iterable[Tuple[str, Optional[str], List[Dict[str, Any]]]],
+        value_dtype=np.float32,
+    ) -> "CurveStore":
+        """
+        Build a store from (location, variant, rows) tuples.
+
+        A variant of None registers the location without adding a series
+        (used for locations whose variant dict is empty). Rows that are not
+        dicts or have no date are skipped, as in the stitching script.
+        """
+        locations: List[str] = []
+        variants: List[str] = []
+        location_code: Dict[str, int] = {}
+        variant_code: Dict[str, int] = {}
+        series_location: List[int] = []
+        series_variant: List[int] = []
+        lengths: List[int] = []
+        dates: List[str] = []
+        values: List[List[Any]] = [[], [], []]
+
+        for location, variant, rows in series:
+            if location not in location_code:
+                location_code[location] = len(locations)
+                locations.append(location)
+            if variant is None:
+                continue
+            if variant not in variant_code:
+                variant_code[variant] = len(variants)
+                variants.append(variant)
+
+            rows = [r for r in rows or [] if isinstance(r, dict) and r.get("date")]
+            series_location.append(location_code[location])
+            series_variant.append(variant_code[variant])
+            lengths.append(len(rows))
+            dates.extend([r["date"] for r in rows])
+            for field, column in zip(VALUE_FIELDS, values):
+                column.extend([r.get(field) for r in rows])
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # None (JSON null) becomes NaN in a float array
+        proportion, lower, upper = (np.array(c, dtype=np.float64).astype(value_dtype) for c in values)
+
+        return cls(
+            locations=locations,
+            variants=variants,
+            series_location=np.asarray(series_location, dtype=np.int32),
+            series_variant=np.asarray(series_variant, dtype=np.int32),
+            offsets=offsets,
+            day=dates_to_days(dates),
+            proportion=proportion,
+            lower=lower,
+            upper=upper,
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], value_dtype=np.float32) -> "CurveStore":
+        """Build a store from an already parsed nested dict."""
+        def walk():
+            for location, location_data in data.items():
+                if not location_data:
+                    yield location, None, None
+                    continue
+                for variant, vdata in location_data.items():
+                    yield location, variant, (vdata or {}).get("timeseriesSummary", [])
+
+        return cls.from_series(walk(), value_dtype=value_dtype)
+
+    @classmethod
+    def load(cls, filepath: str, value_dtype=np.float32) -> "CurveStore":
+        """Stream a curves file into a store without building the nested dict."""
+        logging.info(f"Loading curves into columnar store from: {filepath}")
+        return cls.from_series(iter_series(filepath), value_dtype=value_dtype)
+
+    @classmethod
+    def load_npz(cls, filepath: str) -> "CurveStore":
+        """Load a store previously written with `save_npz`."""
+        with np.load(filepath, allow_pickle=False) as npz:
+            return cls(
+                locations=npz["locations"].tolist(),
+                variants=npz["variants"].tolist(),
+                series_location=npz["series_location"],
+                series_variant=npz["series_variant"],
+                offsets=npz["offsets"],
+                day=npz["day"],
+                proportion=npz["proportion"],
+                lower=npz["lower"],
+                upper=npz["upper"],
+            )
+
+    # --------- accessors ---------
+
+    @property
+    def n_series(self) -> int:
+        return len(self.series_location)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.day)
+
+    def series_slice(self, location: str, variant: str) -> Optional[slice]:
+        """Row slice of the (location, variant) series, or None if absent."""
+        i = self._series_index.get(
+            (self.location_code.get(location, -1), self.variant_code.get(variant, -1))
+        )
+        if i is None:
+            return None
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def iter_series(self) -> Iterator[Tuple[str, str, slice]]:
+        """Yield (location, variant, row slice) in storage order."""
+        for i in range(self.n_series):
+            yield (
+                self.locations[self.series_location[i]],
+                self.variants[self.series_variant[i]],
+                slice(int(self.offsets[i]), int(self.offsets[i + 1])),
+            )
+
+    def row_series(self) -> np.ndarray:
+        """Series index of every row (expanded from the CSR offsets)."""
+        return np.repeat(np.arange(self.n_series, dtype=np.int32), np.diff(self.offsets))
+
+    def _columns(self, sl: slice = slice(None)) -> List[List[Any]]:
+        """Python lists (dates, proportion, lower, upper) for a row slice."""
+        day = self.day[sl]
+        unique_days, inverse = np.unique(day, return_inverse=True)
+        unique_dates = days_to_dates(unique_days)
+        columns = [[unique_dates[i] for i in inverse.tolist()]]
+        for arr in (self.proportion, self.lower, self.upper):
+            values = arr[sl].astype(np.float64)
+            column = values.tolist()
+            if np.isnan(values).any():
+                column = [_none_if_nan(v) for v in column]
+            columns.append(column)
+        return columns
+
+    @staticmethod
+    def _rows_from_columns(columns: List[List[Any]], start: int, stop: int) -> List[Dict[str, Any]]:
+        dates, proportion, lower, upper = (c[start:stop] for c in columns)
+        return [
+            {"date": d, "proportion": p, "proportionLower": lo, "proportionUpper": up}
+            for d, p, lo, up in zip(dates, proportion, lower, upper)
+        ]
+
+    def rows(self, sl: slice) -> List[Dict[str, Any]]:
+        """Rebuild the timeseriesSummary rows of one series slice."""
+        return self._rows_from_columns(self._columns(sl), 0, sl.stop - sl.start)
+
+    # --------- export ---------
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert back to the nested lollipop JSON structure."""
+        out: Dict[str, Any] = {location: {} for location in self.locations}
+        columns = self._columns()
+        for location, variant, sl in self.iter_series():
+            out[location][variant] = {"timeseriesSummary": self._rows_from_columns(columns, sl.start, sl.stop)}
+        return out
+
+    def to_frame(self) -> pd.DataFrame:
+        """Long-format DataFrame with categorical location/variant columns."""
+        row_series = self.row_series()
+        return pd.DataFrame(
+            {
+                "location": pd.Categorical.from_codes(
+                    self.series_location[row_series], categories=self.locations
+                ),
+                "variant": pd.Categorical.from_codes(
+                    self.series_variant[row_series], categories=self.variants
+                ),
+                "date": self.day.astype("datetime64[D]").astype("datetime64[s]"),
+                "proportion": self.proportion,
+                "lower": self.lower,
+                "upper": self.upper,
+            }
+        )
+
+    def save_json(self, output_path: str, **kwargs):
+        """Write the store series by series (keyword arguments go to LollipopJSONWriter)."""
+        by_location: Dict[str, List[Tuple[str, slice]]] = {location: [] for location in self.locations}
+        for location, variant, sl in self.iter_series():
+            by_location[location].append((variant, sl))
+        with LollipopJSONWriter(output_path, **kwargs) as writer:
+            for location, series in by_location.items():
+                writer.add_location(location)
+                for variant, sl in series:
+                    writer.write_series(location, variant, self.rows(sl))
+        logging.info(f"Saved curves JSON to: {output_path}")
+
+    def save_npz(self, output_path: str):
+        """Binary snapshot for handing the store between processing stages."""
+        np.savez(
+            output_path,
+            locations=np.asarray(self.locations, dtype=str),
+            variants=np.asarray(self.variants, dtype=str),
+            series_location=self.series_location,
+            series_variant=self.series_variant,
+            offsets=self.offsets,
+            day=self.day,
+            proportion=self.proportion,
+            lower=self.lower,
+            upper=self.upper,
+        )
+        logging.info(f"Saved columnar curves to: {output_path}")
@@ -0,0 +1,113 @@
+"""
+Typed loader for lollipop deconvolution tables
+
+Reads the `lollipop deconvolute` output (deconvoluted.tsv.zst of the V-pipe
+flow, deconvolved.csv of the covvfit flow) with an explicit schema instead of
+`pd.read_csv(path, sep="\\t")` followed by `pd.to_datetime`:
+
+- location and variant as categoricals
+- date parsed while reading
+- proportion (and proportionLower/proportionUpper when present) as float32
+- the pyarrow CSV engine when it is available, else pandas' C engine
+- the delimiter (tab or comma) is detected from the header line
+
+The parsed table is kept in a Parquet sidecar keyed by the size and mtime of
+the source file, so further reads of the same file (map, aggregates, reports
+on the same processing day) only load the Parquet file. The sidecar sits next
+to the source file, or in `cache_dir` when given (e.g. when the source
+directory is not writable).
+
+USAGE:
+    from deconvolution_io import load_deconvolution
+    df = load_deconvolution("deconvoluted.tsv.zst")
+
+    python deconvolution_io.py deconvoluted.tsv.zst [--cache-dir DIR]   # warm the cache
+"""
+
+import argparse
+import glob
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+SCHEMA: Dict[str, object] = {
+    "location": "category",
+    "variant": "category",
+    "proportion": np.float32,
+    "proportionLower": np.float32,
+    "proportionUpper": np.float32,
+}
+DATE_COLUMNS = ["date"]
+
+
+def _detect_sep(path: str) -> str:
+    """Tab or comma, whichever splits the header line."""
+    header = pd.read_csv(path, sep="\t", nrows=0).columns
+    return "\t" if len(header) > 1 else ","
+
+
+def read_typed(path: str, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """Parse the table with the typed schema (no cache)."""
+    sep = _detect_sep(path)
+    columns = list(pd.read_csv(path, sep=sep, nrows=0).columns)
+    if usecols is not None:
+        columns = [c for c in columns if c in usecols]
+    dtype = {c: t for c, t in SCHEMA.items() if c in columns}
+    parse_dates = [c for c in DATE_COLUMNS if c in columns]
+
+    kwargs = dict(sep=sep, usecols=columns, dtype=dtype, parse_dates=parse_dates)
+    try:
+        return pd.read_csv(path, engine="pyarrow", **kwargs)
+    except Exception as e:
+        # pyarrow missing, an option it does not support for this file, or a file it cannot
+        # parse with these options (ArrowInvalid / ArrowKeyError are not ValueErrors)
+        print(f"pyarrow could not read {path} ({type(e).__name__}: {e}), retrying with the default parser")
+        return pd.read_csv(path, **kwargs)
+
+
+def _sidecar_prefix(path: str, cache_dir: Optional[str]) -> str:
+    directory = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(path))
+    return os.path.join(directory, f".{os.path.basename(path)}.")
+
+
+def load_deconvolution(path: str, cache_dir: Optional[str] = None, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Typed deconvolution table, from the Parquet sidecar when it matches the source size and mtime.
+
+    usecols restricts the returned columns (the sidecar always holds the full table).
+    """
+    stat = os.stat(path)
+    prefix = _sidecar_prefix(path, cache_dir)
+    sidecar = f"{prefix}{stat.st_size}-{stat.st_mtime_ns}.parquet"
+
+    if os.path.exists(sidecar):
+        print(f"Reading {path} from cache: {sidecar}")
+        return pd.read_parquet(sidecar, columns=usecols)
+
+    df = read_typed(path)
+    try:
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        for stale in glob.glob(glob.escape(prefix) + "*.parquet"):
+            os.remove(stale)
+        df.to_parquet(sidecar + ".tmp", index=False)
+        os.replace(sidecar + ".tmp", sidecar)
+    except (OSError, ImportError) as e:
+        print(f"[WARN] could not write the Parquet cache of {path}: {e}")
+    return df if usecols is None else df[[c for c in df.columns if c in usecols]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse deconvolution tables into their Parquet cache.")
+    parser.add_argument("files", nargs="+", help="deconvoluted.tsv(.zst) / deconvolved.csv files")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Cache directory (default: next to each file)")
+    args = parser.parse_args()
+
+    for path in args.files:
+        df = load_deconvolution(path, args.cache_dir)
+        print(f"{path}: {len(df)} rows, {df['location'].nunique()} locations, {df['variant'].nunique()} variants")
+
+
+if __name__ == "__main__":
+    main()
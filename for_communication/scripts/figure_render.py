@@ -0,0 +1,64 @@
+"""
+Parallel multi-format figure rendering
+
+`savefig` re-renders the whole figure for every output format on one core.
+`save_formats` pickles the finished figure once and renders each requested
+format in its own worker process, so PNG, SVG and PDF are drawn concurrently.
+
+Worker processes are forked: the plotting scripts run at module level, and a
+spawned worker would re-execute them on import. Where fork is not available,
+with a single format, or if the figure cannot be pickled, the formats are
+rendered one after the other in-process as before.
+
+USAGE:
+    from figure_render import FORMATS, save_formats
+    save_formats(fig, os.path.join(plots_dir, "combined-vpipe"), ["png", "pdf"])
+"""
+
+import multiprocessing
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+
+import matplotlib.pyplot as plt
+
+FORMATS = ("pdf", "svg", "png")
+
+
+def _render(figure_bytes: bytes, path: str, savefig_kwargs: dict) -> str:
+    fig = pickle.loads(figure_bytes)
+    fig.savefig(path, **savefig_kwargs)
+    plt.close(fig)
+    return path
+
+
+def save_formats(
+    fig,
+    base_path: str,
+    formats: Sequence[str] = FORMATS,
+    workers: Optional[int] = None,
+    **savefig_kwargs,
+) -> List[str]:
+    """
+    Save `fig` as `<base_path>.<format>` for every format.
+
+    workers defaults to one process per format; returns the written paths.
+    """
+    paths = [f"{base_path}.{fmt}" for fmt in formats]
+    workers = len(paths) if workers is None else min(workers, len(paths))
+
+    figure_bytes = None
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        try:
+            figure_bytes = pickle.dumps(fig)
+        except Exception as e:
+            print(f"[WARN] figure cannot be pickled ({e}), rendering formats sequentially")
+
+    if figure_bytes is None:
+        for path in paths:
+            fig.savefig(path, **savefig_kwargs)
+        return paths
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        futures = [pool.submit(_render, figure_bytes, path, savefig_kwargs) for path in paths]
+        return [future.result() for future in futures]
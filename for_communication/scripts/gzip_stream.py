@@ -0,0 +1,126 @@
+"""
+One-pass gzip compression + SHA-256 of the compressed output and of the input
+
+The WiseDB upload needs a gzip file of the curves JSON and the SHA-256 of
+that gzip file. `gzip_file` reads the input once in large chunks, deflates
+it, and hashes the compressed bytes while they are written, so the output is
+never read back. The input chunks are hashed as they are read, so the
+SHA-256 of the uncompressed file (used by the upload manifest) costs no
+second read either.
+
+Two deflate backends produce the same standard single-member gzip file
+(readable by gzip/zcat/python's gzip module):
+- threads=1: one zlib stream, as `gzip.open(..., compresslevel=9)`
+- threads>1: pigz-style parallel deflate; the input is cut into blocks that
+  are compressed concurrently (zlib releases the GIL). Each block is primed
+  with the last 32 KiB of the previous one as dictionary and ends on a
+  SYNC_FLUSH byte boundary, so the blocks concatenate into one valid deflate
+  stream; the CRC-32 is accumulated over the blocks in input order.
+The header carries no file name and a zero timestamp, so identical input
+gives an identical (and identically hashed) output.
+
+USAGE:
+    from gzip_stream import gzip_file
+    checksum, size, input_checksum = gzip_file("curves.json", "curves.json.gz", level=9, threads=8)
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+READ_CHUNK = 1 << 20
+BLOCK_SIZE = 1 << 20
+DICT_SIZE = 1 << 15
+
+
+def _gzip_header(level: int) -> bytes:
+    # magic, deflate, no flags, mtime 0, XFL (2: max compression, 4: fastest), OS unknown
+    xfl = 2 if level == 9 else 4 if level == 1 else 0
+    return b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + bytes([xfl, 255])
+
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _HashingWriter:
+    """Write to a file while hashing and counting the written bytes."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.f.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+
+def _serial(f_in, out: _HashingWriter, level: int, input_sha256) -> Tuple[int, int]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc, length = 0, 0
+    for chunk in iter(lambda: f_in.read(READ_CHUNK), b""):
+        crc = zlib.crc32(chunk, crc)
+        input_sha256.update(chunk)
+        length += len(chunk)
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush(zlib.Z_FINISH))
+    return crc, length
+
+
+def _parallel(f_in, out: _HashingWriter, level: int, threads: int, block_size: int, input_sha256) -> Tuple[int, int]:
+    crc, length = 0, 0
+    pending = []
+    dictionary = b""
+    block = f_in.read(block_size)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            following = f_in.read(block_size) if block else b""
+            last = not following
+            crc = zlib.crc32(block, crc)
+            input_sha256.update(block)
+            length += len(block)
+            pending.append(pool.submit(_deflate_block, block, dictionary, level, last))
+            # keep a bounded number of blocks in flight, written in input order
+            while len(pending) > 2 * threads or (last and pending):
+                out.write(pending.pop(0).result())
+            if last:
+                return crc, length
+            dictionary = block[-DICT_SIZE:]
+            block = following
+
+
+def gzip_file(
+    input_path: str,
+    output_path: str,
+    level: int = 9,
+    threads: int = 1,
+    block_size: int = BLOCK_SIZE,
+) -> Tuple[str, int, str]:
+    """
+    Compress input_path to output_path in one pass.
+
+    Returns the SHA-256 hex digest and the size of the written gzip file, and
+    the SHA-256 hex digest of the (uncompressed) input.
+    threads=0 uses one thread per CPU available to the process.
+    """
+    if threads == 0:
+        threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    input_sha256 = hashlib.sha256()
+    with open(input_path, "rb") as f_in, open(output_path, "wb") as f_out:
+        out = _HashingWriter(f_out)
+        out.write(_gzip_header(level))
+        if threads > 1:
+            crc, length = _parallel(f_in, out, level, threads, block_size, input_sha256)
+        else:
+            crc, length = _serial(f_in, out, level, input_sha256)
+        out.write(struct.pack("<II", crc & 0xFFFFFFFF, length & 0xFFFFFFFF))
+    return out.sha256.hexdigest(), out.size, input_sha256.hexdigest()
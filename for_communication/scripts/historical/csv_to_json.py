@@ -5,39 +5,127 @@
 ## 2025
 ## Description: takes in input the cov-spectrum table "wastewater_results" in csv format
 ##   and converts it in a json format compatible with the output from Lollipop
+##
+##   The table is not loaded into memory: a first pass indexes the byte offset of
+##   every record by location/variant, a second pass reads the records location by
+##   location and writes the JSON incrementally (lollipop_json.LollipopJSONWriter).
+##   Parsing the embedded JSON blobs can be spread over worker processes (--workers).
+##   Peak memory is the offset index plus the blobs of the batches in flight.
 ###########################
 
 import csv
 import json
 import argparse
-from collections import defaultdict
+import os
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lollipop_json import LollipopJSONWriter, dumps  # noqa: E402
 
 # bump the field-size limit
 csv.field_size_limit(sys.maxsize)
 
-def build_nested_dict(rows, idx2, idx1, idx3):
-    # { col2_value: { col1_value: parsed_col3_obj } }
-    nested = defaultdict(dict)
-    for row in rows:
-        k2 = row[idx2]
-        k1 = row[idx1]
-        # parse the JSON in col3
+
+def iter_records(f):
+    """
+    Yield (offset, length, raw bytes) for every CSV record of a binary file.
+
+    A record ends at the first line break outside of a quoted field, i.e. once
+    the number of quote characters seen is even (escaped quotes come in pairs).
+    """
+    offset = 0
+    start = 0
+    quotes = 0
+    for line in f:
+        if quotes == 0:
+            start = offset
+            parts = []
+        parts.append(line)
+        offset += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            quotes = 0
+            yield start, offset - start, b"".join(parts)
+    if quotes:
+        raise ValueError(f"Unterminated quoted field in the record at byte {start}")
+
+
+def parse_record(raw):
+    """Fields of one raw CSV record (empty list for a blank line)."""
+    return next(csv.reader([raw.decode("utf-8")]), [])
+
+
+def build_index(path, idx2, idx1):
+    """
+    { col2_value: { col1_value: (offset, length) } } with dict insertion order,
+    so a repeated pair keeps its first position and its last record.
+    """
+    index = {}
+    n_records = 0
+    with open(path, "rb") as f:
+        for offset, length, raw in iter_records(f):
+            row = parse_record(raw)
+            if not row:
+                continue
+            index.setdefault(row[idx2], {})[row[idx1]] = (offset, length)
+            n_records += 1
+    return index, n_records
+
+
+def convert_batch(batch):
+    """Parse the JSON blobs of a batch of (k2, k1, blob) and re-serialize them compactly."""
+    out = []
+    for k2, k1, blob in batch:
         try:
-            v3 = json.loads(row[idx3])
+            v3 = json.loads(blob)
         except json.JSONDecodeError as e:
             raise ValueError(f"Invalid JSON in row for {k2}/{k1}: {e}")
-        nested[k2][k1] = v3
-    return nested
+        out.append((k2, k1, dumps(v3, separators=(',', ':'), ensure_ascii=False)))
+    return out
 
-def read_csv_no_header(path):
-    with open(path, newline='', encoding='utf-8') as f:
-        return list(csv.reader(f))
 
-def write_json(data, path):
-    compact = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(compact)
+def iter_batches(path, index, idx3, batch_size):
+    """Read the indexed records location by location, in batches of (k2, k1, blob)."""
+    batch = []
+    with open(path, "rb") as f:
+        for k2, variants in index.items():
+            for k1, (offset, length) in variants.items():
+                f.seek(offset)
+                batch.append((k2, k1, parse_record(f.read(length))[idx3]))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def iter_converted(batches, workers):
+    """convert_batch over the batches, in order; at most 2 batches per worker in flight."""
+    if workers <= 1:
+        yield from map(convert_batch, batches)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(convert_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def convert(input_csv, output_json, idx2, idx1, idx3, workers=1, batch_size=256):
+    index, n_records = build_index(input_csv, idx2, idx1)
+    n_series = sum(len(variants) for variants in index.values())
+    print(f"Indexed {n_records} records: {len(index)} locations, {n_series} series")
+
+    with LollipopJSONWriter(output_json, ensure_ascii=False) as writer:
+        for converted in iter_converted(iter_batches(input_csv, index, idx3, batch_size), workers):
+            for k2, k1, vdata_json in converted:
+                writer.write_variant_json(k2, k1, vdata_json)
+
 
 def parse_args():
     p = argparse.ArgumentParser()
@@ -46,20 +134,25 @@ def parse_args():
     p.add_argument('--col1_idx', type=int, default=0)
     p.add_argument('--col2_idx', type=int, default=1)
     p.add_argument('--col3_idx', type=int, default=2)
+    p.add_argument('--workers', type=int, default=1,
+                   help='processes parsing the JSON blobs (default: 1, in-process)')
+    p.add_argument('--batch_size', type=int, default=256,
+                   help='records per worker task (default: 256)')
     return p.parse_args()
 
+
 def main():
     args = parse_args()
-    rows = read_csv_no_header(args.input_csv)
-    nested = build_nested_dict(
-        rows,
+    convert(
+        args.input_csv,
+        args.output_json,
         idx2=args.col2_idx,
         idx1=args.col1_idx,
-        idx3=args.col3_idx
+        idx3=args.col3_idx,
+        workers=args.workers,
+        batch_size=args.batch_size,
     )
-    write_json(nested, args.output_json)
     print(f"Written compact JSON to {args.output_json}")
 
 if __name__=='__main__':
     main()
-
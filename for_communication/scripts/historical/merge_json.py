@@ -6,79 +6,210 @@
 ## Description: takes in input two lollipop-compatible json files and merge them.
 ##   The script checks for duplicates and throws an error if multiple time series for
 ##   the same virus in the same location are present
+##   With --by-date, any number of files are merged and overlapping time series
+##   are combined date by date, the value of a date shared by several files being
+##   taken according to --precedence (see merge_by_date)
 ###########################
 
-import json
 import argparse
+import heapq
+import os
 import sys
+from collections import Counter
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lollipop_json import LollipopJSONWriter, iter_keys, iter_variants  # noqa: E402
 
-def load_json(path):
+
+def merge_streaming(first_path, second_path, output_path):
     """
-    Load JSON data from the given file path.
+    Union of the two files (inputs have no duplicate location/variant pairs),
+    written series by series: the variants of a location present in both files
+    follow the ones of the first file, locations only in the second file come
+    last. Only the series of such shared locations are held in memory.
     """
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"Error reading JSON from {path}: {e}", file=sys.stderr)
-        sys.exit(1)
-
-
-def write_json(data, path):
+    first_locations = {loc for loc, _ in iter_keys(first_path)}
+    shared = {}
+    for loc, var, vdata in iter_variants(second_path):
+        if loc in first_locations:
+            shared.setdefault(loc, [])
+            if var is not None:
+                shared[loc].append((var, vdata))
+
+    with LollipopJSONWriter(output_path, ensure_ascii=False) as writer:
+        current = None
+        for loc, var, vdata in iter_variants(first_path):
+            if loc != current and current in shared:
+                for var2, vdata2 in shared.pop(current):
+                    writer.write_variant(current, var2, vdata2)
+            current = loc
+            writer.add_location(loc)
+            if var is not None:
+                writer.write_variant(loc, var, vdata)
+        if current in shared:
+            for var2, vdata2 in shared.pop(current):
+                writer.write_variant(current, var2, vdata2)
+        for loc, var, vdata in iter_variants(second_path):
+            if loc in first_locations:
+                continue
+            writer.add_location(loc)
+            if var is not None:
+                writer.write_variant(loc, var, vdata)
+
+
+PRECEDENCES = ("first", "second", "newest")
+
+
+def sorted_unique_rows(rows):
+    """Rows sorted by date; of several rows with the same date the last one is kept."""
+    if any(rows[i]["date"] > rows[i + 1]["date"] for i in range(len(rows) - 1)):
+        rows = sorted(rows, key=lambda row: row["date"])
+    return [row for i, row in enumerate(rows) if i + 1 == len(rows) or rows[i + 1]["date"] != row["date"]]
+
+
+def _keyed_rows(rows, rank):
+    for row in rows:
+        yield row["date"], rank, row
+
+
+def merge_series(sources, precedence, stats):
     """
-    Write data as compact JSON to the given file path.
+    Merge the (input index, variant data) sources of one series by date.
+
+    Every source is sorted and deduplicated by date, then all are merged in one
+    pass (heapq.merge of the sorted row lists). For a date present in several
+    sources the row of the source with the highest precedence is kept:
+      first   the earlier input file
+      second  the later input file
+      newest  the source whose series reaches the most recent date (ties: the later file)
     """
-    try:
-        compact = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(compact)
-    except Exception as e:
-        print(f"Error writing JSON to {path}: {e}", file=sys.stderr)
-        sys.exit(1)
-
-
-def recursive_merge(a, b):
+    ranked = [(index, vdata, sorted_unique_rows(vdata.get("timeseriesSummary", []))) for index, vdata in sources]
+    # highest precedence first
+    if precedence == "first":
+        ranked.sort(key=lambda item: item[0])
+    elif precedence == "second":
+        ranked.sort(key=lambda item: item[0], reverse=True)
+    else:
+        ranked.sort(key=lambda item: (item[2][-1]["date"] if item[2] else "", item[0]), reverse=True)
+
+    merged = []
+    overlapping = conflicting = 0
+    streams = [_keyed_rows(rows, r) for r, (_, _, rows) in enumerate(ranked)]
+    for date, r, row in heapq.merge(*streams, key=lambda item: item[:2]):
+        if merged and merged[-1]["date"] == date:
+            overlapping += 1
+            conflicting += row != merged[-1]
+            continue
+        merged.append(row)
+
+    stats["series"] += 1
+    if len(sources) > 1:
+        stats["overlapping series"] += 1
+        stats["overlapping dates"] += overlapping
+        stats["conflicting dates"] += conflicting
+    stats["rows"] += len(merged)
+
+    vdata = dict(ranked[0][1])
+    vdata["timeseriesSummary"] = merged
+    return vdata
+
+
+def merge_by_date(paths, output_path, precedence="newest"):
     """
-    Recursively merge b into a:
-      - dicts: merge keys; if both values are dict/list, merge; else b overrides.
-      - lists: concatenate.
-      - other: b overrides.
+    Merge any number of lollipop-format files, combining shared series by date.
+
+    Locations and variants keep their first-seen order over the input files.
+    The files are streamed; only the series of locations that also occur in an
+    earlier file, and the location currently being written, are held in memory.
+    Returns the overlap statistics.
     """
-    if isinstance(a, dict) and isinstance(b, dict):
-        result = dict(a)
-        for key, b_val in b.items():
-            if key in result:
-                result[key] = recursive_merge(result[key], b_val)
-            else:
-                result[key] = b_val
-        return result
-    if isinstance(a, list) and isinstance(b, list):
-        return a + b
-    return b
+    locations = [{loc for loc, _ in iter_keys(path)} for path in paths]
+    # series of locations already seen in an earlier file, by location -> variant -> [(file, vdata)]
+    pending = {}
+    for j in range(1, len(paths)):
+        earlier = set().union(*locations[:j])
+        for loc, var, vdata in iter_variants(paths[j]):
+            if loc in earlier:
+                variants = pending.setdefault(loc, {})
+                if var is not None:
+                    variants.setdefault(var, []).append((j, vdata))
+
+    stats = Counter()
+    written = set()
+    with LollipopJSONWriter(output_path, ensure_ascii=False) as writer:
+
+        def flush(i, loc, variants):
+            writer.add_location(loc)
+            for var, vdata in variants.items():
+                pending_sources = pending.get(loc, {}).pop(var, [])
+                writer.write_variant(loc, var, merge_series([(i, vdata)] + pending_sources, precedence, stats))
+            for var, sources in pending.pop(loc, {}).items():
+                writer.write_variant(loc, var, merge_series(sources, precedence, stats))
+            written.add(loc)
+
+        for i, path in enumerate(paths):
+            current, variants = None, {}
+            for loc, var, vdata in iter_variants(path):
+                if loc in written:
+                    continue
+                if loc != current:
+                    if current is not None:
+                        flush(i, current, variants)
+                    current, variants = loc, {}
+                if var is not None:
+                    variants[var] = vdata
+            if current is not None:
+                flush(i, current, variants)
+    return stats
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
-        description="Merge two nested-JSON files into one with duplication checks.")
-    parser.add_argument('first_json', help='Path to the first input JSON file')
-    parser.add_argument('second_json', help='Path to the second input JSON file')
+        description="Merge nested-JSON files into one, with duplication checks or merged by date.")
+    parser.add_argument('input_json', nargs='+',
+                        help='Paths to the input JSON files (exactly two unless --by-date)')
     parser.add_argument('output_json', help='Path where the merged JSON will be written')
-    return parser.parse_args()
+    parser.add_argument('--by-date', action='store_true',
+                        help='Merge time series present in several files date by date instead of failing on duplicates')
+    parser.add_argument('--precedence', choices=PRECEDENCES, default='newest',
+                        help='With --by-date, which file wins on a shared date: the first (earlier) file, '
+                             'the second (later) file, or the one whose series is newest (default: newest)')
+    args = parser.parse_intermixed_args()
+    if len(args.input_json) < 2:
+        parser.error("at least two input files are required")
+    if not args.by_date and len(args.input_json) != 2:
+        parser.error("more than two input files require --by-date")
+    return args
 
 
 def main():
     args = parse_args()
-    json1 = load_json(args.first_json)
-    json2 = load_json(args.second_json)
 
-    # Check for duplicates at the first two nesting levels
-    duplicates = []
-    for top_key, subdict in json2.items():
-        if isinstance(subdict, dict) and top_key in json1 and isinstance(json1[top_key], dict):
-            for sub_key in subdict:
-                if sub_key in json1[top_key]:
-                    duplicates.append(f"{top_key}/{sub_key}")
+    if args.by_date:
+        try:
+            stats = merge_by_date(args.input_json, args.output_json, args.precedence)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error merging into {args.output_json}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(
+            f"Merged {stats['series']} series ({stats['rows']} rows) from {len(args.input_json)} files; "
+            f"{stats['overlapping series']} series in several files, {stats['overlapping dates']} overlapping dates "
+            f"resolved by '{args.precedence}' precedence, {stats['conflicting dates']} of them with differing values"
+        )
+        print(f"Merged JSON written to '{args.output_json}'")
+        return
+
+    args.first_json, args.second_json = args.input_json
+
+    # Check for duplicates at the first two nesting levels (keys only, streamed)
+    try:
+        keys1 = {(loc, var) for loc, var in iter_keys(args.first_json) if var is not None}
+        duplicates = [
+            f"{loc}/{var}" for loc, var in iter_keys(args.second_json) if (loc, var) in keys1
+        ]
+    except (OSError, ValueError) as e:
+        print(f"Error reading JSON: {e}", file=sys.stderr)
+        sys.exit(1)
 
     if duplicates:
         print(
@@ -88,8 +219,11 @@ def main():
         )
         sys.exit(1)
 
-    merged = recursive_merge(json1, json2)
-    write_json(merged, args.output_json)
+    try:
+        merge_streaming(args.first_json, args.second_json, args.output_json)
+    except (OSError, ValueError) as e:
+        print(f"Error writing JSON to {args.output_json}: {e}", file=sys.stderr)
+        sys.exit(1)
     print(f"Merged JSON written to '{args.output_json}'")
 
 
@@ -0,0 +1,354 @@
+"""
+In-process HTTP uploads for Polybox (WebDAV) and WiseDB
+
+Replaces one `curl` subprocess per file:
+- one `requests.Session` with a connection pool, so the TLS connection to a
+  host is reused across files
+- files are streamed from disk (PUT body / multipart body), never read into memory
+- transient failures (connection errors, timeouts, 429 and 5xx responses) are
+  retried with exponential backoff; the WiseDB POST is not idempotent, so it is
+  only retried when the connection could not be established (nothing was sent)
+- credentials come from ~/.netrc like `curl --netrc`; a user name in the URL
+  (https://user@host/...) selects the matching netrc entry and is stripped
+  from the request URL; a malformed ~/.netrc is reported and ignored, as curl does
+- several files can be uploaded concurrently with a thread pool
+- `list_remote` lists a WebDAV folder (size, ETag, Nextcloud checksum per file)
+  with a single PROPFIND request
+
+USAGE:
+    from http_upload import list_remote, make_session, put_file, upload_files
+    session = make_session()
+    put_file(session, "curves.json", "https://user@polybox.ethz.ch/remote.php/dav/files/user/Shared/X/")
+    results = upload_files(session, [(path, url), ...], workers=4)
+    remote = list_remote(session, "https://user@polybox.ethz.ch/remote.php/dav/files/user/Shared/X/")
+"""
+
+import netrc
+import os
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 2.0
+DEFAULT_TIMEOUT = (30, 600)
+STREAM_CHUNK = 1 << 20
+
+
+def make_session(pool_size: int = 8) -> requests.Session:
+    """Session whose connection pool can serve `pool_size` concurrent uploads per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def netrc_auth(url: str) -> Tuple[str, Optional[Tuple[str, str]]]:
+    """
+    Split credentials from an upload URL.
+
+    Returns the URL without user info and the (login, password) of the
+    matching ~/.netrc entry (None if there is none), like `curl --netrc`.
+    """
+    parts = urlsplit(url)
+    clean = urlunsplit(parts._replace(netloc=parts.hostname + (f":{parts.port}" if parts.port else "")))
+    try:
+        entry = netrc.netrc().authenticators(parts.hostname)
+    except FileNotFoundError:
+        entry = None
+    except netrc.NetrcParseError as e:
+        print(f"[WARN] Ignoring malformed .netrc ({e}), sending {parts.hostname} requests without credentials")
+        entry = None
+    if entry is None:
+        return clean, None
+    login, _, password = entry
+    if parts.username and login and parts.username != login:
+        print(f"[WARN] .netrc login for {parts.hostname} is {login!r}, URL asks for {parts.username!r}")
+    return clean, (parts.username or login, password)
+
+
+def target_url(url: str, path: str) -> str:
+    """Like curl --upload-file: a URL ending in '/' receives the local file name."""
+    return url + quote(os.path.basename(path)) if url.endswith("/") else url
+
+
+def _not_sent(error: requests.RequestException) -> bool:
+    """Whether the request failed while connecting, i.e. before anything reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _send(
+    session: requests.Session,
+    method: str,
+    url: str,
+    open_body,
+    retries: int,
+    backoff: float,
+    idempotent: bool = True,
+    **kwargs,
+) -> requests.Response:
+    """
+    Send a request with a freshly opened body per attempt, retrying transient failures.
+
+    A request that is not idempotent is only retried when it could not be sent at
+    all: after a timeout or a 5xx the server may already have processed it.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with open_body() as body:
+                response = session.request(method, url, data=body, timeout=DEFAULT_TIMEOUT, **kwargs)
+            if response.status_code not in RETRY_STATUS or attempt == retries or not idempotent:
+                response.raise_for_status()
+                return response
+            reason = f"HTTP {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries or not (idempotent or _not_sent(e)):
+                raise
+            reason = type(e).__name__
+        delay = backoff * 2 ** attempt
+        print(f"[RETRY] {method} {url}: {reason}, retrying in {delay:.0f}s ({attempt + 1}/{retries})")
+        time.sleep(delay)
+
+
+def put_file(
+    session: requests.Session,
+    path: str,
+    url: str,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    headers: Optional[Dict[str, str]] = None,
+) -> requests.Response:
+    """Stream one file to a WebDAV/HTTP URL with PUT (the `curl --netrc --upload-file` equivalent)."""
+    clean, auth = netrc_auth(url)
+    return _send(
+        session, "PUT", target_url(clean, path), lambda: open(path, "rb"), retries, backoff, auth=auth, headers=headers
+    )
+
+
+def upload_files(
+    session: requests.Session,
+    uploads: Iterable[Tuple[str, str]],
+    workers: int = 4,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    headers: Optional[Dict[Tuple[str, str], Dict[str, str]]] = None,
+    responses: Optional[Dict[Tuple[str, str], requests.Response]] = None,
+) -> Dict[Tuple[str, str], Optional[Exception]]:
+    """
+    PUT several (path, url) pairs concurrently.
+
+    headers optionally maps a (path, url) pair to extra request headers;
+    if a dict is passed as responses, the response of every successful upload is stored in it.
+    Returns {(path, url): None on success or the exception that made it fail}.
+    """
+    uploads = list(uploads)
+
+    def upload(item: Tuple[str, str]) -> Optional[Exception]:
+        path, url = item
+        try:
+            response = put_file(
+                session, path, url, retries=retries, backoff=backoff, headers=(headers or {}).get(item)
+            )
+        except (requests.RequestException, OSError) as e:
+            print(f"[ERROR] {path} -> {url}: {e}")
+            return e
+        print(f"Uploaded {path} -> {url} (HTTP {response.status_code})")
+        if responses is not None:
+            responses[item] = response
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(uploads, pool.map(upload, uploads)))
+
+
+class RemoteFile(NamedTuple):
+    size: Optional[int]
+    etag: Optional[str]
+    # Nextcloud/ownCloud checksums ("SHA256:<hex>"...), set when the file was uploaded with an OC-Checksum header
+    checksums: Tuple[str, ...]
+
+
+_PROPFIND_BODY = (
+    '<?xml version="1.0"?>'
+    '<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns"><d:prop>'
+    "<d:resourcetype/><d:getcontentlength/><d:getetag/><oc:checksums/>"
+    "</d:prop></d:propfind>"
+).encode()
+_DAV = "{DAV:}"
+_OC = "{http://owncloud.org/ns}"
+
+
+def normalize_etag(etag: Optional[str]) -> Optional[str]:
+    """ETag without quotes and weak-validator prefix (PROPFIND and PUT headers quote it differently)."""
+    if etag is None:
+        return None
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    return etag.strip('"')
+
+
+def list_remote(
+    session: requests.Session,
+    url: str,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+) -> Dict[str, RemoteFile]:
+    """
+    Files of a WebDAV folder from one `PROPFIND` (Depth: 1) request.
+
+    Returns {file name: RemoteFile}; sub-folders are left out.
+    """
+    clean, auth = netrc_auth(url)
+    folder = clean if clean.endswith("/") else clean + "/"
+    response = _send(
+        session,
+        "PROPFIND",
+        folder,
+        lambda: _BytesBody(_PROPFIND_BODY),
+        retries,
+        backoff,
+        auth=auth,
+        headers={"Depth": "1", "Content-Type": "application/xml; charset=utf-8"},
+    )
+    folder_path = unquote(urlsplit(folder).path)
+
+    files = {}
+    for entry in ET.fromstring(response.content).iter(f"{_DAV}response"):
+        href = unquote(urlsplit(entry.findtext(f"{_DAV}href", "")).path)
+        if href.rstrip("/") == folder_path.rstrip("/"):
+            continue
+        props = {}
+        for propstat in entry.iter(f"{_DAV}propstat"):
+            if " 200 " not in (propstat.findtext(f"{_DAV}status") or " 200 "):
+                continue
+            prop = propstat.find(f"{_DAV}prop")
+            if prop is not None:
+                props.update((child.tag, child) for child in prop)
+        resourcetype = props.get(f"{_DAV}resourcetype")
+        if resourcetype is not None and resourcetype.find(f"{_DAV}collection") is not None:
+            continue
+        length = props.get(f"{_DAV}getcontentlength")
+        etag = props.get(f"{_DAV}getetag")
+        checksums = props.get(f"{_OC}checksums")
+        files[os.path.basename(href.rstrip("/"))] = RemoteFile(
+            size=int(length.text) if length is not None and length.text else None,
+            etag=normalize_etag(etag.text) if etag is not None else None,
+            checksums=tuple(
+                value for checksum in (checksums.iter() if checksums is not None else [])
+                for value in (checksum.text or "").split()
+            ),
+        )
+    return files
+
+
+class _BytesBody:
+    """In-memory request body usable with `_send` (reopened for every attempt)."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __enter__(self) -> bytes:
+        return self.data
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _MultipartBody:
+    """Read-only multipart/form-data stream of form fields and files with a known length."""
+
+    def __init__(self, fields: Dict[str, str], files: Dict[str, str]):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.parts: List = []
+        for name, value in fields.items():
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for name, path in files.items():
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{os.path.basename(path)}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n".encode()
+            )
+            self.parts.append(path)
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+        self.length = sum(len(p) if isinstance(p, bytes) else os.path.getsize(p) for p in self.parts)
+        self.index = 0
+        self.current = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __enter__(self) -> "_MultipartBody":
+        return self
+
+    def __exit__(self, *exc):
+        if self.current is not None and not isinstance(self.current, bytes):
+            self.current.close()
+
+    def _next_part(self) -> bool:
+        if self.current is not None and not isinstance(self.current, bytes):
+            self.current.close()
+        if self.index == len(self.parts):
+            self.current = None
+            return False
+        part = self.parts[self.index]
+        self.index += 1
+        self.current = part if isinstance(part, bytes) else open(part, "rb")
+        self.offset = 0
+        return True
+
+    def read(self, size: int = STREAM_CHUNK) -> bytes:
+        if size is None or size < 0:
+            size = STREAM_CHUNK
+        while True:
+            if self.current is None and not self._next_part():
+                return b""
+            if isinstance(self.current, bytes):
+                chunk = self.current[self.offset:self.offset + size]
+                self.offset += len(chunk)
+            else:
+                chunk = self.current.read(size)
+            if chunk:
+                return chunk
+            if not self._next_part():
+                return b""
+
+
+def post_multipart(
+    session: requests.Session,
+    url: str,
+    fields: Dict[str, str],
+    files: Dict[str, str],
+    headers: Optional[Dict[str, str]] = None,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+) -> requests.Response:
+    """
+    POST form fields and files (streamed from disk) as multipart/form-data, like `curl -F`.
+
+    Only retried when the connection could not be established, so an upload the
+    server accepted is never sent twice.
+    """
+
+    def open_body() -> _MultipartBody:
+        body = _MultipartBody(fields, files)
+        request_headers["Content-Type"] = body.content_type
+        return body
+
+    request_headers = dict(headers or {})
+    return _send(session, "POST", url, open_body, retries, backoff, idempotent=False, headers=request_headers)
@@ -0,0 +1,271 @@
+"""
+Streaming reader and writer for lollipop-format JSON files
+
+The curve files ({location: {variant: {"timeseriesSummary": [rows]}}}) keep
+growing with every week of history. Instead of `json.load` of the whole
+document and `json.dumps(...).replace("NaN", "null")` of the whole result,
+this module
+- reads a file chunk by chunk and yields one (location, variant, ...) record
+  at a time, so peak memory is bounded by a single series
+- writes a file series by series, emitting standards-compliant `null` for
+  NaN values directly
+
+Reader functions:
+    iter_variants(path) -> (location, variant, variant_data dict)
+    iter_series(path)   -> (location, variant, timeseriesSummary rows)
+    iter_rows(path)     -> (location, variant, row)
+Locations with an empty variant dict are reported by iter_variants/iter_series
+as (location, None, None) so that they survive a read/write round trip.
+
+Writer:
+    with LollipopJSONWriter(path) as writer:
+        writer.write_variant(location, variant, variant_data)
+All variants of a location have to be written consecutively. The file is
+written to `path + ".tmp"` and only moved to `path` when the `with` block
+finishes without an exception, so a failed run never leaves a truncated (but
+valid-looking) document behind.
+"""
+
+import json
+import math
+import os
+import types
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+READ_CHUNK = 1 << 20
+
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+def nan_to_none(obj: Any) -> Any:
+    """Replace NaN/Infinity floats (at any depth) by None, i.e. JSON null."""
+    if isinstance(obj, float):
+        return None if math.isnan(obj) or math.isinf(obj) else obj
+    if isinstance(obj, dict):
+        return {k: nan_to_none(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [nan_to_none(v) for v in obj]
+    return obj
+
+
+def dumps(obj: Any, **kwargs) -> str:
+    """json.dumps that writes NaN as null (replaces `json.dumps(...).replace("NaN", "null")`)."""
+    return json.dumps(nan_to_none(obj), allow_nan=False, **kwargs)
+
+
+class _Scanner:
+    """Incremental JSON tokenizer over a text file, keeping only a small window in memory."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop the consumed part of the window
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next non-whitespace character ('' at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f"Malformed JSON: expected one of {chars!r}, got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number (or literal) touching the end of the window may be truncated
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def members(self) -> Iterator[str]:
+        """Iterate over the keys of the object starting at the cursor.
+
+        After each key the cursor is positioned on its value, which the caller
+        has to consume before asking for the next key.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Malformed JSON: object key is not a string")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self) -> Iterator[Any]:
+        """Iterate over the decoded elements of the array starting at the cursor."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def _iter_variant_members(scanner: _Scanner) -> Iterator[Tuple[str, Any]]:
+    for key in scanner.members():
+        if key == "timeseriesSummary" and scanner.peek() == "[":
+            yield key, scanner.elements()
+        else:
+            yield key, scanner.value()
+
+
+def iter_variants(path: str) -> Iterator[Tuple[str, Optional[str], Optional[Dict[str, Any]]]]:
+    """Yield (location, variant, variant_data) for every series of the file."""
+    with open(path, "r", encoding="utf-8") as f:
+        scanner = _Scanner(f)
+        for location in scanner.members():
+            empty = True
+            for variant in scanner.members():
+                empty = False
+                vdata: Dict[str, Any] = {}
+                for key, value in _iter_variant_members(scanner):
+                    vdata[key] = list(value) if isinstance(value, types.GeneratorType) else value
+                yield location, variant, vdata
+            if empty:
+                yield location, None, None
+
+
+def iter_series(path: str) -> Iterator[Tuple[str, Optional[str], Optional[List[Dict[str, Any]]]]]:
+    """Yield (location, variant, timeseriesSummary rows) for every series of the file."""
+    for location, variant, vdata in iter_variants(path):
+        yield location, variant, None if vdata is None else vdata.get("timeseriesSummary", [])
+
+
+def iter_rows(path: str) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+    """Yield (location, variant, row) for every timeseriesSummary row, one row in memory at a time."""
+    with open(path, "r", encoding="utf-8") as f:
+        scanner = _Scanner(f)
+        for location in scanner.members():
+            for variant in scanner.members():
+                for key, value in _iter_variant_members(scanner):
+                    if isinstance(value, types.GeneratorType):
+                        for row in value:
+                            yield location, variant, row
+
+
+def iter_keys(path: str) -> Iterator[Tuple[str, Optional[str]]]:
+    """Yield the (location, variant) keys of the file."""
+    for location, variant, _ in iter_variants(path):
+        yield location, variant
+
+
+class LollipopJSONWriter:
+    """Incremental writer for the nested lollipop format."""
+
+    def __init__(self, path: str, separators: Tuple[str, str] = (",", ":"), ensure_ascii: bool = True):
+        self.path = path
+        self.separators = separators
+        self.ensure_ascii = ensure_ascii
+        self.f = None
+        self.location: Optional[str] = None
+        self.done_locations: Set[str] = set()
+        self.first_variant = True
+
+    def __enter__(self) -> "LollipopJSONWriter":
+        self.tmp_path = self.path + ".tmp"
+        self.f = open(self.tmp_path, "w", encoding="utf-8")
+        self.f.write("{")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # incomplete: drop it and leave any previous output untouched
+            self.f.close()
+            os.remove(self.tmp_path)
+            return
+        if self.location is not None:
+            self.f.write("}")
+        self.f.write("}")
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def _dumps(self, obj: Any) -> str:
+        return dumps(obj, separators=self.separators, ensure_ascii=self.ensure_ascii)
+
+    def add_location(self, location: str):
+        """Open a location block (a no-op if it is the current one)."""
+        if location == self.location:
+            return
+        if location in self.done_locations:
+            raise ValueError(f"Location {location!r} was already written; variants of a location must be consecutive")
+        item_sep, key_sep = self.separators
+        if self.location is not None:
+            self.f.write("}" + item_sep)
+            self.done_locations.add(self.location)
+        self.f.write(self._dumps(location) + key_sep + "{")
+        self.location = location
+        self.first_variant = True
+
+    def write_variant(self, location: str, variant: str, vdata: Dict[str, Any]):
+        """Write one variant entry; the timeseriesSummary rows are written one by one."""
+        item_sep, key_sep = self.separators
+        self.add_location(location)
+        self.f.write(("" if self.first_variant else item_sep) + self._dumps(variant) + key_sep + "{")
+        self.first_variant = False
+        for i, (key, value) in enumerate(vdata.items()):
+            self.f.write(("" if i == 0 else item_sep) + self._dumps(key) + key_sep)
+            if key == "timeseriesSummary" and isinstance(value, list):
+                self.f.write("[")
+                for j, row in enumerate(value):
+                    self.f.write(("" if j == 0 else item_sep) + self._dumps(row))
+                self.f.write("]")
+            else:
+                self.f.write(self._dumps(value))
+        self.f.write("}")
+
+    def write_variant_json(self, location: str, variant: str, vdata_json: str):
+        """Write one variant entry whose value is already serialized JSON text."""
+        item_sep, key_sep = self.separators
+        self.add_location(location)
+        self.f.write(("" if self.first_variant else item_sep) + self._dumps(variant) + key_sep + vdata_json)
+        self.first_variant = False
+
+    def write_series(self, location: str, variant: str, rows: List[Dict[str, Any]]):
+        self.write_variant(location, variant, {"timeseriesSummary": rows})
+
+
+def write_nested(data: Dict[str, Any], path: str, **kwargs):
+    """Write an in-memory nested dict series by series (NaN written as null)."""
+    with LollipopJSONWriter(path, **kwargs) as writer:
+        for location, variants in data.items():
+            writer.add_location(location)
+            for variant, vdata in variants.items():
+                writer.write_variant(location, variant, vdata)
@@ -27,10 +27,14 @@ fi
 # the output of lollipop: If dates are in old and new curve the new results will be used in the merging process
 new_only_few_month_curve="/cluster/project/pangolin/processes/sars_cov_2/lollipop/variants/deconvoluted_upload.json"
 
+# --incremental: only the data past each location's stitch date is re-stitched, the frozen history is
+# reused from the store (it is rebuilt from --old automatically if it does not match the latest curve)
 python "$analysis_dir/scripts/enhanced_nested_json_stitching.py" \
   --old "$old_backup_curve" \
   --new "$new_only_few_month_curve" \
   --output "$analysis_dir/results/stitched_curve_${ts}.json" \
+  --incremental \
+  --store-dir "$analysis_dir/results/stitch_store" \
   > "$analysis_dir/logs/stitching_${ts}.log" 2>&1
 
 #make a copy with fixed name to be used in config file
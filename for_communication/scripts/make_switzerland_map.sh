@@ -4,4 +4,7 @@ eval "$(/cluster/project/pangolin/resources/miniconda3/bin/conda shell.bash hook
 
 conda activate communication_env
 
+# (re-)prepare the cached geodata bundle if a source file changed; a no-op otherwise
+python /cluster/project/pangolin/resources/cowwid/for_communication/scripts/map_geodata.py "/cluster/project/pangolin/resources/cowwid/for_communication/config/config.yaml"
+
 python /cluster/project/pangolin/resources/cowwid/for_communication/scripts/ww_cov_switzerland_map.py "/cluster/project/pangolin/resources/cowwid/for_communication/config/config.yaml" > >(tee ww_cov_switzerland_map.log) 2>&1
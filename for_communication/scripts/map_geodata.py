@@ -0,0 +1,203 @@
+"""
+Cached, pre-projected geodata bundle for ww_cov_switzerland_map.py
+
+Reading the shapefiles, re-projecting the catchment areas and parsing the
+population Excel file dominate the run time of the map script, although these
+sources change rarely. `prepare_bundle` does this work once and writes a
+compact GeoParquet bundle:
+
+    <cache_dir>/switzerland.parquet   Swiss boundary (EPSG:4326)
+    <cache_dir>/kantons.parquet       cantons (EPSG:4326)
+    <cache_dir>/lakes.parquet         lakes (EPSG:4326)
+    <cache_dir>/catchments.parquet    all catchment areas, re-projected to EPSG:4326, with centroid_x/centroid_y,
+                                      population (EINWOHNER) and population_max (largest ARA)
+    <cache_dir>/manifest.json         fingerprints (size, mtime, SHA-256) of the source files
+
+`load_bundle` returns the cached layers, re-preparing the bundle when a source
+file (including the shapefile sidecars) changed.
+A touched but identical file (same SHA-256) does not invalidate the bundle.
+
+USAGE:
+    python map_geodata.py config.yaml [--cache-dir DIR] [--force]   # prepare step
+    from map_geodata import load_bundle
+    bundle = load_bundle(config, cache_dir)
+    bundle["catchments"]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import geopandas as gpd
+import pandas as pd
+import yaml
+
+BUNDLE_VERSION = 2
+LAYERS = ("switzerland", "kantons", "lakes", "catchments")
+SHAPEFILE_SIDECARS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+# ARA names in the population table that are spelled differently in the catchment shapefile
+POPULATION_NAME_FIXES = {
+    "SENSETAL (LAUPEN)": "LAUPEN(SENSETAL)",
+    "Thal - Altenrhein": "THAL/ALTENRHEIN",
+    "Chur": "CHUR",
+    "BIOGGIO (LUGANO)": "BIOGGIO(LUGANO)",
+}
+
+
+def default_cache_dir(config: Dict[str, Any]) -> str:
+    return config.get(
+        "geodata_cache_dir",
+        os.path.join(os.path.dirname(config["switzerland_map"]), "geodata_cache"),
+    )
+
+
+def source_files(config: Dict[str, Any]) -> List[str]:
+    """All files the bundle is derived from (shapefiles with their sidecar files)."""
+    files = [
+        config["switzerland_map"],
+        config["kantons_map"],
+        config["swiss_lakes"],
+        config["Ang_Einwohner_ARA_am01012021"],
+    ]
+    stem = os.path.splitext(config["ARA_Einzugsgebiet_2014_SWW"])[0]
+    files += sorted(
+        path for path in glob.glob(glob.escape(stem) + ".*")
+        if os.path.splitext(path)[1].lower() in SHAPEFILE_SIDECARS
+    )
+    return files
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _fingerprint(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _sha256(path)}
+
+
+def _read_manifest(cache_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(cache_dir, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(cache_dir: str, manifest: Dict[str, Any]):
+    path = os.path.join(cache_dir, "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def is_current(config: Dict[str, Any], cache_dir: str) -> bool:
+    """Whether the bundle in cache_dir was prepared from the current source files."""
+    manifest = _read_manifest(cache_dir)
+    if manifest is None or manifest.get("version") != BUNDLE_VERSION:
+        return False
+    sources = source_files(config)
+    if sorted(manifest.get("sources", {})) != sorted(sources):
+        return False
+    if not all(os.path.exists(os.path.join(cache_dir, f"{layer}.parquet")) for layer in LAYERS):
+        return False
+
+    touched = False
+    for path in sources:
+        recorded = manifest["sources"][path]
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) == (recorded["size"], recorded["mtime_ns"]):
+            continue
+        # mtime (or size) changed: only the content hash decides
+        if stat.st_size != recorded["size"] or _sha256(path) != recorded["sha256"]:
+            return False
+        recorded["mtime_ns"] = stat.st_mtime_ns
+        touched = True
+    if touched:
+        _write_manifest(cache_dir, manifest)
+    return True
+
+
+def _population(config: Dict[str, Any]) -> pd.DataFrame:
+    df_pop = pd.read_excel(config["Ang_Einwohner_ARA_am01012021"])
+    df_pop["ARANAME"] = df_pop["ARANAME"].replace(POPULATION_NAME_FIXES)
+    return df_pop
+
+
+def prepare_bundle(config: Dict[str, Any], cache_dir: str):
+    """Read, re-project and join the source layers and write the bundle."""
+    os.makedirs(cache_dir, exist_ok=True)
+    # an interrupted prepare leaves no manifest behind, so the bundle is redone next time
+    if os.path.exists(os.path.join(cache_dir, "manifest.json")):
+        os.remove(os.path.join(cache_dir, "manifest.json"))
+
+    for layer, key in (("switzerland", "switzerland_map"), ("kantons", "kantons_map"), ("lakes", "swiss_lakes")):
+        print(layer)
+        gdf = gpd.read_file(config[key])
+        gdf.set_crs(epsg=4326, inplace=True)
+        gdf.to_parquet(os.path.join(cache_dir, f"{layer}.parquet"))
+
+    print("Einzugsgebiet")
+    df_ca = gpd.read_file(config["ARA_Einzugsgebiet_2014_SWW"])
+    df_ca = df_ca[["ARA_Name", "ARA_Nr", "geometry"]]
+    df_ca = df_ca.to_crs(epsg=4326)
+
+    print("Ang_Einwohner_ARA_am01012021")
+    df_pop = _population(config)
+    population = df_pop.drop_duplicates("ARANR").set_index("ARANR")["EINWOHNER"]
+
+    # centroids in the map's (geographic) coordinates, as the pie charts are placed there
+    centroids = df_ca.geometry.centroid
+    df_ca = df_ca.assign(
+        centroid_x=centroids.x,
+        centroid_y=centroids.y,
+        population=df_ca["ARA_Nr"].map(population),
+        population_max=df_pop["EINWOHNER"].max(),
+    )
+    df_ca.to_parquet(os.path.join(cache_dir, "catchments.parquet"))
+
+    _write_manifest(
+        cache_dir,
+        {
+            "version": BUNDLE_VERSION,
+            "sources": {path: _fingerprint(path) for path in source_files(config)},
+        },
+    )
+    print(f"Prepared geodata bundle in {cache_dir}")
+
+
+def load_bundle(config: Dict[str, Any], cache_dir: str) -> Dict[str, gpd.GeoDataFrame]:
+    """The cached layers, prepared first if missing or out of date."""
+    if not is_current(config, cache_dir):
+        print(f"Geodata bundle in {cache_dir} missing or out of date, preparing it")
+        prepare_bundle(config, cache_dir)
+    return {layer: gpd.read_parquet(os.path.join(cache_dir, f"{layer}.parquet")) for layer in LAYERS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the cached geodata bundle for the Switzerland map.")
+    parser.add_argument("config_file", type=str, help="Path to the YAML configuration file")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Bundle directory (default: config geodata_cache_dir)")
+    parser.add_argument("--force", action="store_true", help="Re-prepare even if the bundle is current")
+    args = parser.parse_args()
+
+    with open(args.config_file, "r") as f:
+        config = yaml.safe_load(f)
+    cache_dir = args.cache_dir or default_cache_dir(config)
+
+    if args.force or not is_current(config, cache_dir):
+        prepare_bundle(config, cache_dir)
+    else:
+        print(f"Geodata bundle in {cache_dir} is up to date")
+
+
+if __name__ == "__main__":
+    main()
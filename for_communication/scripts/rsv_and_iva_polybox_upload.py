@@ -3,27 +3,15 @@
 import argparse
 import glob
 import os
-import subprocess
 import sys
-from typing import List
+import time
+from typing import Dict, List, Optional
 
+import requests
+import yaml
 
-POLYBOX_TARGETS = {
-    "influenza": {
-        "polybox_url": "https://bs-pangolin@polybox.ethz.ch/remote.php/dav/files/bs-pangolin/Shared/BAG-INFLUENZA/",
-        "target_glob": "/cluster/project/pangolin/processes/influenza/*/working/mutation_frequencies/",
-    },
-    "rsv": {
-        "polybox_url": "https://bs-pangolin@polybox.ethz.ch/remote.php/dav/files/bs-pangolin/Shared/BAG-RSV/",
-        "target_glob": "/cluster/project/pangolin/processes/rsv/*/working/MutationFrequencies/",
-    },
-}
-
-
-def run_cmd(cmd: List[str]) -> None:
-    """Run command and stream stdout/stderr to terminal."""
-    print(" ".join(cmd))
-    subprocess.run(cmd, check=True)
+from http_upload import RemoteFile, list_remote, make_session, normalize_etag, upload_files
+from upload_manifest import UploadManifest, compute_sha256
 
 
 def find_latest_files(target_dir_glob: str) -> List[str]:
@@ -31,72 +19,117 @@ def find_latest_files(target_dir_glob: str) -> List[str]:
     For each MutationFrequencies directory, select the lexicographically last file
     (like notebook version using sorted(listdir)[-1]).
     """
-    dirs = glob.glob(target_dir_glob)
-    dirs.sort()
-
     files_to_upload = []
-    for d in dirs:
+    for d in sorted(glob.glob(target_dir_glob)):
         if not os.path.isdir(d):
             continue
 
-        file_list = os.listdir(d)
-        file_list = [f for f in file_list if os.path.isfile(os.path.join(d, f))]
-        file_list.sort()
+        with os.scandir(d) as entries:
+            names = [entry.name for entry in entries if entry.is_file()]
 
-        if not file_list:
+        if not names:
             print(f"[WARN] No files found in {d}", file=sys.stderr)
             continue
 
-        latest = file_list[-1]
-        path = os.path.join(d, latest)
-        files_to_upload.append(path)
+        files_to_upload.append(os.path.join(d, max(names)))
 
     return files_to_upload
 
 
 def print_file_details(path: str) -> None:
-    print("Listing file details:")
-    run_cmd(["ls", "-l", path])
+    stat = os.stat(path)
+    modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(stat.st_mtime))
+    print(f"  {path}  {stat.st_size} bytes  {modified}")
 
 
-def upload_file(path: str, polybox_url: str) -> None:
-    print("Uploading file:")
-    run_cmd(["curl", "--netrc", "--upload-file", path, polybox_url])
+def is_uploaded(
+    path: str, checksum: str, remote: Optional[RemoteFile], manifest: UploadManifest, target: str
+) -> bool:
+    """
+    Whether the remote copy is identical to the local file.
+
+    The sizes have to match, and either the Nextcloud checksum stored with the
+    remote file equals the local SHA-256, or the remote ETag is still the one
+    returned when this same content (by SHA-256) was uploaded last time.
+    """
+    if manifest.force or remote is None or remote.size != os.path.getsize(path):
+        return False
+    if f"SHA256:{checksum}".lower() in (c.lower() for c in remote.checksums):
+        return True
+    return (
+        manifest.get(target, path) == checksum
+        and remote.etag is not None
+        and manifest.get(f"{target}:etag", path) == remote.etag
+    )
 
 
-def process_target(target_name: str, mode: str) -> None:
-    cfg = POLYBOX_TARGETS[target_name]
+def process_target(
+    target_name: str, cfg: Dict[str, str], mode: str, session: requests.Session, workers: int, manifest: UploadManifest
+) -> None:
     polybox_url = cfg["polybox_url"]
     target_glob = cfg["target_glob"]
+    manifest_target = f"polybox:{polybox_url}"
 
     print(f"\n=== Target: {target_name.upper()} ===")
     print(f"Searching directories: {target_glob}")
     files_to_upload = find_latest_files(target_glob)
 
-    print("\nFiles selected for upload:")
-    for f in files_to_upload:
-        print(f"  {f}")
-
     if not files_to_upload:
         print("[INFO] No files to upload.")
         return
 
+    print("\nFiles selected for upload:")
     for f in files_to_upload:
-        print()
         print_file_details(f)
 
-        if mode == "dry-run":
-            print("[DRY-RUN] Skipping upload.")
-        elif mode == "upload":
-            upload_file(f, polybox_url)
+    # one PROPFIND lists the remote folder; identical files are not sent again
+    try:
+        remote_files = list_remote(session, polybox_url)
+    except requests.RequestException as e:
+        print(f"[WARN] Could not list {polybox_url} ({e}), uploading all selected files")
+        remote_files = {}
+
+    checksums = {}
+    for f in files_to_upload:
+        checksum = compute_sha256(f)
+        if is_uploaded(f, checksum, remote_files.get(os.path.basename(f)), manifest, manifest_target):
+            print(f"{os.path.basename(f)} already on Polybox and identical, skipped")
         else:
-            raise ValueError(f"Unknown mode: {mode}")
+            checksums[f] = checksum
+
+    if not checksums:
+        print("[INFO] All selected files are already uploaded.")
+        return
+
+    if mode == "dry-run":
+        print(f"[DRY-RUN] Skipping upload of {len(checksums)} file(s):")
+        for f in checksums:
+            print(f"  {f}")
+    elif mode == "upload":
+        print(f"Uploading {len(checksums)} file(s) with {workers} worker(s):")
+        uploads = [(f, polybox_url) for f in checksums]
+        # Nextcloud stores the OC-Checksum header and returns it in PROPFIND (oc:checksums)
+        headers = {(f, polybox_url): {"OC-Checksum": f"SHA256:{checksum}"} for f, checksum in checksums.items()}
+        responses = {}
+        results = upload_files(session, uploads, workers=workers, headers=headers, responses=responses)
+        for (path, _), response in responses.items():
+            manifest.record(manifest_target, path, checksums[path])
+            etag = normalize_etag(response.headers.get("OC-ETag") or response.headers.get("ETag"))
+            if etag is not None:
+                manifest.record(f"{manifest_target}:etag", path, etag)
+        manifest.save()
+        failed = [path for (path, _), error in results.items() if error is not None]
+        if failed:
+            raise RuntimeError(f"Upload failed for: {', '.join(failed)}")
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Upload latest MutationFrequencies files to BAG Polybox targets."
     )
+    parser.add_argument("config_file", type=str, help="Path to the YAML configuration file")
     parser.add_argument(
         "--mode",
         choices=["dry-run", "upload"],
@@ -106,19 +139,43 @@ def main():
     parser.add_argument(
         "--targets",
         nargs="+",
-        choices=list(POLYBOX_TARGETS.keys()) + ["all"],
         default=["all"],
-        help="Which targets to process (default: all)",
+        help="Which targets of the config rsv_iva_polybox_targets to process (default: all)",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent uploads (default: 4)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Upload the selected files even if an identical copy is already on Polybox",
     )
 
     args = parser.parse_args()
 
+    with open(args.config_file, "r") as f:
+        config = yaml.safe_load(f)
+    polybox_targets = config["rsv_iva_polybox_targets"]
+
     targets = args.targets
     if "all" in targets:
-        targets = list(POLYBOX_TARGETS.keys())
+        targets = list(polybox_targets.keys())
+    unknown = [t for t in targets if t not in polybox_targets]
+    if unknown:
+        parser.error(f"unknown target(s) {', '.join(unknown)}; configured: {', '.join(polybox_targets)}")
+
+    manifest_file = config.get(
+        "rsv_iva_upload_manifest", os.path.join(config["outdir"], "rsv_iva_upload_manifest.json")
+    )
+    manifest = UploadManifest.load(manifest_file, force=args.force)
 
+    session = make_session(pool_size=args.workers)
     for t in targets:
-        process_target(t, args.mode)
+        process_target(t, polybox_targets[t], args.mode, session, args.workers, manifest)
 
 
 if __name__ == "__main__":
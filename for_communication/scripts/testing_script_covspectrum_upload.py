@@ -0,0 +1,204 @@
+"""
+Check covspectrum_upload.upsert_wastewater_results against a throwaway PostgreSQL
+
+Creates public.wastewater_result in a scratch database (and refuses to run if
+that table already exists, so it can never touch the CovSpectrum tables), then
+runs the upsert like ww_cov_uploader_v-pipe.py does (one transaction, committed
+by the caller) and checks:
+- INSERT: new series are inserted and counted
+- UPDATE / UNCHANGED: changed payloads are updated, identical ones are counted
+  as unchanged and not written
+- DUPLICATES: a (location, variant) pair listed twice is stored once, with the
+  same final table content as the former per-row `DO $$ IF EXISTS ...` blocks
+- STAGING TABLE: the ON COMMIT DROP table is gone after commit (and after a
+  rollback), the next upsert on the same connection works, and autocommit is refused
+for a `data` column of type jsonb and of type text.
+
+Without --dsn, a temporary server is started with `pgserver`
+(pip install pgserver, bundles the PostgreSQL binaries) and removed afterwards.
+The exit status is 0 when every check passes, 1 otherwise.
+
+USAGE:
+    python testing_script_covspectrum_upload.py [--dsn postgresql://user@localhost/scratch]
+"""
+
+import argparse
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+import psycopg2
+
+from covspectrum_upload import STAGE_TABLE, upsert_wastewater_results
+
+# the former per-series statement of ww_cov_uploader_v-pipe.py, used as the reference
+_REFERENCE_UPSERT = """
+DO $$
+BEGIN
+IF EXISTS (SELECT ww.data FROM public.wastewater_result AS ww WHERE ww.variant_name=%(var)s AND ww.location=%(city)s) THEN
+UPDATE public.wastewater_result AS ww SET data=%(data)s WHERE ww.variant_name=%(var)s AND ww.location=%(city)s;
+ELSE
+INSERT INTO public.wastewater_result (variant_name, location, data)
+VALUES(%(var)s, %(city)s, %(data)s);
+END IF;
+END
+$$
+"""
+
+failures: List[str] = []
+
+
+def check(name: str, condition: bool, detail: str = ""):
+    print(f"{'PASS' if condition else 'FAIL'}: {name}" + (f" ({detail})" if detail and not condition else ""))
+    if not condition:
+        failures.append(name)
+
+
+def payload(value: float) -> str:
+    return f'{{"timeseriesSummary": [{{"date": "2025-01-01", "proportion": {value}}}]}}'
+
+
+def create_table(dbconn, data_type: str):
+    with dbconn.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.wastewater_result')")
+        if cur.fetchone()[0] is not None:
+            sys.exit("public.wastewater_result already exists in this database, refusing to run (use a scratch database)")
+        cur.execute(f"CREATE TABLE public.wastewater_result (variant_name text, location text, data {data_type})")
+    dbconn.commit()
+
+
+def drop_table(dbconn):
+    with dbconn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS public.wastewater_result")
+    dbconn.commit()
+
+
+def table_rows(dbconn) -> List[Tuple[str, str, str]]:
+    with dbconn.cursor() as cur:
+        cur.execute("SELECT location, variant_name, data::text FROM public.wastewater_result ORDER BY 1, 2, 3")
+        return cur.fetchall()
+
+
+def stage_exists(dbconn) -> bool:
+    with dbconn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (f"pg_temp.{STAGE_TABLE}",))
+        exists = cur.fetchone()[0] is not None
+    dbconn.rollback()
+    return exists
+
+
+def upsert(dbconn, records) -> Dict[str, int]:
+    counts = upsert_wastewater_results(dbconn, records)
+    dbconn.commit()
+    return counts
+
+
+def reference_rows(dbconn, batches) -> List[Tuple[str, str, str]]:
+    """Final table content when the same batches are applied with the former per-row statement."""
+    drop_table_content(dbconn)
+    with dbconn.cursor() as cur:
+        for records in batches:
+            for location, variant, data in records:
+                cur.execute(_REFERENCE_UPSERT, {"data": data, "var": variant, "city": location})
+            dbconn.commit()
+    rows = table_rows(dbconn)
+    drop_table_content(dbconn)
+    return rows
+
+
+def drop_table_content(dbconn):
+    with dbconn.cursor() as cur:
+        cur.execute("TRUNCATE public.wastewater_result")
+    dbconn.commit()
+
+
+def run_checks(dbconn, data_type: str):
+    print(f"\n=== data column of type {data_type} ===")
+    create_table(dbconn, data_type)
+    try:
+        first = [("Zürich (ZH)", "BA.2.86", payload(0.1)), ("Genève (GE)", "BA.2.86", payload(0.2))]
+        second = [
+            ("Zürich (ZH)", "BA.2.86", payload(0.1)),  # unchanged
+            ("Genève (GE)", "BA.2.86", payload(0.25)),  # updated
+            ("Basel (BS)", "XFG", payload(0.3)),  # new
+        ]
+        duplicates = [
+            ("Chur (GR)", "XFG", payload(0.4)),  # new, listed twice
+            ("Chur (GR)", "XFG", payload(0.45)),
+            ("Basel (BS)", "XFG", payload(0.3)),  # existing, listed twice with a change
+            ("Basel (BS)", "XFG", payload(0.35)),
+        ]
+
+        counts = upsert(dbconn, first)
+        check("INSERT counts", counts == {"inserted": 2, "updated": 0, "unchanged": 0}, str(counts))
+        check("INSERT rows", len(table_rows(dbconn)) == 2, str(table_rows(dbconn)))
+        check("STAGING TABLE dropped at commit", not stage_exists(dbconn))
+
+        counts = upsert(dbconn, second)
+        check("UPDATE / UNCHANGED counts", counts == {"inserted": 1, "updated": 1, "unchanged": 1}, str(counts))
+        check("STAGING TABLE reusable on the same connection", not stage_exists(dbconn))
+
+        counts = upsert(dbconn, duplicates)
+        check("DUPLICATES counts", counts == {"inserted": 1, "updated": 1, "unchanged": 0}, str(counts))
+        rows = table_rows(dbconn)
+        keys = [(location, variant) for location, variant, _ in rows]
+        check("DUPLICATES stored once", len(keys) == len(set(keys)), str(rows))
+        expected = reference_rows(dbconn, [first, second, duplicates])
+        check("DUPLICATES same table as the former per-row statements", rows == expected, f"{rows} != {expected}")
+
+        upsert(dbconn, first + second + duplicates)
+        counts = upsert(dbconn, first + second + duplicates)
+        check("UNCHANGED on identical rerun", counts["inserted"] == 0 and counts["updated"] == 0, str(counts))
+
+        before = table_rows(dbconn)
+        upsert_wastewater_results(dbconn, [("Lugano (TI)", "XFG", payload(0.5))])
+        dbconn.rollback()
+        check("ROLLBACK leaves the table unchanged", table_rows(dbconn) == before)
+        check("STAGING TABLE dropped at rollback", not stage_exists(dbconn))
+
+        dbconn.autocommit = True
+        try:
+            upsert_wastewater_results(dbconn, first)
+            refused = False
+        except ValueError:
+            refused = True
+        finally:
+            dbconn.autocommit = False
+        check("AUTOCOMMIT refused", refused)
+    finally:
+        dbconn.rollback()
+        drop_table(dbconn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the CovSpectrum upsert against a throwaway PostgreSQL.")
+    parser.add_argument("--dsn", default=None, help="Scratch database (default: temporary server started with pgserver)")
+    args = parser.parse_args()
+
+    server = None
+    dsn = args.dsn
+    if dsn is None:
+        try:
+            import pgserver
+        except ImportError:
+            parser.error("no --dsn given and pgserver is not installed (pip install pgserver)")
+        server = pgserver.get_server(tempfile.mkdtemp(prefix="pg_covspectrum_check."), cleanup_mode="delete")
+        dsn = server.get_uri()
+
+    dbconn = psycopg2.connect(dsn)
+    try:
+        for data_type in ("jsonb", "text"):
+            run_checks(dbconn, data_type)
+    finally:
+        dbconn.close()
+        if server is not None:
+            server.cleanup()
+
+    if failures:
+        print(f"\n{len(failures)} check(s) failed: {', '.join(failures)}")
+        sys.exit(1)
+    print("\nAll checks passed.")
+
+
+if __name__ == "__main__":
+    main()
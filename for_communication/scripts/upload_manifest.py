@@ -0,0 +1,117 @@
+"""
+Local manifest of previously uploaded payloads
+
+Stores, per upload target, the SHA-256 of the last payload that was
+successfully pushed, and for files the size and mtime they had when that
+SHA-256 was computed:
+
+{
+  "version": 1,
+  "targets": {
+    "covspectrum": {"Zürich (ZH)\tKP.2": "<sha256>", ...},
+    "wisedb": {"/path/ww_update_data_wisebd.json": "<sha256>"},
+    "wisedb:stamp": {"/path/ww_update_data_wisebd.json": "<size>:<mtime_ns>"},
+    "polybox:https://.../BAG-COWWID19/": {"/path/ww_update_data_combined.json": "<sha256>"}
+  }
+}
+
+Series are keyed by "location<TAB>variant", files by their path. A file whose
+size and mtime still match its stamp counts as unchanged without being read;
+otherwise its SHA-256 decides. Entries are only recorded after the upload
+succeeded, and the file is replaced atomically, so an interrupted run re-sends
+whatever it did not finish.
+
+USAGE:
+    manifest = UploadManifest.load(path)
+    if manifest.changed("wisedb", input_file, digest):
+        ...upload...
+        manifest.record("wisedb", input_file, digest)
+    manifest.save()
+
+    stamp = file_stamp(input_file)
+    if manifest.file_unchanged("wisedb", input_file, stamp):
+        ...skip without reading the file...
+    ...
+    manifest.record_file("wisedb", input_file, digest, stamp)
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+MANIFEST_VERSION = 1
+
+
+def compute_sha256(file_path: str, chunk_size: int = 8192) -> str:
+    """SHA-256 hex digest of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_stamp(file_path: str) -> str:
+    """Cheap change marker of a file: its size and mtime (ns)."""
+    stat = os.stat(file_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def sha256_text(text: str) -> str:
+    """SHA-256 hex digest of a (UTF-8 encoded) string payload."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def series_key(location: str, variant: str) -> str:
+    return f"{location}\t{variant}"
+
+
+class UploadManifest:
+    """SHA-256 of the last successful upload, per target and series/file."""
+
+    def __init__(self, path: str, targets: Optional[Dict[str, Dict[str, str]]] = None, force: bool = False):
+        self.path = path
+        self.targets = targets or {}
+        # with force every payload counts as changed, but successful uploads are still recorded
+        self.force = force
+
+    @classmethod
+    def load(cls, path: str, force: bool = False) -> "UploadManifest":
+        if not os.path.exists(path):
+            return cls(path, force=force)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            print(f"Ignoring upload manifest {path} with unknown version {data.get('version')!r}")
+            return cls(path, force=force)
+        return cls(path, data.get("targets", {}), force=force)
+
+    def get(self, target: str, key: str) -> Optional[str]:
+        return self.targets.get(target, {}).get(key)
+
+    def changed(self, target: str, key: str, digest: str) -> bool:
+        """Whether the payload has to be (re-)uploaded."""
+        return self.force or self.get(target, key) != digest
+
+    def record(self, target: str, key: str, digest: str):
+        self.targets.setdefault(target, {})[key] = digest
+
+    def file_unchanged(self, target: str, file_path: str, stamp: str) -> bool:
+        """Whether the file still has the size and mtime it had at its last upload (no hashing needed)."""
+        return (
+            not self.force
+            and self.get(target, file_path) is not None
+            and self.get(f"{target}:stamp", file_path) == stamp
+        )
+
+    def record_file(self, target: str, file_path: str, digest: str, stamp: str):
+        """Record a file's SHA-256 with the stamp (file_stamp, taken before hashing) it was computed at."""
+        self.record(target, file_path, digest)
+        self.record(f"{target}:stamp", file_path, stamp)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "targets": self.targets}, f, indent=1, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,186 @@
+"""
+Rolling-window aggregates of the deconvoluted variant proportions
+
+The Swiss map (and any report) needs "mean proportion per location and variant
+over the week up to date D". Instead of filtering the deconvolution table and
+re-running a groupby for every date, `rolling_fractions` computes the window
+mean for every calendar day and every (location, variant) at once:
+
+- the rows are scattered into a dense (day x series) grid of sums and counts
+- window sums are differences of cumulative sums along the day axis
+- the mean is sum / count wherever the window holds at least one value
+
+The window of date D covers [D - window_days, D] (both ends included), which is
+the `date >= most_recent - 7 days` selection of the map for window_days=7.
+Missing proportions are ignored like in `groupby(...).mean()`.
+The table ends at the last date of the input.
+
+The result is cached as Parquet, keyed by the SHA-256 of the input file and
+the window, so repeated runs (map, frames, reports) only read the cache.
+
+`national_fractions` turns the per-location table into population-weighted
+national means per (date, variant), using only the locations that have a value
+in the window.
+
+USAGE:
+    from variant_aggregates import rolling_fractions, fractions_at
+    rolling = rolling_fractions("deconvoluted.tsv.zst", window_days=7, cache_dir="cache/")
+    df_week = fractions_at(rolling, rolling["date"].max())
+
+    python variant_aggregates.py config.yaml --window 7 --output rolling.csv [--national national.csv]
+"""
+
+import argparse
+import hashlib
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from deconvolution_io import load_deconvolution
+
+CACHE_VERSION = 2
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_deconvolution(path: str) -> pd.DataFrame:
+    """Read the lollipop deconvolution table (typed, through the Parquet sidecar of deconvolution_io)."""
+    return load_deconvolution(path, usecols=["date", "location", "variant", "proportion"])
+
+
+def compute_rolling(df: pd.DataFrame, window_days: int = 7) -> pd.DataFrame:
+    """
+    Window mean of `proportion` for every calendar day and (location, variant).
+
+    df needs date, location, variant and proportion columns. Returns a long
+    table (date, location, variant, fraction, n) with a row wherever the
+    window of that day holds at least one value; n is the number of values.
+    """
+    df = df[df["date"].notna()]
+    if df.empty:
+        return pd.DataFrame({"date": pd.Series(dtype="datetime64[ns]"), "location": [], "variant": [], "fraction": [], "n": []})
+
+    days = df["date"].dt.normalize()
+    first = days.min()
+    day = ((days - first) // pd.Timedelta(days=1)).to_numpy()
+    n_days = int(day.max()) + 1
+
+    series, keys = pd.MultiIndex.from_arrays([df["location"], df["variant"]]).factorize()
+    values = df["proportion"].to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+
+    sums = np.zeros((n_days, len(keys)))
+    counts = np.zeros((n_days, len(keys)), dtype=np.int64)
+    np.add.at(sums, (day[present], series[present]), values[present])
+    np.add.at(counts, (day[present], series[present]), 1)
+
+    # window [d - window_days, d]: cumulative sum at d minus the one at d - window_days - 1
+    def window(a: np.ndarray) -> np.ndarray:
+        cs = np.cumsum(a, axis=0)
+        out = cs.copy()
+        out[window_days + 1:] -= cs[:-window_days - 1]
+        return out
+
+    window_sums = window(sums)
+    window_counts = window(counts)
+
+    d, s = np.nonzero(window_counts)
+    return pd.DataFrame(
+        {
+            "date": first + pd.to_timedelta(d, unit="D"),
+            "location": keys.get_level_values(0)[s],
+            "variant": keys.get_level_values(1)[s],
+            "fraction": window_sums[d, s] / window_counts[d, s],
+            "n": window_counts[d, s],
+        }
+    )
+
+
+def rolling_fractions(path: str, window_days: int = 7, cache_dir: Optional[str] = None) -> pd.DataFrame:
+    """`compute_rolling` of a deconvolution file, cached by input hash and window."""
+    if cache_dir is None:
+        return compute_rolling(read_deconvolution(path), window_days)
+
+    key = f"v{CACHE_VERSION}_{_sha256(path)[:20]}_w{window_days}"
+    cache_file = os.path.join(cache_dir, f"rolling_{key}.parquet")
+    if os.path.exists(cache_file):
+        print(f"Rolling {window_days}-day fractions from cache: {cache_file}")
+        return pd.read_parquet(cache_file)
+
+    rolling = compute_rolling(read_deconvolution(path), window_days)
+    os.makedirs(cache_dir, exist_ok=True)
+    # drop the entries of previous inputs, the cache only serves the current file
+    for old in os.listdir(cache_dir):
+        if old.startswith(f"rolling_v{CACHE_VERSION}_") and old.endswith(f"_w{window_days}.parquet"):
+            os.remove(os.path.join(cache_dir, old))
+    rolling.to_parquet(cache_file + ".tmp", index=False)
+    os.replace(cache_file + ".tmp", cache_file)
+    print(f"Rolling {window_days}-day fractions cached in: {cache_file}")
+    return rolling
+
+
+def fractions_at(rolling: pd.DataFrame, date) -> pd.DataFrame:
+    """Window means of one date, indexed by (location, variant) with a `fraction` column."""
+    selected = rolling[rolling["date"] == pd.Timestamp(date).normalize()]
+    return selected.set_index(["location", "variant"])[["fraction"]].sort_index()
+
+
+def national_fractions(rolling: pd.DataFrame, populations: pd.Series) -> pd.DataFrame:
+    """
+    Population-weighted mean per (date, variant) over the locations with a value.
+
+    populations maps location -> inhabitants; locations without a population are left out.
+    """
+    weight = rolling["location"].map(populations)
+    weighted = rolling.assign(weight=weight, weighted=rolling["fraction"] * weight)[weight.notna()]
+    national = weighted.groupby(["date", "variant"], sort=True)[["weighted", "weight"]].sum()
+    national["fraction"] = national["weighted"] / national["weight"]
+    return national[["fraction"]].reset_index()
+
+
+def location_populations(catchments: pd.DataFrame, ara_shortnames: dict) -> pd.Series:
+    """Inhabitants per deconvolution location, from the catchment table and config `ara_shortnames`."""
+    by_ara = catchments.drop_duplicates("ARA_Name").set_index("ARA_Name")["population"]
+    return pd.Series({location: by_ara.get(ara, np.nan) for location, ara in ara_shortnames.items()}).dropna()
+
+
+def default_cache_dir(config: dict) -> str:
+    return config.get("aggregates_cache_dir", os.path.join(config["outdir"], "aggregates_cache"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling-window variant fractions from the deconvolution table.")
+    parser.add_argument("config_file", type=str, help="Path to the YAML configuration file")
+    parser.add_argument("--window", type=int, default=7, help="Window length in days before each date (default: 7)")
+    parser.add_argument("--output", type=str, required=True, help="CSV of the per-location window means")
+    parser.add_argument("--national", type=str, default=None, help="Also write population-weighted national means to this CSV")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Cache directory (default: config aggregates_cache_dir)")
+    args = parser.parse_args()
+
+    with open(args.config_file, "r") as f:
+        config = yaml.safe_load(f)
+
+    rolling = rolling_fractions(config["deconvolution"], args.window, args.cache_dir or default_cache_dir(config))
+    rolling.to_csv(args.output, index=False)
+    print(f"Wrote {len(rolling)} rows to {args.output}")
+
+    if args.national:
+        from map_geodata import default_cache_dir as geodata_cache_dir, load_bundle
+
+        catchments = load_bundle(config, geodata_cache_dir(config))["catchments"]
+        national = national_fractions(rolling, location_populations(catchments, config["ara_shortnames"]))
+        national.to_csv(args.national, index=False)
+        print(f"Wrote {len(national)} rows to {args.national}")
+
+
+if __name__ == "__main__":
+    main()
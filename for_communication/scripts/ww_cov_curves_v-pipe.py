@@ -28,7 +28,13 @@ import sys
 import netrc
 import psycopg2
 import argparse
-from copy import deepcopy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.lines import Line2D
+
+from curve_store import CurveStore
+from figure_render import FORMATS, save_formats
+from lollipop_json import LollipopJSONWriter, iter_series
 
 
 
@@ -40,6 +46,19 @@ parser.add_argument(
     type=str, 
     help="Path to the YAML configuration file"
 )
+parser.add_argument(
+    "--formats",
+    nargs="+",
+    choices=FORMATS,
+    default=list(FORMATS),
+    help="Output formats, rendered concurrently (default: all)"
+)
+parser.add_argument(
+    "--panel-workers",
+    type=int,
+    default=1,
+    help="Render each location panel in one of N processes and composite them as raster images (default: 1, single vector figure)"
+)
 args = parser.parse_args()
 
 # Load YAML config from the input argument
@@ -63,43 +82,41 @@ print(
     f"reusing {jsonfile_smooth} last modified: {time.ctime(os.path.getmtime(jsonfile_smooth))}"
 )
 
-with open(jsonfile_smooth, "r") as file:
-    update_data_smooth = json.load(file)
+# One long-format DataFrame (location, variant, date, proportion, lower, upper), streamed from the file once.
+# Everything below (last dates, clipping, blacklist, the three output JSONs and the plot) is derived from it.
+# The parsed rows are kept as well (row i of the DataFrame is raw_rows[i]): the output JSONs are written
+# from them, so the values are exactly those of the file (0 stays 0, not 0.0).
+raw_rows = []
+
+
+def keep_rows(series):
+    for loc, var, rows in series:
+        if rows is not None:
+            # same rows as CurveStore.from_series keeps
+            rows = [r for r in rows if isinstance(r, dict) and r.get("date")]
+            raw_rows.extend(rows)
+        yield loc, var, rows
+
+
+store = CurveStore.from_series(keep_rows(iter_series(jsonfile_smooth)), value_dtype=np.float64)
+df = store.to_frame()
+df["datestr"] = df["date"].dt.strftime("%Y-%m-%d")
 
 ## extra snippet to remove specific variants from the curves after lollipop processing
-#for k,v in update_data_smooth.items():
-#    del update_data_smooth[k]["BA.2.87.1"]
-#update_data_smooth["Altenrhein (SG)"].keys()
+#df = df[df["variant"] != "BA.2.87.1"]
 
-# Locations list in smooth
-locations_file = list({c for c in update_data_smooth.keys()})
+# every (location, variant) series of the file, including empty ones
+series_keys = sorted({(loc, var) for loc, var, _ in store.iter_series()})
 
+# Locations list in smooth
+locations_file = list(store.locations)
 
 # Date max (useful for the e-mail)
+lastdates = df.groupby("location", observed=True)["datestr"].max().to_dict()
 for l in locations_file:
-    print(
-        l,
-        max(
-            [
-                d["date"]
-                for v in update_data_smooth[l].values()
-                for d in v["timeseriesSummary"]
-            ]
-        ),
-        sep="\t",
-    )
+    print(l, lastdates[l], sep="\t")
 
 # date sentence in e-mail
-lastdates = {
-    l: max(
-        [
-            d["date"]
-            for v in update_data_smooth[l].values()
-            for d in v["timeseriesSummary"]
-        ]
-    )
-    for l in locations_file
-}
 bydates = {d: [] for d in sorted(list(set(lastdates.values())))}
 for l, d in lastdates.items():
     bydates[d] += [l]
@@ -120,35 +137,22 @@ only_start_from = {
 }
 print(only_start_from)
 
-update_data = {}
 # HACK presume that the smoothing data is the exact set that we want to upload
-locations_upload = locations_file
-variants_upload = sorted(
-    list({v for c in update_data_smooth.values() for v in c.keys()})
+start_loc = df["location"].astype(str).map(only_start_from).fillna("")
+start_var = df["variant"].astype(str).map(only_start_from).fillna("")
+clipped = (df["datestr"] >= start_loc) & (df["datestr"] >= start_var)
+
+# blacklisted (location, date) pairs are removed for all variants of the location
+blacklisted = pd.MultiIndex.from_arrays([df["location"].astype(str), df["datestr"]]).isin(
+    [(entry["location"], entry["date"]) for entry in blacklist]
 )
-for loc in tqdm(locations_upload, desc="Locations", position=0):
-    update_data[loc] = {}
-    for var in tqdm(variants_upload, desc=loc, position=1, leave=False):
-        # NOTE we always junk the heatmap, it's not up to date anyway
-        update_data[loc][var] = {
-            # "updateDate": todaydate,
-            "timeseriesSummary": [
-                x
-                for x in update_data_smooth[loc][var]["timeseriesSummary"]
-                if ((loc not in only_start_from) or (x["date"] >= only_start_from[loc]))
-                and (
-                    (var not in only_start_from) or (x["date"] >= only_start_from[var])
-                )
-            ],
-            "mutationOccurrences": (np.nan),
-        }
 
 ################################ Inspect ################################
 # Locations list in smooth
-locations = sorted(list({c for c in update_data.keys()}))
+locations = sorted(store.locations)
 
 # Variants in smooth
-variants = sorted(list({v for c in update_data.values() for v in c.keys()}))
+variants = sorted(store.variants)
 
 
 # Does each one of them has a color?
@@ -156,120 +160,133 @@ missing_color = list(set(variants) - set(color_map.keys()))
 print(", ".join(missing_color))
 assert 0 == len(missing_color), "ERROR: some variant without color !"
 
-# Load in a dataframe
-df = pd.DataFrame.from_records(
-    data=[
-        {
-            "location": loc,
-            "date": pd.to_datetime(d["date"]),
-            "variant": var,
-            "proportion": d["proportion"],
-            "upper": d["proportionUpper"],
-            "lower": d["proportionLower"],
-        }
-        for loc in tqdm(locations_upload, desc="Locations", position=0)
-        for var in tqdm(variants_upload, desc=loc, position=1, leave=False)
-        for d in update_data_smooth[loc][var]["timeseriesSummary"]
-    ]
-)
-################################ Plot ################################
-
-# TODO: depending on how many WWTPs we are tracking, we might need to increase nrows and ncols or it will break. A better approach would be to dynamically decide based on how many WWTPs we have
-plotwidth = 40
 
-fig, axes = plt.subplots(
-    nrows=3, ncols=2, figsize=(plotwidth, plotwidth / 2), sharex=True
-)
-axes = axes.flatten()
+def timeseries_by_series(mask):
+    """{(location, variant): timeseriesSummary rows, as parsed from the file} for the rows selected by mask, in file order."""
+    selected = df[mask]
+    positions = selected.index.to_numpy()
+    out = {key: [] for key in series_keys}
+    for key, idx in selected.groupby(["location", "variant"], observed=True, sort=False).indices.items():
+        out[key] = [raw_rows[i] for i in positions[idx].tolist()]
+    return out
 
-for i, loc in enumerate(tqdm(locations, desc="Locations", position=0, leave=False)):
-    axes[i].set_title(loc)
+################################ Plot ################################
 
-    for var in tqdm(variants, desc=loc, position=1, leave=False):
-        tt_df = (
-            df[(df["variant"] == var) & (df["location"] == loc)]
-            .sort_values(by=["date"])
-            .fillna(0)
-        )
-        if tt_df.size == 0:
+plotwidth = 40
+# two panels per row; the height of a row (plotwidth / 6) is the one of the former fixed 3x2 layout
+ncols = 2
+nrows = max(1, -(-len(locations) // ncols))
+figsize = (plotwidth, plotwidth / 6 * nrows)
+# only the last 80 dates of each (location, variant) are plotted
+last_rows = 80
+
+# grouped once: {location: {variant: rows sorted by date}}
+by_location = {loc: {} for loc in locations}
+for (loc, var), tt_df in df.sort_values(by=["date"], kind="stable").groupby(["location", "variant"], observed=True):
+    by_location[loc][var] = tt_df
+
+
+def plot_location(ax, loc):
+    """Draw the curves and confidence bands of all variants of one location."""
+    ax.set_title(loc)
+    for var in variants:
+        tt_df = by_location[loc].get(var)
+        if tt_df is None or tt_df.size == 0:
             continue
-        tt_df = tt_df.iloc[-80:] #That means: plot only the last 15 rows (last 15 dates) for each (location, variant).
+        tt_df = tt_df.iloc[-last_rows:]
+        values = tt_df[["proportion", "lower", "upper"]].fillna(0)
         g = sns.lineplot(
             x=tt_df["date"],
-            y=tt_df["proportion"],
-            hue=tt_df["variant"],
-            ax=axes[i],
+            y=values["proportion"],
+            hue=tt_df["variant"].astype(str),
+            ax=ax,
             palette=color_map,
         )
         g.get_legend().remove()
-        axes[i].fill_between(
+        ax.fill_between(
             x=tt_df["date"],
-            y1=np.clip(tt_df["upper"], 0.0, 1.0),
-            y2=np.clip(tt_df["lower"], 0.0, 1.0),
+            y1=np.clip(values["upper"], 0.0, 1.0),
+            y2=np.clip(values["lower"], 0.0, 1.0),
             alpha=0.2,
             # color="grey",
             color=color_map[var],
         )
-handles, labels = axes[i].get_legend_handles_labels()
+
+
+def render_location_panel(loc):
+    """Render one location panel on its own figure (panel worker) and return it as an RGBA array."""
+    panel_fig, panel_ax = plt.subplots(figsize=(figsize[0] / ncols, figsize[1] / nrows))
+    plot_location(panel_ax, loc)
+    panel_fig.tight_layout()
+    panel_fig.canvas.draw()
+    image = np.asarray(panel_fig.canvas.buffer_rgba()).copy()
+    plt.close(panel_fig)
+    return image
+
+
+fig, axes = plt.subplots(
+    nrows=nrows, ncols=ncols, figsize=figsize, sharex=args.panel_workers <= 1, squeeze=False
+)
+axes = axes.flatten()
+for ax in axes[len(locations):]:
+    ax.set_axis_off()
+
+if args.panel_workers > 1:
+    # each panel is rendered in its own (forked) process and the raster images are composited into the grid
+    with ProcessPoolExecutor(max_workers=args.panel_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        for ax, image in zip(axes, tqdm(pool.map(render_location_panel, locations), total=len(locations), desc="Locations")):
+            ax.imshow(image, aspect="auto", interpolation="none")
+            ax.set_axis_off()
+    fig.subplots_adjust(left=0, right=1, top=0.95, bottom=0.1, wspace=0, hspace=0)
+    plotted = [var for var in variants if any(var in by_location[loc] for loc in locations)]
+    handles = [Line2D([0], [0], color=color_map[var]) for var in plotted]
+    labels = plotted
+else:
+    for i, loc in enumerate(tqdm(locations, desc="Locations", position=0, leave=False)):
+        plot_location(axes[i], loc)
+    handles, labels = axes[len(locations) - 1].get_legend_handles_labels()
 fig.legend(
     handles, labels, loc="lower center", ncol=len(labels), bbox_to_anchor=(0.5, 0.05)
 )
 fig.suptitle(f"Deconvolution by V-pipe")
-plt.savefig(os.path.join(plots_dir, f"combined-vpipe.pdf"))
-plt.savefig(os.path.join(plots_dir, f"combined-vpipe.svg"))
-plt.savefig(os.path.join(plots_dir, f"combined-vpipe.png"))
+save_formats(fig, os.path.join(plots_dir, "combined-vpipe"), args.formats)
 
-with open(update_data_combined_file, "w") as file:
-    file.write(
-        json.dumps(update_data).replace("NaN", "null")
-    )  # syntactically standard compliant JSON vs. python numpy's output.
+# written series by series, NaN as null: syntactically standard compliant JSON vs. python numpy's output.
+update_data = timeseries_by_series(clipped)
+with LollipopJSONWriter(update_data_combined_file, separators=(", ", ": ")) as writer:
+    for loc, var in series_keys:
+        # NOTE we always junk the heatmap, it's not up to date anyway
+        writer.write_variant(loc, var, {"timeseriesSummary": update_data[(loc, var)], "mutationOccurrences": np.nan})
 
 
 ################################ Data Preparation for Upload to Cov-Spectrum ################################
 
-update_data_for_cov_spectrum = deepcopy(update_data)
-for entry in blacklist:
-    blacklist_location = entry["location"]
-    blacklist_date = entry["date"]
-    blacklist_reason = entry["reason"]
-    for k in update_data_for_cov_spectrum[blacklist_location].keys():
-        dates = update_data_for_cov_spectrum[blacklist_location][k]["timeseriesSummary"]
-        for date in dates:
-            if date["date"] == blacklist_date:
-                update_data_for_cov_spectrum[blacklist_location][k]["timeseriesSummary"].remove(date)
+update_data_for_cov_spectrum = timeseries_by_series(clipped & ~blacklisted)
 print("Data Preparation for Upload to Cov-Spectrum:")
 print("Blacklisted: "+str(len(blacklist)))
-print(len(update_data[blacklist_location][k]["timeseriesSummary"]))
-print(len(update_data_for_cov_spectrum[blacklist_location][k]["timeseriesSummary"]))
+print(int(clipped.sum()))
+print(int((clipped & ~blacklisted).sum()))
 
-with open(update_data_covspectrum_file, "w") as file:
-    file.write(
-        json.dumps(update_data_for_cov_spectrum).replace("NaN", "null")
-    )  # syntactically standard compliant JSON vs. python numpy's output.
+with LollipopJSONWriter(update_data_covspectrum_file, separators=(", ", ": ")) as writer:
+    for loc, var in series_keys:
+        writer.write_variant(loc, var, {"timeseriesSummary": update_data_for_cov_spectrum[(loc, var)], "mutationOccurrences": np.nan})
 
 
 ################################ Data Preparation for Upload to FOPH/BAG's Polybox ################################
 
-reformat = {
-    var: {
-        loc: {"timeseriesSummary": update_data[loc][var]["timeseriesSummary"]}
-        for loc in tqdm(locations, desc=pango, position=1, leave=False)
-    }
-    for pango in tqdm(variants, desc="Variants", position=0)
-}
+# variant first: {variant: {location: {"timeseriesSummary": [...]}}}, every variant and location
+reformat_keys = sorted(series_keys, key=lambda key: (key[1], key[0]))
 
 # CHECK: print first entry to check if is formatted correctly:
 # Get first variant and location
-first_variant = next(iter(reformat))
-first_location = next(iter(reformat[first_variant]))
+first_location, first_variant = reformat_keys[0]
 
 # Print nicely formatted JSON
 print(json.dumps(
-    reformat[first_variant][first_location],
+    {"timeseriesSummary": update_data[(first_location, first_variant)]},
     indent=2
 ))
 
-with open(reformatted, "w") as file:
-    file.write(
-        json.dumps(reformat).replace("NaN", "null")
-    )  # syntactically standard compliant JSON vs. python numpy's output.
+with LollipopJSONWriter(reformatted, separators=(", ", ": ")) as writer:
+    for loc, var in reformat_keys:
+        writer.write_series(var, loc, update_data[(loc, var)])
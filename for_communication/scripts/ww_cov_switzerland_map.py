@@ -21,13 +21,20 @@ import seaborn as sns
 import yaml
 import os
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
+from matplotlib.animation import FFMpegWriter, PillowWriter
 import matplotlib.patheffects as PathEffects
 
 from adjustText import adjust_text
 
+from figure_render import FORMATS, save_formats
+from map_geodata import default_cache_dir, load_bundle
+from variant_aggregates import default_cache_dir as aggregates_cache_dir, fractions_at, rolling_fractions
+
 ################################ Globals ################################
 # Set up argument parser
 parser = argparse.ArgumentParser(description="Process YAML config file.")
@@ -36,7 +43,59 @@ parser.add_argument(
     type=str, 
     help="Path to the YAML configuration file"
 )
+parser.add_argument(
+    "--cache-dir",
+    type=str,
+    default=None,
+    help="Directory of the pre-projected geodata bundle (default: config geodata_cache_dir); prepared if missing or stale"
+)
+parser.add_argument(
+    "--formats",
+    nargs="+",
+    choices=FORMATS,
+    default=list(FORMATS),
+    help="Output formats, rendered concurrently (default: all)"
+)
+parser.add_argument(
+    "--start",
+    type=str,
+    default=None,
+    help="Render one map per week from this date (YYYY-MM-DD) up to --end instead of only the most recent week"
+)
+parser.add_argument(
+    "--end",
+    type=str,
+    default=None,
+    help="Last week end of the frame series (default: most recent date in the data)"
+)
+parser.add_argument(
+    "--step-days",
+    type=int,
+    default=7,
+    help="Days between two frames (default: 7)"
+)
+parser.add_argument(
+    "--frame-workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of processes rendering frames in parallel (default: number of CPUs)"
+)
+parser.add_argument(
+    "--animate",
+    nargs="+",
+    choices=["gif", "mp4"],
+    default=[],
+    help="Also assemble the frames into an animation (mp4 needs ffmpeg)"
+)
+parser.add_argument(
+    "--fps",
+    type=float,
+    default=2,
+    help="Frames per second of the animation (default: 2)"
+)
 args = parser.parse_args()
+if args.start is not None and args.end is not None and pd.to_datetime(args.start) > pd.to_datetime(args.end):
+    parser.error("--start must not be after --end")
 
 # Load YAML config from the input argument
 print(f"Loading configuration from: {args.config_file}")
@@ -46,29 +105,22 @@ with open(args.config_file, "r") as f:
 # Access variables
 plots_dir = config["plots_dir"]
 deconvolution = config["deconvolution"]
-switzerland_file = config["switzerland_map"]
-kantons_file = config["kantons_map"]
 swiss_cities = config["swiss_cities"]
-swiss_lakes = config["swiss_lakes"]
-swiss_municipalities = config["swiss_municipalities"]
 wastewater_plants = config["wastewater_plants"]
 legend_information = config["legend_information"]
-ARA_2014_SWW = config["ARA_2014_SWW"]
-ARA_Einzugsgebiet_2014_SWW = config["ARA_Einzugsgebiet_2014_SWW"]
-Ang_Einwohner_ARA_am01012021 = config["Ang_Einwohner_ARA_am01012021"]
+geodata_cache_dir = args.cache_dir or default_cache_dir(config)
 
 color_map = config["color_map"]
 
 blacklist = []
 
-df_lollipop = pd.read_csv(deconvolution, sep="\t",)
-
-df_lollipop['date'] = pd.to_datetime(df_lollipop['date'])
-df_lollipop = df_lollipop.rename(columns={"location": "ARA_Name"})
+# weekly (7-day window) mean proportions for every date, cached by input hash (see variant_aggregates.py)
+df_rolling = rolling_fractions(deconvolution, window_days=7, cache_dir=aggregates_cache_dir(config))
 
-most_recent = max(df_lollipop['date'])
+most_recent = df_rolling['date'].max()
 print(most_recent)
-df_lollipop.head()
+if args.start is not None and args.end is None and pd.to_datetime(args.start) > most_recent:
+    parser.error(f"--start must not be after the most recent date ({most_recent.date()})")
 
 week_before = most_recent - pd.DateOffset(days=7)
 
@@ -78,15 +130,16 @@ week_before = most_recent - pd.DateOffset(days=7)
 #df_week = df_lollipop[(df_lollipop['date'] >= week_before) | (df_lollipop['date'] >= week_before_basel)]
 #####
 
-df_week = df_lollipop[df_lollipop['date'] >= week_before]
-df_week = pd.DataFrame(df_week.groupby(['ARA_Name', 'variant'])['proportion'].agg('mean'))
-#df_week.reset_index()
+
+def weekly_fractions(week_end):
+    """Mean proportion per (ARA_Name, variant) over the week (7 days) up to week_end."""
+    return fractions_at(df_rolling, week_end).rename_axis(index={"location": "ARA_Name"})
+
 
 ## name for the file
 file_out_name = most_recent
 
-df_week = df_week.rename(columns={"proportion": "fraction"})
-df_fractions = df_week
+df_fractions = weekly_fractions(most_recent)
 
 print(f"Most recent: {most_recent}")
 print(f"Week before: {week_before}")
@@ -94,19 +147,13 @@ print(f"Week before: {week_before}")
 ################################ Read Data ################################
 #Obtained from https://github.com/interactivethings/swiss-maps and https://simplemaps.com/data/ch-cities
 
-#switzerland
-print("switzerland")
-df_switzerland = gpd.read_file(switzerland_file)
-df_switzerland.set_crs(epsg=4326, inplace=True)
-
-df_switzerland.head()
-
-#kantons_file
-print("kantons")
-df_kantons = gpd.read_file(kantons_file)
-df_kantons.set_crs(epsg=4326, inplace=True)
-
-df_kantons.head()
+# Boundaries, lakes and the tracked catchment areas (already re-projected, with centroids and
+# population) come from the cached bundle, see map_geodata.py
+bundle = load_bundle(config, geodata_cache_dir)
+df_switzerland = bundle["switzerland"]
+df_kantons = bundle["kantons"]
+df_lakes = bundle["lakes"]
+df_ca = bundle["catchments"]
 
 #swiss_cities
 print("swiss_cities")
@@ -118,20 +165,6 @@ df_cities.set_crs(epsg=4326, inplace=True)
 
 df_cities.head()
 
-#swiss_lakes
-print("swiss_lakes")
-df_lakes = gpd.read_file(swiss_lakes)
-df_lakes.set_crs(epsg=4326, inplace=True)
-
-df_lakes.head()
-
-#swiss_municipalities
-print("swiss_municipalities")
-df_munci = gpd.read_file(swiss_municipalities)
-df_munci.set_crs(epsg=4326, inplace=True)
-
-df_munci.head()
-
 #wastewater_plants
 print("wastewater_plants")
 tmp = pd.read_csv(wastewater_plants)
@@ -152,53 +185,11 @@ for col in df_legend.columns:
 
 print(df_legend)
 
-################################ Wastewater Catchment Areas ################################
-################################ Read geographic data
-print("ARA_2014_SWW")
-df_ww = gpd.read_file(ARA_2014_SWW)
-df_ww.to_crs(epsg=4326, inplace=True)
-df_ww.head()
-
-# Einzugsgebiet
-print("Einzugsgebiet")
-df_ca = gpd.read_file(ARA_Einzugsgebiet_2014_SWW)
-df_ca.to_crs(epsg=4326, inplace=True)
-df_ca.head()
-
-################################ Read "numeric" data
-print("Ang_Einwohner_ARA_am01012021")
-df_pop = pd.read_excel(Ang_Einwohner_ARA_am01012021)
-df_pop["ARANAME"].replace(
-    {
-        "SENSETAL (LAUPEN)": "LAUPEN(SENSETAL)",
-        "Thal - Altenrhein": "THAL/ALTENRHEIN",
-        "Chur": "CHUR",
-        "BIOGGIO (LUGANO)": "BIOGGIO(LUGANO)",
-    },
-    inplace=True,
-)
-df_pop.set_index("ARANAME", inplace=True)
-df_pop.head()
-
 ################################ Select relevant CAs
-# IMPROVE: This is a hardcoded list of tracked ARAs. As soon as this changes we will have to change the script. An improvement is to move this to the config
-selected_ca_list = [
-    #'ARA REGION BERN AG',
-    #'PORRENTRUY(SEPE)',
-    'BASEL',
-    #'SCHWYZ', 
-    'LAUPEN(SENSETAL)',
-    #'LAUSANNE',
-    #'NEUCHATEL',
-    #'ZUCHWIL(SOLOTH.-EMME)',
-    #'EMMEN(BUHOLZ)',
-    #'THAL/ALTENRHEIN',
-    'ZUERICH(WERDHOELZLI)',
-    'CHUR',
-    'BIOGGIO(LUGANO)',
-    'VERNIER/AIRE',
-    #'SIERRE/NOES',
-]
+# catchments drawn on the map (ARA_Name of the catchment shapefile, or "all" for every catchment with data)
+selected_ca_list = config["map_catchments"]
+# pie chart offsets from the catchment centroid (default: none)
+offsets = {name: tuple(offset) for name, offset in config.get("map_inset_offsets", {}).items()}
 
 ################################ Create plot ################################
 Ara_shortnames_dict = config["ara_shortnames"]
@@ -208,122 +199,190 @@ print(Ara_shortnames_dict)
 Ara_shortnames_dict_english = config["ara_shortnames_english"]
 print(Ara_shortnames_dict_english)
 
-offsets = {'ARA REGION BERN AG': (0,-0.15),
- 'PORRENTRUY(SEPE)': (-0.6,0),
- 'BASEL': (0.02,0),
- 'SCHWYZ': (0,0),
- 'LAUPEN(SENSETAL)': (-0.35,-0.3),
- 'LAUSANNE': (-0.6,0),
- 'NEUCHATEL': (-0.55,0),
- 'ZUCHWIL(SOLOTH.-EMME)': (0,0),
- 'EMMEN(BUHOLZ)': (-0.3,-0.3),
- 'THAL/ALTENRHEIN': (0,0),
- 'ZUERICH(WERDHOELZLI)': (0.05,0),
- 'CHUR': (0,0),
- 'BIOGGIO(LUGANO)': (0.05,0),
- 'VERNIER/AIRE': (0.1,-0.1)}
- 
+x_dodge = 0.3
+y_dodge = 0.1
+inset_size = 0.1
+
+
+def inset_table(df_ca, df_fractions):
+    """
+    One row per (selected catchment, variant): catchment attributes, pie position and size, and the fraction.
+
+    Built with a single merge of the catchment table and the fractions; rows are grouped by catchment
+    in catchment order, variants in the order of df_fractions.
+    """
+    catchments = pd.DataFrame(df_ca.drop(columns="geometry"))
+    catchments["location"] = catchments["ARA_Name"].map(Ara_shortnames_dict)
+    catchments = catchments[catchments["location"].notna() & ~catchments["location"].isin(blacklist)]
+    catchments["location_english"] = catchments["location"].map(Ara_shortnames_dict_english).fillna(catchments["location"])
+
+    offset = catchments["ARA_Name"].map(lambda name: offsets.get(name, (0, 0)))
+    catchments["x_pos"] = catchments["centroid_x"] + offset.str[0]
+    catchments["y_pos"] = catchments["centroid_y"] + offset.str[1]
+    catchments["inset_size_scaled"] = (inset_size * catchments["population"] / catchments["population_max"]) ** (1 / 4)
+
+    table = catchments.merge(df_fractions.reset_index().rename(columns={"ARA_Name": "location"}), on="location", how="inner")
+    missing = sorted(set(catchments["ARA_Name"]) - set(table["ARA_Name"]))
+    if missing:
+        print(f"[WARN] no variant fractions for catchments: {', '.join(missing)}")
+    no_population = sorted(table.loc[table["population"].isna(), "ARA_Name"].unique())
+    if no_population:
+        print(f"[WARN] no population for catchments: {', '.join(no_population)}")
+    return table[table["population"].notna()]
+
+
+def draw_insets(ax, table):
+    """Population-scaled variant fraction pie charts, one per catchment of the inset table."""
+    axes_in = []
+    for _, rows in table.groupby("ARA_Name", sort=False):
+        row = rows.iloc[0]
+        # variant fraction pie charts
+        ax_in = ax.inset_axes(
+            [
+                row.x_pos - row.inset_size_scaled / 2 + x_dodge,
+                row.y_pos - row.inset_size_scaled / 2,
+                row.inset_size_scaled,
+                row.inset_size_scaled,
+            ],
+            transform=ax.transData,
+        )
+        ax_in.pie(rows["fraction"], colors=[color_map[variant] for variant in rows["variant"]])
+
+        ax_in.set_title(
+            f"{row.location_english}\nPop. {round(row.population/1000)}K",
+            fontsize=12,
+            pad=-2,
+            y=1.000001,
+            path_effects=[PathEffects.withStroke(linewidth=5, foreground="w")],
+        )
+
+        ax_in.axis("off")
+        ax_in.set_aspect("equal")
+
+        axes_in.append(ax_in)
+    return axes_in
+
+
 x = 0.05
-filtered_df = df_fractions.groupby('variant').filter(lambda group: group['fraction'].sum() > x)
+filtered_df = df_fractions[df_fractions.groupby('variant')['fraction'].transform('sum') > x]
 
 # MAKE PLOT
 
-s = 8
-fig, ax = plt.subplots(figsize=(1.5 * s, s))
+def draw_map(df_fractions):
+    """Map of the weekly variant fractions; the basemap layers and catchments are shared by all frames."""
+    s = 8
+    fig, ax = plt.subplots(figsize=(1.5 * s, s))
 
-# plot features
-df_kantons.boundary.plot(ax=ax, color="grey", alpha=0.2)
-df_switzerland.boundary.plot(ax=ax, color="black")
-df_lakes.plot(ax=ax, alpha=0.2)
+    # plot features
+    df_kantons.boundary.plot(ax=ax, color="grey", alpha=0.2)
+    df_switzerland.boundary.plot(ax=ax, color="black")
+    df_lakes.plot(ax=ax, alpha=0.2)
 
-df_ca_sel = df_ca[df_ca["ARA_Name"].isin(selected_ca_list)]
-df_ca_sel.plot(ax=ax, color="#333333", alpha=0.25)
-df_ca_sel.boundary.plot(ax=ax, color="#222222", alpha=0.4)
+    if selected_ca_list == "all":
+        df_ca_sel = df_ca[df_ca["ARA_Name"].map(Ara_shortnames_dict).isin(df_fractions.index.get_level_values("ARA_Name"))]
+    else:
+        df_ca_sel = df_ca[df_ca["ARA_Name"].isin(selected_ca_list)]
+    df_ca_sel.plot(ax=ax, color="#333333", alpha=0.25)
+    df_ca_sel.boundary.plot(ax=ax, color="#222222", alpha=0.4)
 
-axes_in = []
+    axes_in = draw_insets(ax, inset_table(df_ca_sel, df_fractions))
 
-x_dodge = 0.3
-y_dodge = 0.1
-inset_size = 0.1
-for row in df_ca_sel.itertuples():
-    if Ara_shortnames_dict[row.ARA_Name] in blacklist:
-        continue
-#     pop_size = df_pop.loc[row.ARA_Name].EINWOHNER
-    pop_size = df_pop[df_pop.ARANR == row.ARA_Nr].EINWOHNER.values[0]
-    inset_size_scaled = (inset_size * pop_size / df_pop["EINWOHNER"].max()) ** (1 / 4)
-
-    x_pos = row.geometry.centroid.x + offsets[row.ARA_Name][0]
-    y_pos = row.geometry.centroid.y + offsets[row.ARA_Name][1]
-
-    # variant fraction pie charts
-    ax_in = ax.inset_axes(
-        [
-            x_pos - inset_size_scaled / 2 + x_dodge,
-            y_pos - inset_size_scaled / 2,
-            inset_size_scaled,
-            inset_size_scaled,
-        ],
-        transform=ax.transData,
-    )
-    df_fractions.loc[Ara_shortnames_dict[row.ARA_Name]].plot(
-        ax=ax_in,
-        kind="pie",
-        y="fraction",
-        labels=None,
-        legend=False,
-        colors=[color_map[variant] for variant in df_fractions.loc[Ara_shortnames_dict[row.ARA_Name]].index],
-    )
 
-    ax_in.set_title(
-        f"{Ara_shortnames_dict_english[Ara_shortnames_dict[row.ARA_Name]]}\nPop. {round(pop_size/1000)}K",
-        fontsize=12,
-        pad=-2,
-        y=1.000001,
-        path_effects=[PathEffects.withStroke(linewidth=5, foreground="w")],
-    )
+    #  variant legend
+    variants_presence = df_fractions.reset_index().groupby(["variant"])['fraction'].agg('max')
+
+    # minimum presence of variant to be addded to the legend
+    min_pres = 0.001
+    variants_presence = variants_presence.loc[lambda x : x > min_pres]
+    legend_colors = {key: color_map[key] for key in variants_presence.index}
+
+    #### Create sorting list to sort legend labels according to mean frequency
+    # Reset index if 'variant' and 'ARA_Name' are in the index
+    df_avg = df_fractions.reset_index()
+    # Group by variant, average the fractions
+    variant_avg = df_avg.groupby('variant')['fraction'].mean()
+    # Sort the variants by average fraction
+    sorted_variants = variant_avg.sort_values(ascending=False).index.tolist()
+    filtered_sorted_variants = [v for v in sorted_variants if v in legend_colors]
 
-    ax_in.axis("off")
-    ax_in.set_aspect("equal")
-    
-    axes_in.append(ax_in)
-   
-
-#  variant legend
-variants_presence = df_fractions.reset_index().groupby(["variant"])['fraction'].agg('max')
-
-# minimum presence of variant to be addded to the legend
-min_pres = 0.001
-variants_presence = variants_presence.loc[lambda x : x > min_pres]
-color_map = {key: color_map[key] for key in variants_presence.index}
-
-#### Create sorting list to sort legend labels according to mean frequency
-# Reset index if 'variant' and 'ARA_Name' are in the index
-df_avg = df_fractions.reset_index()
-# Group by variant, average the fractions
-variant_avg = df_avg.groupby('variant')['fraction'].mean()
-# Sort the variants by average fraction
-sorted_variants = variant_avg.sort_values(ascending=False).index.tolist()
-filtered_sorted_variants = [v for v in sorted_variants if v in color_map]
-
-
-ax.legend(
-    handles=[
-        Patch(facecolor=color_map[variant], edgecolor=color_map[variant], label=variant)
-        for variant in filtered_sorted_variants if variant in color_map
-    ],
-    bbox_to_anchor=(1.04, .7),
-    loc="upper left",
-    title="Variant",
-    title_fontsize=12,
-    fontsize=11,
-    frameon=False,
-)
 
-# finalize axis
-ax.axis("off")
+    ax.legend(
+        handles=[
+            Patch(facecolor=legend_colors[variant], edgecolor=legend_colors[variant], label=variant)
+            for variant in filtered_sorted_variants if variant in legend_colors
+        ],
+        bbox_to_anchor=(1.04, .7),
+        loc="upper left",
+        title="Variant",
+        title_fontsize=12,
+        fontsize=11,
+        frameon=False,
+    )
 
-# save plot
-fig.tight_layout()
+    # finalize axis
+    ax.axis("off")
+
+    # save plot
+    fig.tight_layout()
+    return fig
+
+
+################################ Weekly history (frames) ################################
+
+def render_frame(week_end):
+    """Render the map of the week ending at week_end in every requested format (frame worker)."""
+    fig = draw_map(weekly_fractions(week_end))
+    paths = save_formats(fig, os.path.join(frames_dir, f"SwissMap_{week_end.strftime('%Y-%m-%d')}"), frame_formats, workers=1)
+    plt.close(fig)
+    return paths
+
+
+def animate_frames(png_frames, output_path, fps):
+    """Assemble same-sized PNG frames into a GIF (pillow) or MP4 (ffmpeg) animation, one frame in memory at a time."""
+    first = plt.imread(png_frames[0])
+    height, width = first.shape[:2]
+    dpi = 100
+    anim_fig = plt.figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    anim_ax = anim_fig.add_axes([0, 0, 1, 1])
+    anim_ax.axis("off")
+    image = anim_ax.imshow(first)
+
+    writer = PillowWriter(fps=fps) if output_path.endswith(".gif") else FFMpegWriter(fps=fps)
+    with writer.saving(anim_fig, output_path, dpi):
+        for path in png_frames:
+            image.set_data(plt.imread(path))
+            writer.grab_frame()
+    plt.close(anim_fig)
+    print(f"Animation written to {output_path}")
+
+
+def render_frames():
+    """One map per week from --start to --end, rendered in parallel, plus the optional animations."""
+    last = pd.to_datetime(args.end) if args.end else most_recent
+    # week ends counted back from the last one, so that the most recent map is always a frame
+    week_ends = []
+    week_end = last
+    while week_end >= pd.to_datetime(args.start):
+        week_ends.insert(0, week_end)
+        week_end = week_end - pd.DateOffset(days=args.step_days)
+    print(f"Rendering {len(week_ends)} frames from {week_ends[0].date()} to {week_ends[-1].date()} into {frames_dir}")
+
+    os.makedirs(frames_dir, exist_ok=True)
+    if args.frame_workers > 1 and len(week_ends) > 1:
+        # frames are forked from this process: the loaded data and basemap layers are shared, not reloaded
+        with ProcessPoolExecutor(max_workers=args.frame_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            frame_paths = list(pool.map(render_frame, week_ends))
+    else:
+        frame_paths = [render_frame(week_end) for week_end in week_ends]
+
+    png_frames = [path for paths in frame_paths for path in paths if path.endswith(".png")]
+    for fmt in args.animate:
+        animate_frames(png_frames, os.path.join(plots_dir, f"SwissMap_{week_ends[0].strftime('%Y-%m-%d')}_{week_ends[-1].strftime('%Y-%m-%d')}.{fmt}"), args.fps)
+
+
+frames_dir = os.path.join(plots_dir, "SwissMap_frames")
+# animations are assembled from the PNG frames
+frame_formats = list(args.formats) + (["png"] if args.animate and "png" not in args.formats else [])
 
 # Suppose `most_recent` is a pandas.Timestamp or datetime.datetime
 safe_stamp = most_recent.strftime('%Y-%m-%d_%H%M%S')
@@ -333,7 +392,8 @@ safe_stamp = most_recent.strftime('%Y-%m-%d_%H%M%S')
 #fig.savefig("plots/SwissMap_{}.svg".format(file_out_name))
 
 # Save figures with correct path
-fig.savefig(os.path.join(plots_dir, f"SwissMap_{safe_stamp}.png"))
-fig.savefig(os.path.join(plots_dir, f"SwissMap_{safe_stamp}.svg"))
-
-fig.savefig(os.path.join(plots_dir, f"SwissMap_{safe_stamp}.pdf"))
+if args.start is None:
+    fig = draw_map(df_fractions)
+    save_formats(fig, os.path.join(plots_dir, f"SwissMap_{safe_stamp}"), args.formats)
+else:
+    render_frames()
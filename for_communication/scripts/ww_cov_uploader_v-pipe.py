@@ -14,10 +14,6 @@ Maintainer:
     - Kyra Kirschenbuehler (@kirschen-k)
 """
 
-import gzip
-import shutil
-import hashlib
-import subprocess
 import numpy as np
 import seaborn as sns
 import pandas as pd
@@ -30,9 +26,16 @@ import os
 import sys
 import netrc
 import psycopg2
+import requests
 import argparse
 from copy import deepcopy
 
+import lollipop_json
+from covspectrum_upload import upsert_wastewater_results
+from gzip_stream import gzip_file
+from http_upload import make_session, post_multipart, upload_files
+from upload_manifest import UploadManifest, compute_sha256, file_stamp, series_key, sha256_text
+
 
 ################################ Globals ################################
 
@@ -43,6 +46,11 @@ parser.add_argument(
     type=str, 
     help="Path to the YAML configuration file"
 )
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Upload every series and file, even if identical to the last successful upload in the manifest"
+)
 args = parser.parse_args()
 
 # Load YAML config from the input argument
@@ -60,6 +68,14 @@ upload_covspectrum=config["upload_covspectrum"]
 upload_wisedb=config["upload_wisedb"]
 upload_polybox=config["upload_polybox"]
 
+# SHA-256 of the last successfully uploaded payload per target and series/file: only changes are sent
+manifest_file = config.get("upload_manifest", os.path.join(config["outdir"], "upload_manifest.json"))
+manifest = UploadManifest.load(manifest_file, force=args.force)
+
+# HTTP uploads (WiseDB, Polybox) share one pooled session; files are uploaded concurrently
+upload_workers = config.get("upload_workers", 4)
+http_session = make_session(pool_size=upload_workers)
+
 ################################  Upload to Cov-Spectrum ################################
 print("Response Cov-Spectrum:")
 #IMPROVE: This is hardcoded and can be moved to the config as an improvement
@@ -79,42 +95,34 @@ if upload_covspectrum == True:
         password=dbpass,
         port="5432",
     )
-    cur = dbconn.cursor()
-
-    with open(update_data_covspectrum_file, "r") as f:
-        update_data_for_cov_spectrum = json.load(f)
-    
-    locations = sorted(list(update_data_for_cov_spectrum.keys()))
-    variants = sorted(
-        list({v for loc_data in update_data_for_cov_spectrum.values() for v in loc_data.keys()})
-    )
-
-    for loc in tqdm(locations, desc="Locations", position=0):
-        for pango in tqdm(variants, desc=loc, position=1, leave=True):
-            cur.execute(
-                """
-                DO $$
-                BEGIN
-                IF EXISTS (SELECT ww.data FROM public.wastewater_result AS ww WHERE ww.variant_name=%(var)s AND ww.location=%(city)s) THEN
-                UPDATE public.wastewater_result AS ww SET data=%(data)s WHERE ww.variant_name=%(var)s AND ww.location=%(city)s;
-                ELSE
-                INSERT INTO public.wastewater_result (variant_name, location, data)
-                VALUES(%(var)s, %(city)s, %(data)s);
-                END IF;
-                END
-                $$
-                """,
-                {
-                    "data": json.dumps(update_data_for_cov_spectrum[loc][pango]).replace("NaN", "null"),
-                    "var": pango,
-                    "city": loc,
-                },
-            )
+    # all series are staged with one COPY and applied set-based (see covspectrum_upload.py);
+    # series whose stored payload is identical are left untouched
+    # series identical to the last successful upload are not sent at all
+    pending = {}
+    skipped = 0
+
+    def changed_records():
+        global skipped
+        for loc, pango, vdata in lollipop_json.iter_variants(update_data_covspectrum_file):
+            if pango is None:
+                continue
+            payload = lollipop_json.dumps(vdata)
+            key, digest = series_key(loc, pango), sha256_text(payload)
+            if not manifest.changed("covspectrum", key, digest):
+                skipped += 1
+                continue
+            pending[key] = digest
+            yield loc, pango, payload
+
+    counts = upsert_wastewater_results(dbconn, changed_records())
 
     ## Save to DB !
     dbconn.commit()
+    for key, digest in pending.items():
+        manifest.record("covspectrum", key, digest)
+    manifest.save()
+    print(f"inserted: {counts['inserted']}, updated: {counts['updated']}, unchanged: {counts['unchanged']}, skipped (manifest): {skipped}")
 
-    cur.close()
     dbconn.close()
 
 
@@ -126,61 +134,80 @@ if upload_wisedb == True :
     checksum_file = config["WiseDB_checksum_file"]
     url = config["WiseDB_url"]
 
-    # gz compress the curves json file. --best is required for it to be compliant with 
-    with open(input_file, 'rb') as f_in, gzip.open(output_file, 'wb', compresslevel=9) as f_out:
-        shutil.copyfileobj(f_in, f_out)
-
-    # md5 checksum of the zipped file. wisedb will test to ensure the correct file is uploaded
-    def compute_sha256(file_path, chunk_size=8192):
-        sha256 = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(chunk_size), b""):
-                sha256.update(chunk)
-        return sha256.hexdigest()
-
-    checksum = compute_sha256(output_file)
-    with open(checksum_file, 'w') as f:
-        f.write(checksum + '\n')
-
-    dbhost = (
-        "wisedb"
-    )
-    # load from netrc
-    dbuser, token = netrc.netrc().authenticators(dbhost)[0::2] # add the login for covspetrum as an element in the .netrc
-
-    # upload
-    curl_command = [
-        "curl",
-        url,
-        "-H", f"Authorization: Token {token}",
-        "-F", f"checksums={checksum}",
-        "-F", f"files=@{output_file}"
-    ]
-
-    result = subprocess.run(curl_command, capture_output=True, text=True)
-
-    print("Response wiseDB:")
-    print(result.stdout)
-    if result.stderr:
-        print(result.stderr)
+    # same size and mtime as at the last upload: skipped without reading the input
+    input_stamp = file_stamp(input_file)
+    if manifest.file_unchanged("wisedb", input_file, input_stamp):
+        print(f"Response wiseDB: {input_file} unchanged since last upload, skipped")
+    else:
+        # gz compress the curves json file. --best is required for it to be compliant with 
+        # the sha256 checksum of the zipped file is computed while writing it. wisedb will test to ensure the correct file is uploaded
+        # the sha256 of the uncompressed input (for the manifest) is computed in the same read
+        checksum, _, input_checksum = gzip_file(input_file, output_file, level=9, threads=config.get("WiseDB_gzip_threads", 1))
+        with open(checksum_file, 'w') as f:
+            f.write(checksum + '\n')
+
+        if not manifest.changed("wisedb", input_file, input_checksum):
+            # rewritten with the same content: not sent again, the new stamp spares the read next time
+            print(f"Response wiseDB: {input_file} unchanged since last upload, skipped")
+            manifest.record_file("wisedb", input_file, input_checksum, input_stamp)
+            manifest.save()
+        else:
+            dbhost = (
+                "wisedb"
+            )
+            # load from netrc
+            dbuser, token = netrc.netrc().authenticators(dbhost)[0::2] # add the login for covspetrum as an element in the .netrc
+
+            # upload (multipart form, the gz file is streamed from disk)
+            print("Response wiseDB:")
+            try:
+                response = post_multipart(
+                    http_session,
+                    url,
+                    fields={"checksums": checksum},
+                    files={"files": output_file},
+                    headers={"Authorization": f"Token {token}"},
+                )
+            except requests.RequestException as e:
+                print(e)
+                if e.response is not None:
+                    print(e.response.text)
+            else:
+                print(response.text)
+                manifest.record_file("wisedb", input_file, input_checksum, input_stamp)
+                manifest.save()
 
 
 ################################ Upload to FOPH/BAG's Polybox ################################
 print("Response Polybox:")
 if upload_polybox == True:
-        
-    polybox_url = config["FOPH_BAG_polybox_url"]
 
-    subprocess.run([
-        "curl", "--netrc", "--upload-file", update_data_combined_file, polybox_url
-    ])
-    subprocess.run([
-        "curl", "--netrc", "--upload-file", reformatted, polybox_url
-    ])
-
-    ################################ Upload to Public Polybox folder ################################
-    polybox_url = config["Public_polybox_url"]
+    # (file, folder) pairs; files unchanged since the last successful upload to a folder are skipped
+    polybox_uploads = [
+        (update_data_combined_file, config["FOPH_BAG_polybox_url"]),
+        (reformatted, config["FOPH_BAG_polybox_url"]),
+        ################################ Upload to Public Polybox folder ################################
+        (update_data_combined_file, config["Public_polybox_url"]),
+    ]
 
-    subprocess.run([
-        "curl", "--netrc", "--upload-file", update_data_combined_file, polybox_url
-    ])
+    # a file is only hashed when its size or mtime changed since the last upload, and then once for all folders
+    stamps = {file_path: file_stamp(file_path) for file_path, _ in polybox_uploads}
+    file_checksums = {}
+    checksums = {}
+    for file_path, polybox_url in polybox_uploads:
+        target = f"polybox:{polybox_url}"
+        if not manifest.file_unchanged(target, file_path, stamps[file_path]):
+            if file_path not in file_checksums:
+                file_checksums[file_path] = compute_sha256(file_path)
+            checksum = file_checksums[file_path]
+            if manifest.changed(target, file_path, checksum):
+                checksums[(file_path, polybox_url)] = checksum
+                continue
+            manifest.record_file(target, file_path, checksum, stamps[file_path])
+        print(f"{os.path.basename(file_path)} unchanged since last upload to {polybox_url}, skipped")
+
+    results = upload_files(http_session, checksums.keys(), workers=upload_workers)
+    for (file_path, polybox_url), error in results.items():
+        if error is None:
+            manifest.record_file(f"polybox:{polybox_url}", file_path, checksums[(file_path, polybox_url)], stamps[file_path])
+    manifest.save()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Deduplicate the *Mutations_Dashboard.tsv files before the genspectrum upload
+
+Replaces the `tail | sort | uniq -d` and `sort | uniq` passes of run_uploader.sh:
+every file is streamed once, keeping the header and the first occurrence of
+every row in its original order (a set of 128-bit row digests tells whether a
+row was already seen). The number of duplicate rows and the first few
+duplicated rows are printed per file.
+
+The outputs go to <folder>/deduped/<name>_deduped.tsv as before. Which inputs
+were already deduplicated is recorded in <folder>/dedup_state.json by the
+SHA-256 of their content, so an input that changed is processed again. A
+deduped file that already exists without a state entry (written by the former
+shell version) is adopted as is.
+
+The folders are processed concurrently, one process per folder.
+
+USAGE:
+    python dedup_dashboards.py FOLDER [FOLDER ...] [--workers 6] [--show 20]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+STATE_VERSION = 1
+STATE_FILE = "dedup_state.json"
+PATTERN = "*Mutations_Dashboard.tsv"
+CHUNK = 1 << 20
+
+
+def sha256_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def dedup_file(path: str, output: str, show: int) -> Tuple[str, int, int, List[bytes]]:
+    """
+    Write the header and the first occurrence of every row of `path` to `output`.
+
+    Returns (SHA-256 of the input, rows written, duplicate rows dropped, first `show` distinct duplicated rows).
+    """
+    sha256 = hashlib.sha256()
+    seen = set()
+    reported = set()
+    shown: List[bytes] = []
+    rows = duplicates = 0
+
+    tmp_output = output + ".tmp"
+    with open(path, "rb") as src, open(tmp_output, "wb") as dst:
+        header = src.readline()
+        sha256.update(header)
+        if header:
+            # line endings are normalized to \n, for the header as for the rows
+            dst.write(header.rstrip(b"\r\n") + b"\n")
+        for line in src:
+            sha256.update(line)
+            row = line.rstrip(b"\r\n")
+            digest = hashlib.blake2b(row, digest_size=16).digest()
+            if digest in seen:
+                duplicates += 1
+                if len(shown) < show and digest not in reported:
+                    reported.add(digest)
+                    shown.append(row)
+                continue
+            seen.add(digest)
+            dst.write(row + b"\n")
+            rows += 1
+    os.replace(tmp_output, output)
+    return sha256.hexdigest(), rows, duplicates, shown
+
+
+def load_state(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        state = json.load(f)
+    if state.get("version") != STATE_VERSION:
+        return {}
+    return state.get("files", {})
+
+
+def save_state(path: str, files: Dict[str, Dict]):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"version": STATE_VERSION, "files": files}, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def dedup_folder(data_dir: str, show: int = 20) -> List[str]:
+    """Deduplicate the new or changed dashboard files of one folder; returns the log lines."""
+    log = [f"=== {data_dir} ==="]
+    if not os.path.isdir(data_dir):
+        return log + [f"Skipping: {data_dir} (does not exist)"]
+
+    dedup_dir = os.path.join(data_dir, "deduped")
+    os.makedirs(dedup_dir, exist_ok=True)
+    state_path = os.path.join(data_dir, STATE_FILE)
+    state = load_state(state_path)
+
+    for path in sorted(glob.glob(os.path.join(glob.escape(data_dir), PATTERN))):
+        filename = os.path.basename(path)
+        output = os.path.join(dedup_dir, f"{filename[:-len('.tsv')]}_deduped.tsv")
+        entry = state.get(filename)
+
+        if entry is not None or os.path.exists(output):
+            checksum = sha256_file(path)
+            if entry is None:
+                log.append(f"Adopting existing {output} (no state entry)")
+                state[filename] = {"sha256": checksum, "output": os.path.basename(output)}
+                continue
+            if entry.get("sha256") == checksum and os.path.exists(output):
+                log.append(f"Skipping: {filename} unchanged since it was deduplicated")
+                continue
+
+        checksum, rows, duplicates, shown = dedup_file(path, output, show)
+        state[filename] = {
+            "sha256": checksum,
+            "output": os.path.basename(output),
+            "rows": rows,
+            "duplicates": duplicates,
+        }
+        log.append(f"Duplicates in {filename}: {duplicates} row(s)")
+        log.extend("  " + row.decode("utf-8", "replace") for row in shown)
+        if duplicates and len(shown) == show:
+            log.append(f"  (first {show} distinct duplicated rows shown)")
+        log.append(f"Saved deduped ({rows} rows) to: {output}")
+        # after every file, so an interrupted run keeps what it finished
+        save_state(state_path, state)
+
+    save_state(state_path, state)
+    return log
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deduplicate Mutations_Dashboard.tsv files, keeping the row order.")
+    parser.add_argument("folders", nargs="+", help="MutationFrequencies folders")
+    parser.add_argument("--workers", type=int, default=None, help="Folders processed in parallel (default: one per folder)")
+    parser.add_argument("--show", type=int, default=20, help="Distinct duplicated rows printed per file (default: 20)")
+    args = parser.parse_args()
+
+    workers = args.workers or len(args.folders)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            logs = list(pool.map(dedup_folder, args.folders, [args.show] * len(args.folders)))
+    else:
+        logs = [dedup_folder(folder, args.show) for folder in args.folders]
+
+    for log in logs:
+        print("\n".join(log))
+    print("Deduplication done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,9 @@ folders=(
   "$IA_N2_folder"
 )
 
+# deduplicate the new or changed *Mutations_Dashboard.tsv files of all folders (in parallel, row order kept)
+python "$(dirname "$(readlink -f "$0")")/dedup_dashboards.py" "${folders[@]}"
+
 for data_dir in "${folders[@]}"; do
     # check if path exists
     if [[ ! -d "$data_dir" ]]; then
@@ -40,34 +43,6 @@ for data_dir in "${folders[@]}"; do
 
     dedup_data_dir="${data_dir}/deduped"
 
-    # Make sure the output folder exists
-    mkdir -p "$dedup_data_dir"
-
-    # for each file that has not yet been checked to contain duplicates, create a file in deduped folder
-    for file in "$data_dir"/*Mutations_Dashboard.tsv; do
-        if [[ ! -e "$file" ]]; then
-            continue
-        fi
-
-      filename=$(basename "$file")
-      deduped="$dedup_data_dir/${filename%.tsv}_deduped.tsv"
-
-      # Skip if output already exists
-      if [[ -f "$deduped" ]]; then
-        echo "Skipping: $deduped already exists"
-        continue
-      fi
-
-      # Print duplicate full lines (excluding header)
-      echo "Duplicates in $file:"
-      tail -n +2 "$file" | sort | uniq -d
-
-      # Write header + deduped content
-      { head -n 1 "$file"; tail -n +2 "$file" | sort | uniq; } > "$deduped"
-
-      echo "Saved deduped to: $deduped"
-    done
-
     # upload the deduplicated files
 
     #check if it is rsv or influenza
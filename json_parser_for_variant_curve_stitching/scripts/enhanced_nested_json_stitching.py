@@ -14,15 +14,33 @@ Additionally:
   (a shared date grid). Missing dates are filled with zeros:
     proportion=0, proportionLower=0, proportionUpper=0
 
+The default engine loads both files into the columnar CurveStore
+(for_communication/scripts/curve_store.py) and performs the stitch as array
+operations; `stitch_datasets` is kept as the reference implementation
+(`--engine reference`, or `--verify` to run both and compare the results).
+
+With `--incremental`, the frozen history before each location's stitch date
+is kept in a segmented store (`--store-dir`, see stitch_store.py); later runs
+only re-stitch the tail and copy the frozen prefix into the output unchanged.
+
 USAGE:
     python stitch_variants.py --old older.json --new smoothed.json --output stitched.json
 """
 
 import json
 import logging
+import os
+import sys
 from typing import Dict, Any, List, Set
 import argparse
 
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "for_communication", "scripts"))
+from curve_store import CurveStore, dates_to_days, days_to_dates  # noqa: E402
+from lollipop_json import write_nested  # noqa: E402
+from stitch_store import StitchStore, StoreMismatch, bootstrap, stitch_incremental  # noqa: E402
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -31,6 +49,9 @@ logging.basicConfig(
 
 ZERO_ROW = {"proportion": 0.0, "proportionLower": 0.0, "proportionUpper": 0.0}
 
+DAY_MIN = np.iinfo(np.int32).min
+DAY_MAX = np.iinfo(np.int32).max
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Stitch together two nested JSON files containing time series data by location and variant."
@@ -38,7 +59,32 @@ def parse_args():
     parser.add_argument("--old", required=True, help="Path to the older JSON file (contains earlier timepoints).")
     parser.add_argument("--new", required=True, help="Path to the newer JSON file (contains new or updated timepoints).")
     parser.add_argument("--output", required=True, help="Path to the output JSON file to write the stitched result.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--engine",
+        choices=["vectorized", "reference"],
+        default="vectorized",
+        help="Stitching implementation: array-based (default) or the original per-row reference.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Also run the reference implementation and fail if the results differ.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Re-stitch only the data past the per-location stitch dates, reusing the frozen history "
+             "from --store-dir. --old is only read when the store has to be (re)built.",
+    )
+    parser.add_argument(
+        "--store-dir",
+        help="Directory of the segmented history store used by --incremental "
+             "(default: 'stitch_store' next to the output file).",
+    )
+    args = parser.parse_args()
+    if args.incremental and args.verify:
+        parser.error("--verify cannot be combined with --incremental")
+    return args
 
 def setup_logging() -> None:
     logging.basicConfig(
@@ -53,10 +99,14 @@ def load_json(filepath: str) -> Dict[str, Any]:
         return json.load(f)
 
 def save_json(data: Dict[str, Any], output_path: str):
-    with open(output_path, "w") as f:
-        json.dump(data, f, separators=(",", ":"))
+    write_nested(data, output_path)
     logging.info(f"Saved stitched JSON to: {output_path}")
 
+def load_store(filepath: str) -> CurveStore:
+    """Stream a curves file straight into a (float64) columnar store."""
+    logging.info(f"Loading JSON from: {filepath}")
+    return CurveStore.load(filepath, value_dtype=np.float64)
+
 def determine_stitch_dates_per_location(new_data: Dict[str, Any]) -> Dict[str, str]:
     """Earliest date in NEW data for each location."""
     stitch_dates: Dict[str, str] = {}
@@ -74,6 +124,19 @@ def determine_stitch_dates_per_location(new_data: Dict[str, Any]) -> Dict[str, s
             logging.warning(f"{location} → no dates in NEW data; no stitch date computed.")
     return stitch_dates
 
+def determine_stitch_dates_from_store(new: CurveStore) -> Dict[str, str]:
+    """Same as `determine_stitch_dates_per_location`, on a columnar store."""
+    first_day = np.full(len(new.locations), DAY_MAX, dtype=np.int64)
+    np.minimum.at(first_day, new.series_location[new.row_series()], new.day)
+    stitch_dates: Dict[str, str] = {}
+    for location, day in zip(new.locations, first_day.tolist()):
+        if day != DAY_MAX:
+            stitch_dates[location] = days_to_dates([day])[0]
+            logging.info(f"{location} → stitch date: {stitch_dates[location]}")
+        else:
+            logging.warning(f"{location} → no dates in NEW data; no stitch date computed.")
+    return stitch_dates
+
 def index_by_date(ts: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
     """Map date -> row. Assumes dates should be unique (last wins if not).
     Convert a timeseriesSummary list into a dict keyed by date.
@@ -205,15 +268,226 @@ def stitch_datasets(
 
     return stitched_data
 
+# --------- VECTORIZED ENGINE ---------
+
+def _unify_codes(names: List[str], index: Dict[str, int], ordered: List[str]) -> np.ndarray:
+    """Map local name codes to codes in a shared name table (appending new names)."""
+    codes = np.empty(len(names), dtype=np.int64)
+    for i, name in enumerate(names):
+        if name not in index:
+            index[name] = len(ordered)
+            ordered.append(name)
+        codes[i] = index[name]
+    return codes
+
+def stitch_stores(old: CurveStore, new: CurveStore, stitch_dates: Dict[str, str]) -> CurveStore:
+    """
+    Array implementation of `stitch_datasets` on columnar stores.
+
+    Same rules as the reference:
+      - per location, OLD rows are kept only before the stitch date
+        (all of them if the location is absent from NEW, none of them if it is
+        present in NEW without a stitch date)
+      - NEW rows are always kept and win on duplicate dates (last row wins
+        within a file, as with `index_by_date`)
+      - every variant of a location is expanded to the union of all OLD and
+        NEW dates of that location, missing dates are zero-filled
+    Locations and variants are emitted in first-seen order (OLD, then NEW).
+    """
+    locations: List[str] = []
+    location_index: Dict[str, int] = {}
+    variants: List[str] = []
+    variant_index: Dict[str, int] = {}
+    old_loc = _unify_codes(old.locations, location_index, locations)
+    new_loc = _unify_codes(new.locations, location_index, locations)
+    old_var = _unify_codes(old.variants, variant_index, variants)
+    new_var = _unify_codes(new.variants, variant_index, variants)
+    n_var = max(len(variants), 1)
+
+    # per-location cutoff for OLD rows (day < cutoff is kept)
+    in_new = set(new.locations)
+    cutoff = np.empty(len(locations), dtype=np.int64)
+    for code, location in enumerate(locations):
+        stitch_date = stitch_dates.get(location)
+        if stitch_date is not None:
+            cutoff[code] = dates_to_days([stitch_date])[0]
+        elif location not in in_new:
+            cutoff[code] = DAY_MAX
+        else:
+            logging.warning(f"{location} → No stitch date; concatenating old+new without filtering.")
+            cutoff[code] = DAY_MIN
+
+    # series of each store, expressed in the shared codes
+    old_series_loc = old_loc[old.series_location]
+    new_series_loc = new_loc[new.series_location]
+    old_series_key = old_series_loc * n_var + old_var[old.series_variant]
+    new_series_key = new_series_loc * n_var + new_var[new.series_variant]
+
+    # output series: grouped by location, OLD variants first, then NEW-only ones
+    all_series_key = np.concatenate([old_series_key, new_series_key])
+    series_key, first_seen = np.unique(all_series_key, return_index=True)
+    order = np.lexsort((first_seen, series_key // n_var))
+    series_key = series_key[order]
+    out_series_loc = series_key // n_var
+    out_series_var = series_key % n_var
+
+    # rows of both stores, OLD rows filtered by the per-location cutoff
+    old_row_series = old.row_series()
+    new_row_series = new.row_series()
+    old_row_loc = old_series_loc[old_row_series]
+    new_row_loc = new_series_loc[new_row_series]
+    day_base = int(min(old.day.min(initial=0), new.day.min(initial=0)))
+
+    # shared date grid per location: union of all OLD and NEW dates
+    grid_key = np.unique(np.concatenate([
+        (old_row_loc << 32) + (old.day.astype(np.int64) - day_base),
+        (new_row_loc << 32) + (new.day.astype(np.int64) - day_base),
+    ]))
+    grid_loc = grid_key >> 32
+    grid_start = np.searchsorted(grid_loc, np.arange(len(locations)), side="left")
+    grid_len = np.searchsorted(grid_loc, np.arange(len(locations)), side="right") - grid_start
+
+    out_len = grid_len[out_series_loc]
+    out_offsets = np.zeros(len(series_key) + 1, dtype=np.int64)
+    np.cumsum(out_len, out=out_offsets[1:])
+    n_out = int(out_offsets[-1])
+    grid_index = np.arange(n_out) + np.repeat(grid_start[out_series_loc] - out_offsets[:-1], out_len)
+    out_day = ((grid_key[grid_index] & 0xFFFFFFFF) + day_base).astype(np.int32)
+
+    # merge: OLD (kept) then NEW, last occurrence per (series, date) wins
+    keep = old.day < cutoff[old_row_loc]
+    row_series_key = np.concatenate([old_series_key[old_row_series][keep], new_series_key[new_row_series]])
+    row_loc = np.concatenate([old_row_loc[keep], new_row_loc])
+    row_day = np.concatenate([old.day[keep], new.day]).astype(np.int64)
+    values = [
+        np.concatenate([old_arr[keep], new_arr]).astype(np.float64)
+        for old_arr, new_arr in ((old.proportion, new.proportion), (old.lower, new.lower), (old.upper, new.upper))
+    ]
+    row_key = row_series_key * (1 << 32) + (row_day - day_base)
+    _, last_reversed = np.unique(row_key[::-1], return_index=True)
+    last = len(row_key) - 1 - last_reversed
+
+    # position of each merged row in the output arrays
+    sorter = np.argsort(series_key)
+    out_series = sorter[np.searchsorted(series_key, row_series_key[last], sorter=sorter)]
+    grid_pos = np.searchsorted(grid_key, (row_loc[last] << 32) + (row_day[last] - day_base)) - grid_start[row_loc[last]]
+    position = out_offsets[out_series] + grid_pos
+
+    out_values = []
+    for arr in values:
+        out = np.zeros(n_out, dtype=np.float64)
+        out[position] = arr[last]
+        out_values.append(out)
+
+    return CurveStore(
+        locations=locations,
+        variants=variants,
+        series_location=out_series_loc.astype(np.int32),
+        series_variant=out_series_var.astype(np.int32),
+        offsets=out_offsets,
+        day=out_day,
+        proportion=out_values[0],
+        lower=out_values[1],
+        upper=out_values[2],
+    )
+
+def stitch_datasets_vectorized(
+    old_data: Dict[str, Any],
+    new_data: Dict[str, Any],
+    stitch_dates: Dict[str, str]
+) -> Dict[str, Any]:
+    """Drop-in replacement for `stitch_datasets` built on `stitch_stores`."""
+    old = CurveStore.from_dict(old_data, value_dtype=np.float64)
+    new = CurveStore.from_dict(new_data, value_dtype=np.float64)
+    return stitch_stores(old, new, stitch_dates).to_dict()
+
+def _same_value(a: Any, b: Any) -> bool:
+    """Value equality where null and NaN are the same missing value."""
+    a_missing = a is None or (isinstance(a, float) and a != a)
+    b_missing = b is None or (isinstance(b, float) and b != b)
+    if a_missing or b_missing:
+        return a_missing and b_missing
+    return a == b
+
+def compare_stitched(reference: Dict[str, Any], candidate: Dict[str, Any]) -> List[str]:
+    """List of differences between two stitched datasets (empty if equivalent)."""
+    problems: List[str] = []
+    for location in sorted(set(reference) | set(candidate)):
+        ref_variants = reference.get(location)
+        cand_variants = candidate.get(location)
+        if ref_variants is None or cand_variants is None:
+            problems.append(f"{location}: present only in {'candidate' if ref_variants is None else 'reference'}")
+            continue
+        for variant in sorted(set(ref_variants) | set(cand_variants)):
+            ref_ts = (ref_variants.get(variant) or {}).get("timeseriesSummary")
+            cand_ts = (cand_variants.get(variant) or {}).get("timeseriesSummary")
+            if ref_ts is None or cand_ts is None:
+                problems.append(f"{location} | {variant}: present only in {'candidate' if ref_ts is None else 'reference'}")
+                continue
+            if len(ref_ts) != len(cand_ts):
+                problems.append(f"{location} | {variant}: {len(ref_ts)} vs {len(cand_ts)} rows")
+                continue
+            for ref_row, cand_row in zip(ref_ts, cand_ts):
+                if ref_row["date"] != cand_row["date"] or not all(
+                    _same_value(ref_row.get(k), cand_row.get(k))
+                    for k in ("proportion", "proportionLower", "proportionUpper")
+                ):
+                    problems.append(f"{location} | {variant}: first difference at {ref_row['date']}")
+                    break
+    return problems
+
 # --------- MAIN EXECUTION ---------
 
 if __name__ == "__main__":
     setup_logging()
     args = parse_args()
 
+    if args.incremental:
+        store_dir = args.store_dir or os.path.join(os.path.dirname(os.path.abspath(args.output)), "stitch_store")
+        stitch_fn = stitch_datasets if args.engine == "reference" else stitch_datasets_vectorized
+        store = StitchStore(store_dir)
+        new_data = load_json(args.new)
+        stitch_dates = determine_stitch_dates_per_location(new_data)
+
+        if store.matches(args.old):
+            try:
+                stitch_incremental(store, new_data, stitch_dates, args.output, stitch_fn)
+                logging.info(f"Saved stitched JSON to: {args.output} (incremental, store: {store_dir})")
+                sys.exit(0)
+            except StoreMismatch as e:
+                logging.warning(f"{e}; rebuilding the store from {args.old}")
+        else:
+            logging.info(f"No checkpoint matching {args.old} in {store_dir}; building the store from it.")
+
+        stitched = stitch_fn(load_json(args.old), new_data, stitch_dates)
+        bootstrap(store, stitched, stitch_dates, args.output)
+        logging.info(f"Saved stitched JSON to: {args.output} (store initialized: {store_dir})")
+        sys.exit(0)
+
+    if args.engine == "vectorized" and not args.verify:
+        # streamed straight into columnar stores, no nested dicts in memory
+        old = load_store(args.old)
+        new = load_store(args.new)
+        stitch_stores(old, new, determine_stitch_dates_from_store(new)).save_json(args.output)
+        sys.exit(0)
+
     old_data = load_json(args.old)
     new_data = load_json(args.new)
     stitch_dates = determine_stitch_dates_per_location(new_data)
 
-    stitched = stitch_datasets(old_data, new_data, stitch_dates)
+    if args.engine == "reference":
+        stitched = stitch_datasets(old_data, new_data, stitch_dates)
+    else:
+        stitched = stitch_datasets_vectorized(old_data, new_data, stitch_dates)
+
+    if args.verify:
+        reference = stitched if args.engine == "reference" else stitch_datasets(old_data, new_data, stitch_dates)
+        candidate = stitched if args.engine == "vectorized" else stitch_datasets_vectorized(old_data, new_data, stitch_dates)
+        problems = compare_stitched(reference, candidate)
+        for problem in problems:
+            logging.error(f"Engine mismatch: {problem}")
+        if problems:
+            sys.exit(1)
+        logging.info("Vectorized and reference stitching results are identical.")
+
     save_json(stitched, args.output)
\ No newline at end of file
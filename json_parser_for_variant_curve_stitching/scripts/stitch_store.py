@@ -0,0 +1,353 @@
+"""
+Segmented on-disk store for incremental curve stitching
+
+Only the last weeks of the stitched curve change from one run to the next:
+everything before the stitch date of a location (the earliest date in the NEW
+lollipop output) is frozen history. The store keeps that history as ready-made
+JSON bytes so that an incremental run only re-stitches the tail and copies the
+frozen prefix into the output byte-for-byte.
+
+Layout of the store directory:
+
+    checkpoint.json             per-location checkpoint (see below)
+    loc_000/grid.json           prefix dates of the location (shared date grid)
+    loc_000/tail.json           {variant: [rows on or after the stitch date]}
+    loc_000/prefix/var_000.json serialized rows before the stitch date,
+                                exactly as they appear in the output file
+
+checkpoint.json records, per location, the stitch date (prefix = dates before
+it), the ordered variants with their segment file names and a SHA-256 of the
+frozen prefix. The hash is verified while the prefix is copied to the output;
+a mismatch (e.g. an interrupted run) discards the store and the next run
+bootstraps again from --old.
+
+A location falls back to a full re-stitch of its history (rebuilt from the
+store) when its NEW data reaches back before the checkpointed stitch date or
+has no dates at all.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from lollipop_json import dumps
+
+CHECKPOINT_FILE = "checkpoint.json"
+STORE_VERSION = 1
+FINGERPRINT_BYTES = 1 << 16
+COPY_CHUNK = 1 << 20
+
+StitchFn = Callable[[Dict[str, Any], Dict[str, Any], Dict[str, str]], Dict[str, Any]]
+
+
+class StoreMismatch(Exception):
+    """The segmented store does not match its checkpoint or the --old file."""
+
+
+def dump_compact(obj: Any) -> str:
+    return dumps(obj, separators=(",", ":"))
+
+
+def file_fingerprint(path: str) -> Dict[str, Any]:
+    """Size plus hash of the first and last 64 KiB: cheap identity check for --old."""
+    size = os.path.getsize(path)
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        sha.update(f.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f.seek(max(size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            sha.update(f.read())
+    return {"size": size, "sha256": sha.hexdigest()}
+
+
+def next_day(date: str) -> str:
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=1)).isoformat()
+
+
+def split_rows(rows: List[Dict[str, Any]], cut: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split date-sorted rows into (before cut, on or after cut)."""
+    i = 0
+    while i < len(rows) and rows[i]["date"] < cut:
+        i += 1
+    return rows[:i], rows[i:]
+
+
+def serialize_rows(rows: List[Dict[str, Any]]) -> str:
+    return ",".join(dump_compact(row) for row in rows)
+
+
+class StitchStore:
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.checkpoint: Optional[Dict[str, Any]] = None
+        path = os.path.join(store_dir, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("version") == STORE_VERSION:
+                self.checkpoint = checkpoint
+            else:
+                logging.warning(f"Ignoring checkpoint with unsupported version in {store_dir}")
+
+    # --------- paths ---------
+
+    def _loc_dir(self, entry: Dict[str, Any]) -> str:
+        return os.path.join(self.store_dir, entry["id"])
+
+    def _prefix_path(self, entry: Dict[str, Any], variant: str) -> str:
+        return os.path.join(self._loc_dir(entry), "prefix", entry["variants"][variant])
+
+    def _read_json(self, entry: Dict[str, Any], name: str) -> Any:
+        with open(os.path.join(self._loc_dir(entry), name), "r") as f:
+            return json.load(f)
+
+    def _write_json(self, entry: Dict[str, Any], name: str, data: Any):
+        path = os.path.join(self._loc_dir(entry), name)
+        with open(path + ".tmp", "w") as f:
+            f.write(dump_compact(data))
+        os.replace(path + ".tmp", path)
+
+    # --------- checkpoint ---------
+
+    def matches(self, old_path: str) -> bool:
+        """True if the checkpoint describes the file passed as --old."""
+        if self.checkpoint is None:
+            return False
+        return self.checkpoint.get("output") == file_fingerprint(old_path)
+
+    def reset(self):
+        if os.path.isdir(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        os.makedirs(self.store_dir)
+        self.checkpoint = {"version": STORE_VERSION, "output": None, "next_id": 0, "locations": {}}
+
+    def _new_entry(self, location: str) -> Dict[str, Any]:
+        entry = {"id": f"loc_{self.checkpoint['next_id']:03d}"}
+        self.checkpoint["next_id"] += 1
+        self.checkpoint["locations"][location] = entry
+        self._clear_entry(entry)
+        return entry
+
+    def _clear_entry(self, entry: Dict[str, Any]):
+        """Forget the frozen history of a location (keeps its id and position)."""
+        shutil.rmtree(self._loc_dir(entry), ignore_errors=True)
+        os.makedirs(os.path.join(self._loc_dir(entry), "prefix"))
+        entry.update({"stitch_date": None, "prefix_sha256": None, "variants": {}})
+
+    def _register_variant(self, entry: Dict[str, Any], variant: str):
+        if variant not in entry["variants"]:
+            entry["variants"][variant] = f"var_{len(entry['variants']):03d}.json"
+            open(self._prefix_path(entry, variant), "w").close()
+
+    def save_checkpoint(self, output_path: str):
+        self.checkpoint["output"] = file_fingerprint(output_path)
+        path = os.path.join(self.store_dir, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.checkpoint, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    # --------- history reconstruction ---------
+
+    def load_location(self, location: str) -> Dict[str, Any]:
+        """Full stitched history of one location (prefix + tail) as nested dict."""
+        entry = self.checkpoint["locations"][location]
+        tail = self._read_json(entry, "tail.json")
+        variants: Dict[str, Any] = {}
+        for variant in entry["variants"]:
+            with open(self._prefix_path(entry, variant), "r") as f:
+                prefix = json.loads("[" + f.read() + "]")
+            variants[variant] = {"timeseriesSummary": prefix + tail.get(variant, [])}
+        return variants
+
+
+def _location_cut(variants: Dict[str, Any], stitch_date: Optional[str]) -> str:
+    """Freeze everything before the stitch date, or all rows if there is none."""
+    if stitch_date is not None:
+        return stitch_date
+    dates = [row["date"] for vdata in variants.values() for row in vdata["timeseriesSummary"]]
+    return next_day(max(dates)) if dates else "0000-00-00"
+
+
+class _OutputWriter:
+    """Writes the nested curves JSON piece by piece, in the layout of `save_json`."""
+
+    def __init__(self, path: str):
+        self.f = open(path, "w")
+        self.f.write("{")
+        self.first_location = True
+
+    def begin_location(self, location: str):
+        self.f.write(("" if self.first_location else ",") + dump_compact(location) + ":{")
+        self.first_location = False
+        self.first_variant = True
+
+    def begin_variant(self, variant: str):
+        self.f.write(("" if self.first_variant else ",") + dump_compact(variant) + ':{"timeseriesSummary":[')
+        self.first_variant = False
+
+    def end_variant(self):
+        self.f.write("]}")
+
+    def end_location(self):
+        self.f.write("}")
+
+    def close(self):
+        self.f.write("}")
+        self.f.close()
+
+
+def _write_location(
+    store: StitchStore,
+    writer: _OutputWriter,
+    location: str,
+    entry: Dict[str, Any],
+    tail: Dict[str, List[Dict[str, Any]]],
+    cut: str,
+):
+    """
+    Emit one location: copy the frozen prefix of every variant, roll rows of
+    the tail that fall before the new cut into the prefix, write the rest as
+    the new tail and update the checkpoint hash.
+    """
+    old_sha = hashlib.sha256()
+    new_sha = hashlib.sha256()
+    known_variants = list(entry["variants"])
+    grid = store._read_json(entry, "grid.json") if known_variants else []
+
+    # rows that become frozen with the new cut, grid dates moving into the prefix
+    rolled: Dict[str, List[Dict[str, Any]]] = {}
+    new_tail: Dict[str, List[Dict[str, Any]]] = {}
+    for variant, rows in tail.items():
+        rolled[variant], new_tail[variant] = split_rows(rows, cut)
+    rolled_dates = sorted({row["date"] for rows in rolled.values() for row in rows})
+
+    writer.begin_location(location)
+    for variant in list(dict.fromkeys(known_variants + list(tail))):
+        writer.begin_variant(variant)
+        if variant in entry["variants"]:
+            prefix_path = store._prefix_path(entry, variant)
+            old_sha.update(variant.encode() + b"\0")
+            new_sha.update(variant.encode() + b"\0")
+            with open(prefix_path, "r") as f:
+                while True:
+                    chunk = f.read(COPY_CHUNK)
+                    if not chunk:
+                        break
+                    data = chunk.encode()
+                    old_sha.update(data)
+                    new_sha.update(data)
+                    writer.f.write(chunk)
+            old_sha.update(b"\0")
+            has_prefix = os.path.getsize(prefix_path) > 0
+        else:
+            # variant new to this location: zero rows over the frozen grid
+            store._register_variant(entry, variant)
+            prefix_path = store._prefix_path(entry, variant)
+            new_sha.update(variant.encode() + b"\0")
+            zeros = serialize_rows([
+                {"date": d, "proportion": 0.0, "proportionLower": 0.0, "proportionUpper": 0.0} for d in grid
+            ])
+            new_sha.update(zeros.encode())
+            writer.f.write(zeros)
+            with open(prefix_path, "a") as f:
+                f.write(zeros)
+            has_prefix = bool(zeros)
+
+        appended = serialize_rows(rolled.get(variant, []))
+        if appended:
+            appended = ("," if has_prefix else "") + appended
+            with open(prefix_path, "a") as f:
+                f.write(appended)
+            new_sha.update(appended.encode())
+            writer.f.write(appended)
+            has_prefix = True
+        new_sha.update(b"\0")
+
+        tail_rows = serialize_rows(new_tail.get(variant, []))
+        if tail_rows:
+            writer.f.write(("," if has_prefix else "") + tail_rows)
+        writer.end_variant()
+    writer.end_location()
+
+    if entry["prefix_sha256"] is not None and old_sha.hexdigest() != entry["prefix_sha256"]:
+        raise StoreMismatch(f"{location} → frozen history does not match its checkpoint hash")
+
+    if rolled_dates:
+        store._write_json(entry, "grid.json", grid + rolled_dates)
+    elif not known_variants:
+        store._write_json(entry, "grid.json", grid)
+    store._write_json(entry, "tail.json", new_tail)
+    entry["stitch_date"] = cut
+    entry["prefix_sha256"] = new_sha.hexdigest()
+
+
+def bootstrap(
+    store: StitchStore,
+    stitched: Dict[str, Any],
+    stitch_dates: Dict[str, str],
+    output_path: str,
+):
+    """Write a full stitched result and seed the store from it."""
+    store.reset()
+    writer = _OutputWriter(output_path)
+    for location, variants in stitched.items():
+        entry = store._new_entry(location)
+        tail = {variant: (vdata or {}).get("timeseriesSummary", []) for variant, vdata in variants.items()}
+        cut = _location_cut(variants, stitch_dates.get(location))
+        _write_location(store, writer, location, entry, tail, cut)
+        logging.info(f"{location} → frozen history before {cut}")
+    writer.close()
+    store.save_checkpoint(output_path)
+
+
+def stitch_incremental(
+    store: StitchStore,
+    new_data: Dict[str, Any],
+    stitch_dates: Dict[str, str],
+    output_path: str,
+    stitch_fn: StitchFn,
+):
+    """Re-stitch only the tail of each location and reuse the frozen prefix."""
+    locations = store.checkpoint["locations"]
+    writer = _OutputWriter(output_path)
+    try:
+        for location in list(dict.fromkeys(list(locations) + list(new_data))):
+            stitch_date = stitch_dates.get(location)
+            entry = locations.get(location)
+
+            if entry is None:
+                logging.info(f"{location} → NEW location; stitching from NEW data only.")
+                entry = store._new_entry(location)
+                stitched = stitch_fn({}, {location: new_data[location]}, stitch_dates)[location]
+            elif location not in new_data:
+                logging.info(f"{location} → Present only in OLD data; reusing stored history.")
+                tail = store._read_json(entry, "tail.json")
+                _write_location(store, writer, location, entry, tail, entry["stitch_date"])
+                continue
+            elif stitch_date is None or stitch_date < entry["stitch_date"]:
+                logging.warning(
+                    f"{location} → NEW data starts at {stitch_date}, before the frozen history "
+                    f"({entry['stitch_date']}); re-stitching the full location."
+                )
+                old_location = store.load_location(location)
+                stitched = stitch_fn({location: old_location}, {location: new_data[location]}, stitch_dates)[location]
+                store._clear_entry(entry)
+            else:
+                logging.info(f"{location} → stitch date: {stitch_date}; re-stitching data from {entry['stitch_date']}")
+                tail = store._read_json(entry, "tail.json")
+                old_tail = {variant: {"timeseriesSummary": rows} for variant, rows in tail.items()}
+                stitched = stitch_fn({location: old_tail}, {location: new_data[location]}, stitch_dates)[location]
+
+            tail = {variant: (vdata or {}).get("timeseriesSummary", []) for variant, vdata in stitched.items()}
+            if not entry["variants"]:
+                cut = _location_cut(stitched, stitch_date)
+            else:
+                cut = max(stitch_date or entry["stitch_date"], entry["stitch_date"])
+            _write_location(store, writer, location, entry, tail, cut)
+    finally:
+        writer.close()
+    store.save_checkpoint(output_path)
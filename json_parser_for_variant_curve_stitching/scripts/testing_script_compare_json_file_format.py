@@ -1,115 +1,216 @@
-# to run the script : conda activate deepdiff-env
-from deepdiff import DeepDiff
-import json
-import pprint
-
-control_file="/cluster/project/pangolin/processes/sars_cov_2/explore-new-variants/variants/results_ba32_202511_202512/deconvoluted_upload.json"
-test_file="/cluster/project/pangolin/resources/cowwid/json_parser_for_variant_curve_stitching/results/stitched_curve.json"
-
-with open(control_file) as f1, open(test_file) as f2:
-    d1 = json.load(f1)
-    d2 = json.load(f2)
-
-def same_date(x, y, level=None):
-    if isinstance(x, dict) and isinstance(y, dict):
-        return x.get("date") == y.get("date")
-    return x == y
-
-def count_timeseries(data):
-    counts = {}
-    for location, variants in data.items():
-        for variant, variant_data in variants.items():
-            ts = variant_data.get("timeseriesSummary", [])
-            counts[(location, variant)] = len(ts)
-    return counts
-
-def dateset(ts):
-    return {row.get("date") for row in ts if isinstance(row, dict) and row.get("date")}
-
-def check_date_alignment(data):
-    """
-    For each location, checks whether all variants have identical date sets in timeseriesSummary.
-    Prints only locations with mismatches, showing missing/extra dates per variant.
-    """
-    problems = []
-
-    for location, variants in data.items():
-        if not isinstance(variants, dict) or not variants:
+"""
+Compare two lollipop-format curve files
+
+Structural and numeric diff of a control and a test file (e.g. a reference
+lollipop output and a stitched curve). Both files are loaded into the columnar
+CurveStore and every data point is aligned on its (location, variant, date)
+key, so the comparison is a handful of sorted-array operations instead of
+DeepDiff's order-insensitive matching of the timeseriesSummary lists.
+
+Reported checks:
+- KEY CHECK: locations and location/variant series missing from or extra in the test file
+- LENGTH CHECK: series whose number of data points differs, with the dates only in one file
+- VALUE CHECK: per series the largest absolute difference of proportion,
+  proportionLower and proportionUpper over the shared dates, listed when above --atol
+  (null in both files counts as equal, null in only one as a difference)
+- DATE GRID CHECK: per file, locations whose variants do not share identical date sets
+
+The exit status is 0 when no check finds a difference, 1 otherwise.
+`--atol 0.05` is close to the former DeepDiff `significant_digits=1` comparison.
+
+USAGE:
+    python testing_script_compare_json_file_format.py control.json test.json [--atol 1e-6] [--max-report 20]
+"""
+
+import argparse
+import os
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "for_communication", "scripts"))
+from curve_store import VALUE_FIELDS, CurveStore, days_to_dates  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare two lollipop-format curve JSON files.")
+    parser.add_argument("control", help="Reference JSON file")
+    parser.add_argument("test", help="JSON file to check against the reference")
+    parser.add_argument("--atol", type=float, default=1e-6,
+                        help="Absolute tolerance for the value comparison (default: 1e-6)")
+    parser.add_argument("--max-report", type=int, default=20,
+                        help="Maximum number of entries listed per check (default: 20)")
+    return parser.parse_args()
+
+
+def row_keys(store: CurveStore, series_ids: Dict[Tuple[str, str], int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Global series id of every row and the int64 (series, date) key of every row."""
+    sid = np.array(
+        [series_ids[(location, variant)] for location, variant, _ in store.iter_series()], dtype=np.int64
+    )
+    row_sid = sid[store.row_series()]
+    keys = (row_sid << 32) | (store.day.astype(np.int64) + (1 << 31))
+    return row_sid, keys
+
+
+def first_unique(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Sorted unique keys, the row of their first occurrence and the number of duplicate rows."""
+    unique, first = np.unique(keys, return_index=True)
+    return unique, first, len(keys) - len(unique)
+
+
+def print_limited(lines: List[str], max_report: int):
+    for line in lines[:max_report]:
+        print(line)
+    if len(lines) > max_report:
+        print(f"  ... and {len(lines) - max_report} more")
+
+
+def compare(control: CurveStore, test: CurveStore, atol: float, max_report: int) -> bool:
+    """Print the key, length and value checks; True if everything matches."""
+    ok = True
+    pairs1 = [(loc, var) for loc, var, _ in control.iter_series()]
+    pairs2 = [(loc, var) for loc, var, _ in test.iter_series()]
+    series_ids = {pair: i for i, pair in enumerate(dict.fromkeys(pairs1 + pairs2))}
+    names = list(series_ids)
+
+    print("-------------------------")
+    print("KEY CHECK (locations / series only in one file):")
+    missing_locations = [loc for loc in control.locations if loc not in test.location_code]
+    extra_locations = [loc for loc in test.locations if loc not in control.location_code]
+    missing_series = sorted(set(pairs1) - set(pairs2))
+    extra_series = sorted(set(pairs2) - set(pairs1))
+    lines = [f"  missing location: {loc}" for loc in missing_locations]
+    lines += [f"  extra location:   {loc}" for loc in extra_locations]
+    lines += [f"  missing series:   {loc} | {var}" for loc, var in missing_series]
+    lines += [f"  extra series:     {loc} | {var}" for loc, var in extra_series]
+    print_limited(lines, max_report)
+    if lines:
+        ok = False
+    else:
+        print("  Same locations and series.")
+
+    sid1, keys1 = row_keys(control, series_ids)
+    sid2, keys2 = row_keys(test, series_ids)
+    unique1, first1, dup1 = first_unique(keys1)
+    unique2, first2, dup2 = first_unique(keys2)
+    shared, in1, in2 = np.intersect1d(unique1, unique2, assume_unique=True, return_indices=True)
+    only1 = unique1[~np.isin(unique1, shared, assume_unique=True)]
+    only2 = unique2[~np.isin(unique2, shared, assume_unique=True)]
+
+    print("-------------------------")
+    print("LENGTH CHECK (series present in both files with a different number of data points):")
+    n_series = len(names)
+    count1 = np.bincount(sid1, minlength=n_series)
+    count2 = np.bincount(sid2, minlength=n_series)
+    # the keys are sorted by series, so the dates of series i only in one file are a contiguous slice
+    bounds = np.arange(n_series + 1, dtype=np.int64)
+    cut1 = np.searchsorted(only1 >> 32, bounds)
+    cut2 = np.searchsorted(only2 >> 32, bounds)
+    both_ids = np.sort(np.array([series_ids[pair] for pair in set(pairs1) & set(pairs2)], dtype=np.int64))
+    lines = []
+    for i in both_ids:
+        dates_only1 = only1[cut1[i]:cut1[i + 1]]
+        dates_only2 = only2[cut2[i]:cut2[i + 1]]
+        if count1[i] == count2[i] and not len(dates_only1) and not len(dates_only2):
             continue
+        loc, var = names[i]
+        line = f"  {loc} | {var}: control={count1[i]}, test={count2[i]}"
+        for label, dates in (("only in control", dates_only1), ("only in test", dates_only2)):
+            if len(dates):
+                days = (dates & 0xFFFFFFFF) - (1 << 31)
+                line += f"\n      {label} ({len(days)}, first 5): {days_to_dates(days[:5])}"
+        lines.append(line)
+    print_limited(lines, max_report)
+    if dup1 or dup2:
+        print(f"  duplicate dates within a series: control={dup1}, test={dup2}")
+    if lines or dup1 or dup2:
+        ok = False
+    else:
+        print("  All shared series have the same dates.")
+
+    print("-------------------------")
+    print(f"VALUE CHECK (max absolute difference per series on shared dates, atol={atol}):")
+    rows1 = first1[in1]
+    rows2 = first2[in2]
+    shared_sid = shared >> 32
+    max_delta = np.zeros(n_series)
+    field_max = {}
+    for field, arr1, arr2 in zip(
+        VALUE_FIELDS, (control.proportion, control.lower, control.upper), (test.proportion, test.lower, test.upper)
+    ):
+        a, b = arr1[rows1].astype(np.float64), arr2[rows2].astype(np.float64)
+        nan1, nan2 = np.isnan(a), np.isnan(b)
+        delta = np.where(nan1 | nan2, np.where(nan1 & nan2, 0.0, np.inf), np.abs(a - b))
+        per_series = np.zeros(n_series)
+        np.maximum.at(per_series, shared_sid, delta)
+        field_max[field] = per_series
+        max_delta = np.maximum(max_delta, per_series)
+
+    differing = np.nonzero(max_delta > atol)[0]
+    differing = differing[np.argsort(-max_delta[differing], kind="stable")]
+    lines = []
+    for i in differing:
+        loc, var = names[i]
+        detail = ", ".join(f"{field}={field_max[field][i]:.3g}" for field in VALUE_FIELDS)
+        lines.append(f"  {loc} | {var}: max delta {max_delta[i]:.3g} ({detail})")
+    print_limited(lines, max_report)
+    if lines:
+        ok = False
+        print(f"  {len(lines)} of {len(both_ids)} shared series differ; largest delta {max_delta.max():.3g}")
+    else:
+        overall = max_delta.max() if n_series else 0.0
+        print(f"  All {len(shared)} shared data points within tolerance (largest delta {overall:.3g}).")
+    return ok
+
+
+def date_grid_problems(store: CurveStore) -> List[Tuple[str, str, int, List[tuple]]]:
+    """
+    Locations whose variants do not all share the same date set.
 
-        per_variant_dates = {}
-        for variant, vdata in variants.items():
-            ts = (vdata or {}).get("timeseriesSummary", [])
-            per_variant_dates[variant] = dateset(ts)
+    A series is aligned when its number of distinct dates equals the number of
+    distinct dates of its location (its dates being a subset of them); only the
+    locations with a misaligned series are inspected in detail.
+    """
+    row_series = store.row_series()
+    row_location = store.series_location[row_series].astype(np.int64)
+    days = store.day.astype(np.int64) + (1 << 31)
+    location_dates = np.bincount(np.unique((row_location << 32) | days) >> 32, minlength=len(store.locations))
+    series_dates = np.bincount(
+        np.unique((row_series.astype(np.int64) << 32) | days) >> 32, minlength=store.n_series
+    )
+    misaligned = series_dates != location_dates[store.series_location]
+    bad_locations = np.unique(store.series_location[misaligned])
 
+    problems = []
+    for code in bad_locations:
+        location = store.locations[code]
+        per_variant_dates = {
+            variant: set(store.day[sl].tolist())
+            for loc, variant, sl in store.iter_series()
+            if loc == location
+        }
         # reference = variant with the largest date set (most informative)
         ref_variant = max(per_variant_dates, key=lambda v: len(per_variant_dates[v]))
         ref_dates = per_variant_dates[ref_variant]
-
         mismatching = []
         for variant, dset in per_variant_dates.items():
             if dset != ref_dates:
-                missing = sorted(ref_dates - dset)
-                extra = sorted(dset - ref_dates)
+                missing = days_to_dates(np.array(sorted(ref_dates - dset)))
+                extra = days_to_dates(np.array(sorted(dset - ref_dates)))
                 mismatching.append((variant, len(dset), len(missing), len(extra), missing[:5], extra[:5]))
-
-        if mismatching:
-            problems.append((location, ref_variant, len(ref_dates), mismatching))
-
+        problems.append((location, ref_variant, len(ref_dates), mismatching))
     return problems
 
-# ignore_order=True helps if list items are same but in different order
-diff = DeepDiff(d1, d2, ignore_order=True, significant_digits=1)
-print("-------------------------")
-print("Diff CHECK 1:")
-pprint.pprint(diff)
-
-diff = DeepDiff(
-    d1, d2,
-    ignore_order=True,
-    significant_digits=1,
-    iterable_compare_func=same_date,
-    exclude_regex_paths=r".*"
-)
-print("-------------------------")
-print("Diff CHECK 2:")
-pprint.pprint(diff)
-
-c1 = count_timeseries(d1)
-c2 = count_timeseries(d2)
-all_pairs = sorted(set(c1.keys()) | set(c2.keys()))
-
-print("-------------------------")
-print("Diff CHECK 3: (no output below is good sign)")
-# only print mismatches
-for location, variant in all_pairs:
-    n1 = c1.get((location, variant), 0)
-    n2 = c2.get((location, variant), 0)
-    if n1 != n2:
-        print(f"{location} | {variant}: control={n1}, test={n2}")
-
-print("-------------------------")
-print("DATE GRID CHECK (within each file):")
-print("Control file (d1):")
-problems1 = check_date_alignment(d1)
-if not problems1:
-    print("  All locations: all variants share identical date sets.")
-else:
-    for location, ref_variant, ref_n, mismatching in problems1:
-        print(f"\n  {location} (ref={ref_variant}, n_dates={ref_n})")
-        for variant, n, n_missing, n_extra, missing5, extra5 in mismatching:
-            print(f"    - {variant}: n_dates={n}, missing={n_missing}, extra={n_extra}")
-            if n_missing:
-                print(f"        missing (first 5): {missing5}")
-            if n_extra:
-                print(f"        extra   (first 5): {extra5}")
 
-print("\nTest file (d2):")
-problems2 = check_date_alignment(d2)
-if not problems2:
-    print("  All locations: all variants share identical date sets.")
-else:
-    for location, ref_variant, ref_n, mismatching in problems2:
+def report_date_grid(label: str, store: CurveStore) -> bool:
+    print(f"{label}:")
+    problems = date_grid_problems(store)
+    if not problems:
+        print("  All locations: all variants share identical date sets.")
+        return True
+    for location, ref_variant, ref_n, mismatching in problems:
         print(f"\n  {location} (ref={ref_variant}, n_dates={ref_n})")
         for variant, n, n_missing, n_extra, missing5, extra5 in mismatching:
             print(f"    - {variant}: n_dates={n}, missing={n_missing}, extra={n_extra}")
@@ -117,3 +218,28 @@ else:
                 print(f"        missing (first 5): {missing5}")
             if n_extra:
                 print(f"        extra   (first 5): {extra5}")
+    return False
+
+
+def main():
+    args = parse_args()
+    control = CurveStore.load(args.control, value_dtype=np.float64)
+    test = CurveStore.load(args.test, value_dtype=np.float64)
+    print(f"Control: {args.control} ({control.n_series} series, {control.n_rows} data points)")
+    print(f"Test:    {args.test} ({test.n_series} series, {test.n_rows} data points)")
+
+    ok = compare(control, test, args.atol, args.max_report)
+
+    print("-------------------------")
+    print("DATE GRID CHECK (within each file):")
+    ok &= report_date_grid("Control file", control)
+    print()
+    ok &= report_date_grid("Test file", test)
+
+    print("-------------------------")
+    print("No differences found." if ok else "Differences found.")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Equivalence check of the vectorized stitching against the reference implementation
+
+`stitch_datasets` (enhanced_nested_json_stitching.py) is the reference; this
+script stitches small generated old/new datasets with it and with the columnar
+engine, and reports every case where the results differ (compare_stitched:
+same locations, variants, dates and values, null and NaN being equal). The
+columnar engine is run both through `stitch_datasets_vectorized` (nested dicts)
+and the way the CLI runs it: both files streamed into CurveStores, stitch dates
+from `determine_stitch_dates_from_store`, then `stitch_stores`.
+
+Cases:
+- fixed edge cases: a location only in new, a location only in old, a variant
+  only in old, a variant only in new, a stitch date before / after all old data,
+  empty series (in old, in new, and a location whose new series are all empty),
+  null values and ragged date grids (zero-filled)
+- --cases random datasets (random locations, variants, date ranges, gaps and nulls)
+
+The exit status is 0 when all cases agree, 1 otherwise.
+
+USAGE:
+    python testing_script_stitching_equivalence.py [--cases 200] [--seed 0]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from enhanced_nested_json_stitching import (  # noqa: E402
+    compare_stitched,
+    determine_stitch_dates_from_store,
+    determine_stitch_dates_per_location,
+    load_store,
+    stitch_datasets,
+    stitch_datasets_vectorized,
+    stitch_stores,
+)
+
+Dataset = Dict[str, Dict[str, Any]]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the vectorized stitching against the reference implementation.")
+    parser.add_argument("--cases", type=int, default=200, help="Number of random cases (default: 200)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random cases (default: 0)")
+    return parser.parse_args()
+
+
+def day(offset: int) -> str:
+    return (datetime.date(2025, 1, 1) + datetime.timedelta(days=offset)).isoformat()
+
+
+def series(days: List[int], value: float = 0.1, nulls: Tuple[int, ...] = ()) -> Dict[str, Any]:
+    rows = []
+    for i, d in enumerate(days):
+        v = None if d in nulls else round(value + i / 1000, 6)
+        rows.append({
+            "date": day(d),
+            "proportion": v,
+            "proportionLower": None if v is None else round(v / 2, 6),
+            "proportionUpper": None if v is None else round(min(1.0, v * 2), 6),
+        })
+    return {"timeseriesSummary": rows}
+
+
+def edge_cases() -> List[Tuple[str, Dataset, Dataset]]:
+    old_zh = {"BA.2.86": series(list(range(0, 10))), "XFG": series(list(range(0, 10)), 0.3)}
+    return [
+        ("location only in new", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"BA.2.86": series([8, 9, 10])}, "Basel (BS)": {"XFG": series([5, 6])}}),
+        ("location only in old", {"Zürich (ZH)": old_zh, "Chur (GR)": {"XFG": series([1, 3, 5])}}, {"Zürich (ZH)": {"XFG": series([9, 10, 11])}}),
+        ("variant only in old", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"BA.2.86": series([7, 8, 9, 10, 11])}}),
+        ("variant only in new", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"NB.1.8.1": series([9, 10, 11], 0.05)}}),
+        ("stitch date before all old data", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"BA.2.86": series([-5, -4, 2, 12])}}),
+        ("stitch date after all old data", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"BA.2.86": series([20, 21]), "XFG": series([22])}}),
+        ("stitch date on the first old date", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"XFG": series([0, 1])}}),
+        ("empty series in old", {"Zürich (ZH)": dict(old_zh, KP3={"timeseriesSummary": []})}, {"Zürich (ZH)": {"XFG": series([9, 10])}}),
+        ("empty series in new", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"XFG": series([9, 10]), "KP3": {"timeseriesSummary": []}}}),
+        ("location with only empty new series", {"Zürich (ZH)": old_zh}, {"Zürich (ZH)": {"XFG": {"timeseriesSummary": []}}}),
+        ("empty old and new", {}, {}),
+        ("null values", {"Zürich (ZH)": {"XFG": series(list(range(6)), nulls=(2, 3))}}, {"Zürich (ZH)": {"XFG": series([4, 5, 6], nulls=(6,))}}),
+        ("ragged date grids", {"Zürich (ZH)": {"XFG": series([0, 2, 4]), "BA.2.86": series([1, 3])}}, {"Zürich (ZH)": {"XFG": series([3, 7]), "LP.8": series([5])}}),
+    ]
+
+
+def random_case(rng: random.Random) -> Tuple[Dataset, Dataset]:
+    locations = [f"Location {i}" for i in range(rng.randint(1, 5))]
+    variants = [f"V{i}" for i in range(rng.randint(1, 6))]
+
+    def dataset(first: int, last: int, p_location: float, p_variant: float) -> Dataset:
+        data: Dataset = {}
+        for location in locations:
+            if rng.random() > p_location:
+                continue
+            data[location] = {}
+            for variant in variants:
+                if rng.random() > p_variant:
+                    continue
+                days = [d for d in range(first, last) if rng.random() < 0.8] if rng.random() > 0.1 else []
+                nulls = tuple(d for d in days if rng.random() < 0.05)
+                data[location][variant] = series(days, rng.random() / 2, nulls)
+        return data
+
+    old_last = rng.randint(5, 40)
+    new_first = rng.randint(-5, old_last + 5)
+    return dataset(0, old_last, 0.9, 0.8), dataset(new_first, new_first + rng.randint(1, 20), 0.8, 0.7)
+
+
+def store_stitch(old_data: Dataset, new_data: Dataset, workdir: str) -> Dict[str, Any]:
+    """Columnar stitch as run by the CLI: files streamed into stores, stitch dates from the store."""
+    paths = []
+    for name, data in (("old.json", old_data), ("new.json", new_data)):
+        path = os.path.join(workdir, name)
+        with open(path, "w") as f:
+            json.dump(data, f)
+        paths.append(path)
+    old, new = load_store(paths[0]), load_store(paths[1])
+    return stitch_stores(old, new, determine_stitch_dates_from_store(new)).to_dict()
+
+
+def check_case(name: str, old_data: Dataset, new_data: Dataset, workdir: str) -> Optional[List[str]]:
+    stitch_dates = determine_stitch_dates_per_location(new_data)
+    reference = stitch_datasets(old_data, new_data, stitch_dates)
+    problems = [f"vectorized: {p}" for p in compare_stitched(reference, stitch_datasets_vectorized(old_data, new_data, stitch_dates))]
+    problems += [f"stores: {p}" for p in compare_stitched(reference, store_stitch(old_data, new_data, workdir))]
+    return problems or None
+
+
+def main():
+    args = parse_args()
+    # the stitching functions log every location and variant
+    logging.getLogger().setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    cases = edge_cases() + [(f"random case {i}", *random_case(rng)) for i in range(args.cases)]
+    failed = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, old_data, new_data in cases:
+            problems = check_case(name, old_data, new_data, workdir)
+            if problems:
+                failed += 1
+                print(f"FAIL: {name}")
+                for problem in problems[:10]:
+                    print(f"    {problem}")
+            elif not name.startswith("random case"):
+                print(f"PASS: {name}")
+
+    print(f"\n{len(cases) - failed}/{len(cases)} cases identical ({args.cases} random, seed {args.seed})")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
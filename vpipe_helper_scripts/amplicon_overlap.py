@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Which variant-defining mutations fall in which amplicons, which are shared between variants, and which are uncovered
+
+Meant for curating new variant definitions (voc/*_mutations_full.yaml) against
+the primer schemes (amplicons.*.yaml) instead of checking collisions by eye.
+Works on the compiled variant catalog (variant_catalog.py), which is rebuilt
+first if one of the YAML files changed.
+
+For every scheme, the amplicon inserts are de-duplicated (the scheme files list
+the same amplicon once per variant tag, e.g. 67_om1, 67_ga) and sorted by start
+with a running maximum of the ends; all mutations of all variants are then joined
+against them at once (two `searchsorted` calls give each mutation its window of
+candidate amplicons). Inserts that do not lie within their primers are reported
+and clipped when the catalog is compiled.
+
+Outputs (tab separated, in --outdir):
+    mutations.tsv   one row per variant mutation: kind, number of variants listing it,
+                    the other variants, and the amplicons covering it per scheme (empty: uncovered)
+    amplicons.tsv   one row per scheme, amplicon and variant with mutations in it,
+                    including the mutations exclusive to that variant
+    matrix.tsv      variant x scheme:amplicon matrix of the number of mutations
+    summary.tsv     per variant and scheme: mutations, covered, uncovered, exclusive, exclusive covered
+
+USAGE:
+    python amplicon_overlap.py --outdir amplicon_overlap
+    python amplicon_overlap.py --outdir amplicon_overlap --schemes v532 v532.ba286 --kinds mut
+"""
+
+import argparse
+import glob
+import os
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from variant_catalog import KINDS, VariantCatalog, default_sources, load_or_compile
+
+
+def interval_join(
+    query_start: np.ndarray, query_end: np.ndarray, start: np.ndarray, end: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    All (query, interval) pairs whose closed ranges overlap.
+
+    `start` must be sorted. Intervals before the first one whose running maximum
+    end reaches the query start cannot overlap it, neither can those starting
+    after the query end, so each query only scans its [lo, hi) window.
+    """
+    maxend = np.maximum.accumulate(end) if len(end) else end
+    lo = np.searchsorted(maxend, query_start, side="left")
+    hi = np.searchsorted(start, query_end, side="right")
+    counts = np.maximum(hi - lo, 0)
+    query = np.repeat(np.arange(len(query_start)), counts)
+    # position of every pair inside its window, added to the window start
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    interval = np.repeat(lo, counts) + within
+    keep = end[interval] >= query_start[query]
+    return query[keep], interval[keep]
+
+
+def scheme_regions(catalog: VariantCatalog, scheme: int) -> pd.DataFrame:
+    """The distinct amplicons of a scheme, sorted by insert start (inserts are clipped to the primers by the catalog)."""
+    rows = np.flatnonzero(np.asarray(catalog.amp_scheme) == scheme)
+    regions = pd.DataFrame(
+        {
+            "amplicon": np.asarray(catalog.amp_number)[rows],
+            "start": np.asarray(catalog.amp_start)[rows],
+            "end": np.asarray(catalog.amp_end)[rows],
+            "insert_start": np.asarray(catalog.amp_insert_start)[rows],
+            "insert_end": np.asarray(catalog.amp_insert_end)[rows],
+            "name": [catalog.amplicon_names[i] for i in rows],
+        }
+    )
+    regions = regions.groupby(["amplicon", "start", "end", "insert_start", "insert_end"], as_index=False).agg(
+        names=("name", ",".join)
+    )
+    return regions.sort_values(["insert_start", "insert_end"], ignore_index=True)
+
+
+def members(catalog: VariantCatalog, kinds: Sequence[str]) -> pd.DataFrame:
+    """One row per (variant, mutation) of the selected kinds."""
+    counts = np.diff(np.asarray(catalog.var_offsets))
+    table = pd.DataFrame(
+        {
+            "variant_id": np.repeat(np.arange(len(catalog.variants)), counts),
+            "mutation": np.asarray(catalog.var_mut),
+            "kind": np.asarray(catalog.var_kind),
+        }
+    )
+    table = table[table["kind"].isin([KINDS.index(k) for k in kinds])]
+    # a variant can list the same mutation in two sections; keep its first kind
+    table = table.drop_duplicates(["variant_id", "mutation"], ignore_index=True)
+
+    mut_pos = np.asarray(catalog.mut_pos)
+    mut_change = np.asarray(catalog.mut_change)
+    table["variant"] = [catalog.variants[v]["short"] for v in table["variant_id"]]
+    table["pangolin"] = [catalog.variants[v]["pangolin"] for v in table["variant_id"]]
+    table["position"] = mut_pos[table["mutation"]]
+    table["end_position"] = np.asarray(catalog.mut_end)[table["mutation"]]
+    table["change"] = [catalog.strings[c] for c in mut_change[table["mutation"]]]
+    table["kind"] = [KINDS[k] for k in table["kind"]]
+    table["n_variants"] = table.groupby("mutation")["variant_id"].transform("size")
+    carriers = table.groupby("mutation")["variant"].agg(list)
+    table["shared_with"] = [
+        ",".join(v for v in carriers[m] if v != own) for m, own in zip(table["mutation"], table["variant"])
+    ]
+    return table
+
+
+def analyze(
+    catalog: VariantCatalog, schemes: Sequence[str], kinds: Sequence[str]
+) -> Dict[str, pd.DataFrame]:
+    table = members(catalog, kinds)
+    mutations = np.unique(table["mutation"].to_numpy())
+    query_start = np.asarray(catalog.mut_pos)[mutations]
+    query_end = np.asarray(catalog.mut_end)[mutations]
+
+    in_amplicons: List[pd.DataFrame] = []
+    for scheme in schemes:
+        regions = scheme_regions(catalog, catalog.schemes.index(scheme))
+        query, region = interval_join(query_start, query_end, regions["insert_start"].to_numpy(), regions["insert_end"].to_numpy())
+        pairs = pd.DataFrame(
+            {
+                "mutation": mutations[query],
+                "scheme": scheme,
+                "amplicon": regions["amplicon"].to_numpy()[region],
+                "insert_start": regions["insert_start"].to_numpy()[region],
+                "insert_end": regions["insert_end"].to_numpy()[region],
+            }
+        )
+        covering = pairs.groupby("mutation")["amplicon"].agg(lambda a: ",".join(map(str, sorted(a))))
+        table[scheme] = table["mutation"].map(covering).fillna("")
+        in_amplicons.append(pairs)
+
+    pairs = pd.concat(in_amplicons, ignore_index=True).merge(
+        table[["mutation", "variant", "position", "change", "n_variants"]], on="mutation"
+    )
+    pairs["exclusive"] = pairs["n_variants"] == 1
+    pairs["label"] = pairs["position"].astype(str) + pairs["change"]
+    amplicons = (
+        pairs.groupby(["scheme", "amplicon", "insert_start", "insert_end", "variant"], sort=False)
+        .agg(
+            mutations=("label", "size"),
+            exclusive=("exclusive", "sum"),
+            positions=("label", ",".join),
+        )
+        .reset_index()
+        .sort_values(["scheme", "amplicon", "variant"], ignore_index=True)
+    )
+
+    matrix = amplicons.assign(column=amplicons["scheme"] + ":" + amplicons["amplicon"].astype(str)).pivot_table(
+        index="variant", columns="column", values="mutations", aggfunc="sum", fill_value=0
+    )
+    matrix = matrix[sorted(matrix.columns, key=lambda c: (c.rsplit(":", 1)[0], int(c.rsplit(":", 1)[1])))]
+
+    summary = []
+    for scheme in schemes:
+        covered = table[scheme] != ""
+        exclusive = table["n_variants"] == 1
+        summary.append(
+            pd.DataFrame(
+                {
+                    "variant": table["variant"],
+                    "scheme": scheme,
+                    "mutations": 1,
+                    "covered": covered.astype(int),
+                    "uncovered": (~covered).astype(int),
+                    "exclusive": exclusive.astype(int),
+                    "exclusive_covered": (exclusive & covered).astype(int),
+                }
+            )
+        )
+    summary = (
+        pd.concat(summary, ignore_index=True).groupby(["variant", "scheme"], sort=False).sum().reset_index()
+    )
+
+    columns = ["variant", "pangolin", "position", "change", "kind", "n_variants", "shared_with", *schemes]
+    return {
+        "mutations": table[columns].sort_values(["variant", "position", "change"], ignore_index=True),
+        "amplicons": amplicons,
+        "matrix": matrix.reset_index(),
+        "summary": summary,
+    }
+
+
+def main():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Amplicon overlap and shared mutations of the variant definitions.")
+    parser.add_argument("--catalog", default=os.path.join(repo_dir, "variant_catalog"), help="Catalog directory")
+    parser.add_argument("--voc-dir", default=os.path.join(repo_dir, "voc"), help="Directory of *_mutations_full.yaml")
+    parser.add_argument("--amplicons", nargs="*", default=None, help="Amplicon scheme files (default: amplicons.*.yaml)")
+    parser.add_argument("--schemes", nargs="+", default=None, help="Schemes to analyze (default: all, e.g. v41 v532)")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS), help="Mutation sections to include")
+    parser.add_argument("--outdir", required=True, help="Output directory for the tables")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    voc_files = sorted(glob.glob(os.path.join(args.voc_dir, "*_mutations_full.yaml")))
+    amplicon_files = sorted(args.amplicons) if args.amplicons is not None else default_sources(repo_dir)[1]
+    catalog = load_or_compile(args.catalog, voc_files, amplicon_files)
+
+    schemes = args.schemes or catalog.schemes
+    unknown = [s for s in schemes if s not in catalog.schemes]
+    if unknown:
+        parser.error(f"unknown scheme(s) {', '.join(unknown)}; available: {', '.join(catalog.schemes)}")
+
+    tables = analyze(catalog, schemes, args.kinds)
+    os.makedirs(args.outdir, exist_ok=True)
+    for name, table in tables.items():
+        table.to_csv(os.path.join(args.outdir, f"{name}.tsv"), sep="\t", index=False)
+
+    mutations = tables["mutations"]
+    print(f"{len(mutations)} variant mutations ({mutations['position'].nunique()} sites) x {len(schemes)} schemes")
+    print(f"Shared between variants: {(mutations['n_variants'] > 1).sum()}")
+    for scheme in schemes:
+        print(f"Uncovered by {scheme}: {(mutations[scheme] == '').sum()}")
+    print(f"Tables written to {args.outdir} in {time.time() - start_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Compiled, indexed catalog of the variant signatures and amplicon schemes
+
+The variant definitions (voc/*_mutations_full.yaml: `mut:`, `shared:` and
+`revert:` maps of position -> 'C>T'-style change) and the amplicon schemes
+(amplicons.*.yaml: name -> [start, end, insert_start, insert_end, {position: base}])
+are parsed once and written as NumPy arrays plus a small JSON header:
+
+    <catalog>/catalog.json          version, source fingerprints, variant / scheme / amplicon names, change strings
+    <catalog>/mut_pos.npy           mutations sorted by (position, change): first position (int32)
+    <catalog>/mut_end.npy           last position covered by the change (int32, e.g. deletions)
+    <catalog>/mut_maxend.npy        running maximum of mut_end (interval index over the sorted mutations)
+    <catalog>/mut_change.npy        index of the change string (int32)
+    <catalog>/var_offsets.npy       variant x mutation membership, CSR by variant:
+    <catalog>/var_mut.npy             mutations of variant i are var_mut[var_offsets[i]:var_offsets[i + 1]]
+    <catalog>/var_kind.npy            0 = mut, 1 = shared, 2 = revert (int8)
+    <catalog>/mut_offsets.npy       the same membership, CSR by mutation (variants carrying mutation j)
+    <catalog>/mut_var.npy
+    <catalog>/mut_kind.npy
+    <catalog>/amp_*.npy             amplicons sorted by insert start: scheme, number, start, end, insert_start,
+                                    insert_end, running maximum of insert_end, and CSR of their {position: base} entries
+                                    (an insert that does not lie within its primers is reported and clipped to them)
+
+`VariantCatalog.load` memory-maps the arrays, so loading is instant and a
+lookup is a binary search on the sorted positions:
+- `signature(variant)`            the mutations of a variant
+- `at(position)` / `in_range()`   mutations (and the variants carrying them) covering a site / a range
+- `amplicons_at(position)`        amplicons whose insert covers a site
+
+`compile` only rebuilds the catalog when a source file changed (size/mtime, then SHA-256).
+
+USAGE:
+    python variant_catalog.py compile --voc-dir voc --amplicons amplicons.*.yaml --catalog variant_catalog
+    python variant_catalog.py site --catalog variant_catalog 22813 [23012 ...]
+    python variant_catalog.py variant --catalog variant_catalog ombba286
+
+    from variant_catalog import VariantCatalog
+    catalog = VariantCatalog.load("variant_catalog")
+    catalog.at(22813)
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import yaml
+
+CATALOG_VERSION = 2
+KINDS = ("mut", "shared", "revert")
+
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+MUT_ARRAYS = ("mut_pos", "mut_end", "mut_maxend", "mut_change", "mut_offsets", "mut_var", "mut_kind")
+VAR_ARRAYS = ("var_offsets", "var_mut", "var_kind")
+AMP_ARRAYS = (
+    "amp_scheme", "amp_number", "amp_start", "amp_end", "amp_insert_start", "amp_insert_end", "amp_maxend",
+    "amp_offsets", "amp_mut_pos", "amp_mut_base",
+)
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def change_span(change: str) -> int:
+    """Number of reference positions covered by a change ('C>T': 1, 'GAT>CTC': 3, '---': 3)."""
+    return max(1, len(change.split(">", 1)[0]))
+
+
+def scheme_name(path: str) -> str:
+    """amplicons.v532.ba286.yaml -> v532.ba286"""
+    name = os.path.basename(path)
+    name = re.sub(r"^amplicons\.", "", name)
+    return re.sub(r"\.ya?ml$", "", name)
+
+
+def _interned(strings: Dict[str, int], value: str) -> int:
+    return strings.setdefault(value, len(strings))
+
+
+def _running_max(values: np.ndarray) -> np.ndarray:
+    return np.maximum.accumulate(values) if len(values) else values.copy()
+
+
+def _csr(keys: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Stable order grouping `keys` (0..n-1) and the CSR offsets of the groups."""
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+    return order, offsets
+
+
+def compile_catalog(voc_files: List[str], amplicon_files: List[str]) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """Parse the YAML sources into the catalog header and arrays."""
+    strings: Dict[str, int] = {}
+    variants: List[Dict[str, str]] = []
+    members: List[Tuple[int, int, str, int]] = []  # (variant, position, change, kind)
+
+    for path in voc_files:
+        with open(path, "r") as f:
+            doc = yaml.load(f, Loader=SafeLoader) or {}
+        info = doc.get("variant") or {}
+        variant = len(variants)
+        variants.append(
+            {
+                "short": str(info.get("short") or "").strip(),
+                "pangolin": str(info.get("pangolin") or "").strip(),
+                "nextstrain": str(info.get("nextstrain") or "").strip(),
+                "file": os.path.basename(path),
+            }
+        )
+        for kind, section in enumerate(KINDS):
+            for position, change in (doc.get(section) or {}).items():
+                members.append((variant, int(position), str(change).strip(), kind))
+
+    # mutation table: unique (position, change), sorted
+    keys = sorted({(position, change) for _, position, change, _ in members})
+    mutation_index = {key: i for i, key in enumerate(keys)}
+    mut_pos = np.array([position for position, _ in keys], dtype=np.int32)
+    mut_end = np.array([position + change_span(change) - 1 for position, change in keys], dtype=np.int32)
+    mut_change = np.array([_interned(strings, change) for _, change in keys], dtype=np.int32)
+
+    member_var = np.array([m[0] for m in members], dtype=np.int32)
+    member_mut = np.array([mutation_index[(m[1], m[2])] for m in members], dtype=np.int32)
+    member_kind = np.array([m[3] for m in members], dtype=np.int8)
+
+    # CSR by variant (mutations in position order) and by mutation (variants in file order)
+    by_position = np.lexsort((member_mut, member_var))
+    var_order, var_offsets = _csr(member_var[by_position], len(variants))
+    var_order = by_position[var_order]
+    mut_order, mut_offsets = _csr(member_mut, len(keys))
+
+    schemes: List[str] = []
+    amplicon_names: List[str] = []
+    amplicons: List[Tuple[int, int, int, int, int, int, List[Tuple[int, int]]]] = []
+    for path in amplicon_files:
+        with open(path, "r") as f:
+            doc = yaml.load(f, Loader=SafeLoader) or {}
+        scheme = len(schemes)
+        schemes.append(scheme_name(path))
+        for name, (start, end, insert_start, insert_end, mutations) in doc.items():
+            number = str(name).split("_", 1)[0]
+            if not int(start) <= int(insert_start) <= int(insert_end) <= int(end):
+                clipped = [min(max(int(p), int(start)), int(end)) for p in (insert_start, insert_end)]
+                print(
+                    f"[WARN] {schemes[-1]}: amplicon {name} has insert {insert_start}-{insert_end} "
+                    f"outside of {start}-{end}, clipped to {clipped[0]}-{clipped[1]}",
+                    file=sys.stderr,
+                )
+                insert_start, insert_end = clipped
+            amplicon_names.append(str(name))
+            amplicons.append(
+                (
+                    scheme,
+                    int(number) if number.isdigit() else -1,
+                    int(start),
+                    int(end),
+                    int(insert_start),
+                    int(insert_end),
+                    sorted((int(p), _interned(strings, str(b))) for p, b in (mutations or {}).items()),
+                )
+            )
+
+    # the index is over the insert intervals
+    amp_order = sorted(range(len(amplicons)), key=lambda i: (amplicons[i][4], amplicons[i][5], i))
+    amplicons = [amplicons[i] for i in amp_order]
+    amplicon_names = [amplicon_names[i] for i in amp_order]
+    amp_columns = [np.array([a[c] for a in amplicons], dtype=np.int32) for c in range(6)]
+    amp_offsets = np.zeros(len(amplicons) + 1, dtype=np.int64)
+    np.cumsum([len(a[6]) for a in amplicons], out=amp_offsets[1:])
+
+    arrays = {
+        "mut_pos": mut_pos,
+        "mut_end": mut_end,
+        "mut_maxend": _running_max(mut_end),
+        "mut_change": mut_change,
+        "mut_offsets": mut_offsets,
+        "mut_var": member_var[mut_order],
+        "mut_kind": member_kind[mut_order],
+        "var_offsets": var_offsets,
+        "var_mut": member_mut[var_order],
+        "var_kind": member_kind[var_order],
+        "amp_scheme": amp_columns[0].astype(np.int16),
+        "amp_number": amp_columns[1],
+        "amp_start": amp_columns[2],
+        "amp_end": amp_columns[3],
+        "amp_insert_start": amp_columns[4],
+        "amp_insert_end": amp_columns[5],
+        "amp_maxend": _running_max(amp_columns[5]),
+        "amp_offsets": amp_offsets,
+        "amp_mut_pos": np.array([p for a in amplicons for p, _ in a[6]], dtype=np.int32),
+        "amp_mut_base": np.array([b for a in amplicons for _, b in a[6]], dtype=np.int32),
+    }
+    header = {
+        "version": CATALOG_VERSION,
+        "variants": variants,
+        "schemes": schemes,
+        "amplicons": amplicon_names,
+        "strings": list(strings),
+    }
+    return header, arrays
+
+
+def _fingerprint(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _sha256(path)}
+
+
+def is_current(catalog_dir: str, sources: List[str]) -> bool:
+    """Whether the catalog was compiled from the current content of exactly these sources."""
+    path = os.path.join(catalog_dir, "catalog.json")
+    if not os.path.exists(path):
+        return False
+    with open(path, "r") as f:
+        header = json.load(f)
+    recorded = header.get("sources", {})
+    if header.get("version") != CATALOG_VERSION or sorted(recorded) != sorted(sources):
+        return False
+    for source in sources:
+        stat = os.stat(source)
+        if (stat.st_size, stat.st_mtime_ns) == (recorded[source]["size"], recorded[source]["mtime_ns"]):
+            continue
+        if stat.st_size != recorded[source]["size"] or _sha256(source) != recorded[source]["sha256"]:
+            return False
+    return True
+
+
+def write_catalog(catalog_dir: str, voc_files: List[str], amplicon_files: List[str]):
+    header, arrays = compile_catalog(voc_files, amplicon_files)
+    header["sources"] = {path: _fingerprint(path) for path in voc_files + amplicon_files}
+    os.makedirs(catalog_dir, exist_ok=True)
+    # the header is written last: an interrupted compile leaves no valid catalog behind
+    if os.path.exists(os.path.join(catalog_dir, "catalog.json")):
+        os.remove(os.path.join(catalog_dir, "catalog.json"))
+    for name, array in arrays.items():
+        np.save(os.path.join(catalog_dir, f"{name}.npy"), array)
+    path = os.path.join(catalog_dir, "catalog.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(header, f, indent=1)
+    os.replace(path + ".tmp", path)
+    print(
+        f"Compiled {len(header['variants'])} variants, {len(arrays['mut_pos'])} mutations, "
+        f"{len(header['amplicons'])} amplicons ({len(header['schemes'])} schemes) into {catalog_dir}"
+    )
+
+
+class VariantCatalog:
+    """Memory-mapped view of a compiled catalog."""
+
+    def __init__(self, header: Dict[str, Any], arrays: Dict[str, np.ndarray]):
+        self.header = header
+        self.variants: List[Dict[str, str]] = header["variants"]
+        self.schemes: List[str] = header["schemes"]
+        self.amplicon_names: List[str] = header["amplicons"]
+        self.strings: List[str] = header["strings"]
+        self.variant_index = {v["short"]: i for i, v in enumerate(self.variants)}
+        self.variant_index.update({v["pangolin"]: i for i, v in enumerate(self.variants) if v["pangolin"]})
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @classmethod
+    def load(cls, catalog_dir: str, mmap: bool = True) -> "VariantCatalog":
+        with open(os.path.join(catalog_dir, "catalog.json"), "r") as f:
+            header = json.load(f)
+        if header.get("version") != CATALOG_VERSION:
+            raise ValueError(f"Catalog {catalog_dir} has version {header.get('version')!r}, expected {CATALOG_VERSION}")
+        mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(catalog_dir, f"{name}.npy"), mmap_mode=mode)
+            for name in MUT_ARRAYS + VAR_ARRAYS + AMP_ARRAYS
+        }
+        return cls(header, arrays)
+
+    @property
+    def n_mutations(self) -> int:
+        return len(self.mut_pos)
+
+    def change(self, mutation: int) -> str:
+        return self.strings[self.mut_change[mutation]]
+
+    def variant_id(self, variant: str) -> int:
+        """Index of a variant by its short name or pangolin lineage."""
+        if variant not in self.variant_index:
+            raise KeyError(f"Unknown variant {variant!r}")
+        return self.variant_index[variant]
+
+    def signature(self, variant: str, kinds=KINDS) -> List[Tuple[int, str, str]]:
+        """(position, change, kind) of the variant's mutations, by position."""
+        i = self.variant_id(variant)
+        sl = slice(int(self.var_offsets[i]), int(self.var_offsets[i + 1]))
+        return [
+            (int(self.mut_pos[m]), self.change(m), KINDS[k])
+            for m, k in zip(self.var_mut[sl].tolist(), self.var_kind[sl].tolist())
+            if KINDS[k] in kinds
+        ]
+
+    def carriers(self, mutation: int) -> List[Tuple[str, str]]:
+        """(variant short name, kind) of the variants listing a mutation."""
+        sl = slice(int(self.mut_offsets[mutation]), int(self.mut_offsets[mutation + 1]))
+        return [(self.variants[v]["short"], KINDS[k]) for v, k in zip(self.mut_var[sl].tolist(), self.mut_kind[sl].tolist())]
+
+    def mutations_in(self, start: int, end: int) -> np.ndarray:
+        """Indices of the mutations overlapping [start, end] (binary searches on the sorted positions)."""
+        hi = int(np.searchsorted(self.mut_pos, end, side="right"))
+        # mutations before lo end before start (running maximum of the end positions)
+        lo = int(np.searchsorted(self.mut_maxend, start, side="left"))
+        candidates = np.arange(lo, hi)
+        return candidates[self.mut_end[lo:hi] >= start]
+
+    def at(self, position: int) -> List[Dict[str, Any]]:
+        """Mutations covering a site, each with the variants carrying it."""
+        return self.in_range(position, position)
+
+    def in_range(self, start: int, end: int) -> List[Dict[str, Any]]:
+        return [
+            {"position": int(self.mut_pos[m]), "change": self.change(m), "variants": self.carriers(m)}
+            for m in self.mutations_in(start, end).tolist()
+        ]
+
+    def amplicons_in(self, start: int, end: int, scheme: Optional[str] = None) -> np.ndarray:
+        """Indices of the amplicons whose insert overlaps [start, end]."""
+        hi = int(np.searchsorted(self.amp_insert_start, end, side="right"))
+        lo = int(np.searchsorted(self.amp_maxend, start, side="left"))
+        candidates = np.arange(lo, hi)
+        keep = self.amp_insert_end[lo:hi] >= start
+        if scheme is not None:
+            if scheme not in self.schemes:
+                raise KeyError(f"Unknown scheme {scheme!r}")
+            keep &= self.amp_scheme[lo:hi] == self.schemes.index(scheme)
+        return candidates[keep]
+
+    def amplicon(self, index: int) -> Dict[str, Any]:
+        sl = slice(int(self.amp_offsets[index]), int(self.amp_offsets[index + 1]))
+        return {
+            "scheme": self.schemes[self.amp_scheme[index]],
+            "name": self.amplicon_names[index],
+            "start": int(self.amp_start[index]),
+            "end": int(self.amp_end[index]),
+            "insert_start": int(self.amp_insert_start[index]),
+            "insert_end": int(self.amp_insert_end[index]),
+            "mutations": {p: self.strings[b] for p, b in zip(self.amp_mut_pos[sl].tolist(), self.amp_mut_base[sl].tolist())},
+        }
+
+    def amplicons_at(self, position: int, scheme: Optional[str] = None) -> List[Dict[str, Any]]:
+        return [self.amplicon(i) for i in self.amplicons_in(position, position, scheme).tolist()]
+
+
+def load_or_compile(catalog_dir: str, voc_files: List[str], amplicon_files: List[str]) -> "VariantCatalog":
+    """Load the catalog, compiling it first if it is missing or a source changed."""
+    if not is_current(catalog_dir, voc_files + amplicon_files):
+        write_catalog(catalog_dir, voc_files, amplicon_files)
+    return VariantCatalog.load(catalog_dir)
+
+
+def default_sources(base_dir: str) -> Tuple[List[str], List[str]]:
+    return (
+        sorted(glob.glob(os.path.join(base_dir, "voc", "*_mutations_full.yaml"))),
+        sorted(glob.glob(os.path.join(base_dir, "amplicons.*.yaml"))),
+    )
+
+
+def main():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Compile and query the variant signature / amplicon catalog.")
+    parser.add_argument("--catalog", default=os.path.join(repo_dir, "variant_catalog"), help="Catalog directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_compile = sub.add_parser("compile", help="Compile the catalog from the YAML definitions")
+    p_compile.add_argument("--voc-dir", default=os.path.join(repo_dir, "voc"), help="Directory of *_mutations_full.yaml")
+    p_compile.add_argument("--amplicons", nargs="*", default=None, help="Amplicon scheme files (default: amplicons.*.yaml)")
+    p_compile.add_argument("--force", action="store_true", help="Recompile even if the sources did not change")
+
+    p_site = sub.add_parser("site", help="Variants sharing a site, and the amplicons covering it")
+    p_site.add_argument("positions", nargs="+", type=int)
+    p_site.add_argument("--scheme", default=None, help="Only amplicons of this scheme (e.g. v532)")
+
+    p_variant = sub.add_parser("variant", help="Signature of a variant (short name or pangolin lineage)")
+    p_variant.add_argument("name")
+
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        voc_files = sorted(glob.glob(os.path.join(args.voc_dir, "*_mutations_full.yaml")))
+        amplicon_files = sorted(args.amplicons) if args.amplicons is not None else default_sources(repo_dir)[1]
+        if not args.force and is_current(args.catalog, voc_files + amplicon_files):
+            print(f"Catalog {args.catalog} is up to date")
+        else:
+            write_catalog(args.catalog, voc_files, amplicon_files)
+        return
+
+    catalog = VariantCatalog.load(args.catalog)
+    if args.command == "site":
+        if args.scheme is not None and args.scheme not in catalog.schemes:
+            parser.error(f"unknown scheme {args.scheme}; available: {', '.join(catalog.schemes)}")
+        for position in args.positions:
+            print(f"{position}:")
+            for mutation in catalog.at(position):
+                carriers = ", ".join(f"{v}" + ("" if k == "mut" else f" ({k})") for v, k in mutation["variants"])
+                print(f"  {mutation['position']} {mutation['change']}: {carriers}")
+            for amplicon in catalog.amplicons_at(position, args.scheme):
+                print(f"  amplicon {amplicon['scheme']}:{amplicon['name']} insert {amplicon['insert_start']}-{amplicon['insert_end']}")
+    elif args.command == "variant":
+        if args.name not in catalog.variant_index:
+            known = ", ".join(v["short"] for v in catalog.variants)
+            parser.error(f"unknown variant {args.name}; known short names (or their pangolin lineages): {known}")
+        for position, change, kind in catalog.signature(args.name):
+            print(f"{position}\t{change}\t{kind}")
+
+
+if __name__ == "__main__":
+    main()